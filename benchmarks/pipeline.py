@@ -0,0 +1,287 @@
+#! /usr/bin/env python
+"""
+Benchmark harness for the empkg packaging pipeline
+
+Generates synthetic PKGBUILDs and source trees, serves them from a local HTTP
+server and times every pipeline stage. Results are written as JSON so runs on
+different commits can be compared with --compare.
+
+    python benchmarks/pipeline.py --profile small-files --out bench.json
+    python benchmarks/pipeline.py --compare old.json --out new.json
+"""
+import argparse
+import json
+import os
+import platform
+import posixpath
+import random
+import shutil
+import subprocess
+import sys
+import tarfile
+import tempfile
+import threading
+import time
+import urllib
+import urlparse
+from copy import copy
+from BaseHTTPServer import HTTPServer
+from SimpleHTTPServer import SimpleHTTPRequestHandler
+from SocketServer import ThreadingMixIn
+
+here = os.path.abspath(os.path.dirname(__file__))
+sys.path.insert(0, os.path.dirname(here))
+
+import yaml
+
+from empkg import sources
+from empkg.constants import BASE_CONFIG
+from empkg.packagers import BasePackager
+from empkg.util import produce_and_run_script, produce_script, rm_rf
+
+PROFILES = {
+    # Lots of tiny files in one archive plus many local sources
+    'small-files': {'files': 5000, 'size': 512, 'local': 200, 'templates': 10, 'depth': 1},
+    # A handful of big files
+    'huge-files': {'files': 4, 'size': 64 * 1024 * 1024, 'local': 2, 'templates': 1, 'depth': 1},
+    # Many templates with nested blocks
+    'templates': {'files': 50, 'size': 4096, 'local': 50, 'templates': 500, 'depth': 8},
+}
+
+STAGES = ('download_url', 'extract', 'apply_context', 'get_sources', 'produce_script', 'package', 'fpm')
+
+PACKAGE_SCRIPT = '''#!/usr/bin/env bash
+set -e
+mkdir -p {{pkgdir}}/opt/{{pkgname}}
+cp -rp {{srcdir}}/* {{pkgdir}}/opt/{{pkgname}}
+'''
+
+
+def make_handler(directory):
+    class Handler(SimpleHTTPRequestHandler):
+        def translate_path(self, path):
+            path = posixpath.normpath(urllib.unquote(urlparse.urlsplit(path).path))
+            return os.path.join(directory, *[part for part in path.split('/') if part not in ('', '.', '..')])
+
+        def log_message(self, format, *args):
+            pass
+    return Handler
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def serve(directory):
+    """Serve directory on a random localhost port, returns (server, base url)"""
+    server = ThreadingHTTPServer(('127.0.0.1', 0), make_handler(directory))
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server, 'http://127.0.0.1:%d' % server.server_address[1]
+
+
+def write_file(path, size, rnd):
+    dirname = os.path.dirname(path)
+    if not os.path.isdir(dirname):
+        os.makedirs(dirname)
+    block = bytes(bytearray(rnd.getrandbits(8) for _ in xrange(min(size, 4096))))
+    with open(path, 'wb') as fd:
+        remaining = size
+        while remaining > 0:
+            fd.write(block[:remaining])
+            remaining -= len(block)
+
+
+def template_body(depth, index):
+    body = 'pkgname={{pkgname}} pkgver={{pkgver}} file=%d\n' % index
+    for level in range(depth):
+        body = '{%% for i%d in range(2) %%}%s{%% endfor %%}\n' % (level, body)
+    return body
+
+
+def generate(workdir, name, params, seed):
+    """Generate the synthetic tree and PKGBUILD, returns the PKGBUILD path"""
+    rnd = random.Random(seed)
+    pkgbuild_dir = os.path.join(workdir, 'build')
+    served = os.path.join(workdir, 'www')
+    tree = os.path.join(workdir, 'tree', name)
+    os.makedirs(pkgbuild_dir)
+    os.makedirs(served)
+
+    for i in range(params['files']):
+        write_file(os.path.join(tree, 'd%03d' % (i % 100), 'f%06d.dat' % i), params['size'], rnd)
+
+    archive = '%s.tar.gz' % name
+    with tarfile.open(os.path.join(served, archive), 'w:gz') as tar:
+        tar.add(tree, arcname=name)
+
+    source = ['%s/%s' % ('{{_mirror}}', archive)]
+    template = []
+    for i in range(params['local']):
+        rel = os.path.join('local', 'l%05d.txt' % i)
+        write_file(os.path.join(pkgbuild_dir, rel), 1024, rnd)
+        source.append(rel)
+    for i in range(params['templates']):
+        rel = os.path.join('templates', *['t%d' % level for level in range(params['depth'])])
+        rel = os.path.join(rel, 'tpl%05d.conf' % i)
+        path = os.path.join(pkgbuild_dir, rel)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'w') as fd:
+            fd.write(template_body(params['depth'], i))
+        source.append(rel)
+        template.append(rel)
+
+    pkgbuild = {
+        'pkgname': 'bench-%s' % name,
+        'pkgver': '1.0.0',
+        'pkgrel': 1,
+        'arch': 'any',
+        'pkgdesc': 'empkg benchmark package',
+        'source': source,
+        'template': template,
+        'noextract': [],
+        'package': PACKAGE_SCRIPT,
+    }
+    path = os.path.join(pkgbuild_dir, 'PKGBUILD.yml')
+    with open(path, 'w') as fd:
+        yaml.safe_dump(pkgbuild, fd, default_flow_style=False)
+    return path, served
+
+
+def timed(results, stage, fcn, *args, **kwargs):
+    start = time.time()
+    ret = fcn(*args, **kwargs)
+    results.setdefault(stage, []).append(time.time() - start)
+    return ret
+
+
+def have_fpm():
+    return any(os.access(os.path.join(path, 'fpm'), os.X_OK)
+               for path in os.environ.get('PATH', '').split(os.pathsep))
+
+
+def run_once(pkgbuild, mirror, results):
+    with open(pkgbuild) as fd:
+        conf = copy(BASE_CONFIG)
+        conf.update(yaml.safe_load(fd))
+    conf['_mirror'] = mirror
+
+    currdir = os.getcwd()
+    os.chdir(os.path.dirname(pkgbuild))
+    try:
+        packager = BasePackager(conf)
+        packager.clean()
+        timed(results, 'apply_context', packager.apply_context)
+
+        remote = [s for s in conf['source'] if s.startswith('http')]
+        local = [s for s in conf['source'] if not s.startswith('http')]
+        downloaded = [timed(results, 'download_url', sources.download_url, s, packager.srcdir) for s in remote]
+        for filename in downloaded:
+            timed(results, 'extract', sources.extract, os.path.join(packager.srcdir, filename), packager.srcdir)
+
+        packager.conf['source'] = local
+        timed(results, 'get_sources', packager.get_sources)
+
+        script = os.path.join(packager.scriptdir, 'package')
+        timed(results, 'produce_script', produce_script, conf['package'], script, context=conf)
+        timed(results, 'package', produce_and_run_script, conf['package'], script,
+              context=conf, workdir=packager.startdir)
+
+        if have_fpm():
+            timed(results, 'fpm', packager.fpm)
+        rm_rf(packager.srcdir)
+        rm_rf(packager.pkgdir)
+        rm_rf(packager.scriptdir)
+    finally:
+        os.chdir(currdir)
+
+
+def summarize(runs):
+    runs = sorted(runs)
+    return {
+        'runs': runs,
+        'min': runs[0],
+        'median': runs[len(runs) // 2],
+        'max': runs[-1],
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=here).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(old, new):
+    for profile, stages in sorted(new['results'].items()):
+        for stage in STAGES:
+            if stage not in stages or stage not in old['results'].get(profile, {}):
+                continue
+            before = old['results'][profile][stage]['median']
+            after = stages[stage]['median']
+            ratio = after / before if before else float('inf')
+            print '%-12s %-15s %10.4fs -> %10.4fs  x%.2f' % (profile, stage, before, after, ratio)
+
+
+def main(args=sys.argv[1:]):
+    parser = argparse.ArgumentParser(description='Benchmark the empkg packaging pipeline')
+    parser.add_argument('--profile', action='append', choices=sorted(PROFILES))
+    parser.add_argument('--scale', type=float, default=1.0, help='multiply file counts by this factor')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--out')
+    parser.add_argument('--compare')
+    parser.add_argument('--keep', action='store_true', help='keep the generated work directory')
+    pargs = parser.parse_args(args)
+
+    report = {
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'time': time.time(),
+        'repeat': pargs.repeat,
+        'scale': pargs.scale,
+        'profiles': {},
+        'results': {},
+    }
+    for name in pargs.profile or sorted(PROFILES):
+        params = dict(PROFILES[name])
+        for key in ('files', 'local', 'templates'):
+            params[key] = max(1, int(params[key] * pargs.scale))
+        report['profiles'][name] = params
+
+        workdir = tempfile.mkdtemp(prefix='empkg-bench-')
+        try:
+            pkgbuild, served = generate(workdir, name, params, pargs.seed)
+            server, mirror = serve(served)
+            try:
+                results = {}
+                for _ in range(pargs.repeat):
+                    run_once(pkgbuild, mirror, results)
+            finally:
+                server.shutdown()
+            report['results'][name] = dict((stage, summarize(runs)) for stage, runs in results.items())
+        finally:
+            if pargs.keep:
+                print 'Work directory kept at %s' % workdir
+            else:
+                shutil.rmtree(workdir)
+
+        for stage in STAGES:
+            if stage in report['results'][name]:
+                print '%-12s %-15s median %.4fs' % (name, stage, report['results'][name][stage]['median'])
+
+    if pargs.out:
+        with open(pargs.out, 'w') as fd:
+            json.dump(report, fd, indent=2, sort_keys=True)
+
+    if pargs.compare:
+        with open(pargs.compare) as fd:
+            compare(json.load(fd), report)
+
+
+if __name__ == '__main__':
+    main()
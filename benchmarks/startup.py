@@ -0,0 +1,69 @@
+#! /usr/bin/env python
+"""
+Import time budget for the empkg CLI
+
+Imports empkg.__main__ in fresh interpreters, reports the median wall time
+and fails when it is over --budget or when modules that should be lazy
+(Fabric, paramiko, jinja2) were loaded.
+
+    python benchmarks/startup.py --budget 0.15
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+here = os.path.abspath(os.path.dirname(__file__))
+
+# Only needed by remote builds or template rendering
+LAZY_MODULES = ('fabric', 'paramiko', 'cryptography', 'jinja2')
+
+PROBE = '''
+import json, sys, time
+start = time.time()
+import empkg.__main__
+elapsed = time.time() - start
+print json.dumps({
+    'elapsed': elapsed,
+    'modules': sorted(set(name.split('.')[0] for name in sys.modules)),
+})
+'''
+
+
+def probe(python):
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(filter(None, [os.path.dirname(here), env.get('PYTHONPATH')]))
+    # -B keeps bytecode writes out of the measurement
+    out = subprocess.check_output([python, '-B', '-c', PROBE], env=env)
+    return json.loads(out)
+
+
+def main(args=sys.argv[1:]):
+    parser = argparse.ArgumentParser(description='Measure empkg CLI import time')
+    parser.add_argument('--repeat', type=int, default=10)
+    parser.add_argument('--budget', type=float, help='maximum median import time in seconds')
+    parser.add_argument('--python', default=sys.executable)
+    parser.add_argument('--out')
+    pargs = parser.parse_args(args)
+
+    runs = [probe(pargs.python) for _ in range(pargs.repeat)]
+    times = sorted(run['elapsed'] for run in runs)
+    median = times[len(times) // 2]
+    loaded = sorted(set(name for run in runs for name in run['modules'] if name in LAZY_MODULES))
+
+    print 'import empkg.__main__: median %.4fs min %.4fs max %.4fs' % (median, times[0], times[-1])
+    if loaded:
+        print 'Eagerly loaded: %s' % ', '.join(loaded)
+
+    if pargs.out:
+        with open(pargs.out, 'w') as fd:
+            json.dump({'runs': times, 'median': median, 'eager': loaded}, fd, indent=2, sort_keys=True)
+
+    if loaded or (pargs.budget is not None and median > pargs.budget):
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
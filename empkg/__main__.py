@@ -1,26 +1,12 @@
 import argparse
 import logging
 import os
-import re
 import sys
-from copy import copy
-
-import yaml
-from fabric.api import (
-    cd,
-    env,
-    execute,
-    get,
-    put,
-    run,
-    sudo,
-)
-from fabric.contrib.files import exists
+import time
 
 from .__init__ import __description__ as description
-from .constants import BASE_CONFIG
 from .packagers import BasePackager
-from .util import rm_rf, get_pkgman_class, get_pkgman
+from .util import default_job, load_pkgbuild, rm_rf_async
 
 logging.basicConfig(level=logging.INFO)
 
@@ -29,123 +15,342 @@ EXIT_FAIL = 1
 
 
 def main(args=sys.argv[1:]):
+    if args and args[0] in COMMANDS:
+        return COMMANDS[args[0]](args[1:])
+    return build(args)
+
+
+def build_parser():
     parser = argparse.ArgumentParser(description=description)
     parser.add_argument('pkgbuild')
     parser.add_argument('--target')  # remote build target
+    parser.add_argument('--pool')  # builder inventory, build on the least loaded compatible host
     parser.add_argument('--pkgman', action='store_true')  # remote build target
     parser.add_argument('--makepkgman', action='store_true')  # remote build target
     parser.add_argument('--clean', action='store_true')
-    parser.add_argument('--dev', action='store_true')  # TODO dev removes checksum check (when I implement the check)
-    pargs = parser.parse_args(args)
+    parser.add_argument('--reuse', action='store_true')  # keep srcdir from the previous build
+    parser.add_argument('--offline', action='store_true')  # no network access, use cached sources and values
+    parser.add_argument('--dev', action='store_true')  # skip source integrity checks
+    parser.add_argument('--socket', nargs='?', const='')  # hand the build to a running `empkg serve`
+    parser.add_argument('--repo')  # publish the built package to this local repository
+    parser.add_argument('--stage-cache')  # share stage outputs through this cache server
+    parser.add_argument('--reproducible', action='store_true')
+    parser.add_argument('--workspace')  # build in tmpfs or this scratch directory
+    parser.add_argument('--verify-reproducible', action='store_true')  # build twice, fail if the packages differ
+    return parser
+
 
-    conf = copy(BASE_CONFIG)
-    with open(os.path.expanduser(pargs.pkgbuild)) as fd:
-        conf.update(yaml.safe_load(fd))
+def build(args):
+    pargs = build_parser().parse_args(args)
+
+    if pargs.socket is not None:
+        from .server import default_socket, submit
+        return submit(pargs.socket or default_socket(), pargs.pkgbuild, without_option(args, '--socket', pargs.socket))
+
+    conf = load_pkgbuild(os.path.expanduser(pargs.pkgbuild))
+    if pargs.reuse:
+        conf['reuse_workspace'] = True
+    if pargs.offline:
+        conf['offline'] = True
+    if pargs.dev:
+        conf['skipinteg'] = True
+    if pargs.stage_cache:
+        conf['stage_cache'] = pargs.stage_cache
+    if pargs.reproducible or pargs.verify_reproducible:
+        conf['reproducible'] = True
+    if pargs.workspace:
+        conf['workspace'] = pargs.workspace
 
     if pargs.clean:
-        rm_rf(conf['srcdir'])
-        rm_rf(conf['pkgdir'])
-        rm_rf(conf['scriptdir'])
-        rm_rf(conf['hookdir'])
+        rm_rf_async(conf['srcdir'])
+        rm_rf_async(conf['pkgdir'])
+        rm_rf_async(conf['scriptdir'])
         return None
 
-    if pargs.target:
+    if pargs.target or pargs.pool:
+        # Only remote builds need the SSH stack
+        from fabric.api import env, execute
+        from .remote import BuildFailed, load_inventory, pool_package, remote_package
+
         # TODO deploy keys
         env.use_ssh_config = True
-        env.hosts = [pargs.target, ]
-
-        # Remove target
-        new_args = []
-        skip = False
-        for arg in args:
-            if skip:
-                skip = False
-                continue
-            if arg == '--target':
-                skip = True
-                continue
-
-            new_args.append(arg)
-            skip = False
 
-        execute(remote_package, new_args, conf)
+        remote_args = args
+        for option in ('--target', '--pool', '--repo'):
+            remote_args = without_option(remote_args, option, getattr(pargs, option[2:]))
+        if pargs.pool:
+            try:
+                artifacts = pool_package(remote_args, conf, load_inventory(pargs.pool))
+            except BuildFailed as exc:
+                return str(exc)
+        else:
+            env.hosts = [pargs.target, ]
+            artifacts = [artifact for paths in execute(remote_package, remote_args, conf).values() for artifact in paths]
+    elif pargs.verify_reproducible:
+        err, artifacts = verify_reproducible(conf)
+        if err:
+            return err
     else:
         packager = BasePackager(conf)
         packager.run()
+        artifacts = packager.artifacts
+
+    if pargs.repo:
+        from .repo import Repository
+        Repository(pargs.repo).add(artifacts)
+
+    return None
+
+
+def verify_reproducible(conf, job=None):
+    """Build twice from scratch, returns (error if the packages differ, packages)"""
+    import shutil
+    import tempfile
+    from .fingerprint import hash_file
+
+    # The caches would hand the first build's packages back, and the builds don't publish deltas
+    conf = dict(conf, reuse_workspace=False, stage_cache=None, artifact_store=None, delta=False)
+    if job is None:
+        job = default_job
+    first = tempfile.mkdtemp(prefix='empkg-verify-')
+    try:
+        packager = BasePackager(dict(conf), job=job)
+        packager.run()
+        digests = {}
+        for artifact in packager.artifacts:
+            digests[os.path.basename(artifact)] = hash_file(artifact)
+            shutil.copy2(artifact, first)
+
+        packager = BasePackager(dict(conf), job=job)
+        packager.run()
+        differ = []
+        for artifact in packager.artifacts:
+            name = os.path.basename(artifact)
+            if digests.pop(name, None) != hash_file(artifact):
+                differ.append(name)
+                if os.path.exists(os.path.join(first, name)):
+                    shutil.copy2(os.path.join(first, name), artifact + '.first')
+        differ.extend(digests)
+    finally:
+        shutil.rmtree(first)
+    if differ:
+        return 'Not reproducible: %s (first build kept as .first)' % ', '.join(sorted(differ)), packager.artifacts
+    job.output('Reproducible: %d packages identical over two builds' % len(packager.artifacts))
+    return None, packager.artifacts
+
+
+def without_option(args, option, value):
+    """Remove option and its value from args"""
+    new_args = []
+    skip = False
+    for arg in args:
+        if skip:
+            skip = False
+            continue
+        if arg == option:
+            # Options with an optional value only consume the next arg when it was used
+            skip = value is not None and value != ''
+            continue
+        if arg == '%s=%s' % (option, value):
+            continue
+
+        new_args.append(arg)
+    return new_args
+
+
+def delta(args):
+    from .delta import apply_delta, make_delta, read_header
+
+    parser = argparse.ArgumentParser(prog='empkg delta', description='Binary deltas between packages')
+    subparsers = parser.add_subparsers(dest='action')
+    make = subparsers.add_parser('make', help='write the delta from old to new')
+    make.add_argument('old')
+    make.add_argument('new')
+    make.add_argument('-o', '--output')
+    apply_ = subparsers.add_parser('apply', help='rebuild the new package from old and a delta')
+    apply_.add_argument('old')
+    apply_.add_argument('delta')
+    apply_.add_argument('-o', '--output')
+    pargs = parser.parse_args(args)
 
+    if pargs.action == 'make':
+        output = pargs.output or pargs.new + '.delta'
+        print '%s: %d bytes' % (output, make_delta(pargs.old, pargs.new, output))
+    else:
+        output = pargs.output or read_header(pargs.delta)['new']['filename']
+        print apply_delta(pargs.old, pargs.delta, output)
     return None
 
 
-def remote_package(args, conf):
-    remote_install(args)
-
-    remotedir = '/tmp/%s' % conf['pkgname']
-    run('rm -rf %s' % remotedir)
-    run('mkdir -p %s' % remotedir)
-    put(local_path='*', remote_path=remotedir)
-    with cd(remotedir):
-        out = run('empkg %s' % ' '.join(args))
-        pattern = re.compile(r':path=>"(.*?)"')
-        match = pattern.search(out)
-        pkgname = match.groups()[0]
-        get(remote_path=os.path.join(remotedir, conf['pkgdir'], pkgname), local_path='.')
-
-
-def remote_install(args):
-    distro = remote_linux_dist()
-    depends = ()
-    if distro == 'arch':
-        # TODO if yaourt available use to install fpm?
-        # TODO arch depends
-        depends = ()
-    elif distro in ('debian', 'ubuntu'):
-        depends = (
-            'build-essential',
-            'openssl',
-            'libssl-dev',
-            'ruby',  # fpm
-            'ruby-dev',  # fpm
-            'python-pip',
-            'libyaml-dev',  # PyYAML
-            'python-dev',  # PyYAML
-        )
-    elif distro == 'centos':
-        depends = (
-            'gcc',
-            'gcc-c++',
-            'kernel-devel',
-            'openssl',
-            'openssl-devel',
-            'ruby',
-            'ruby-devel',
-            'rubygems',
-            'rpm',
-            'rpm-build',
-            'python-devel',
-            'python-pip',
-        )
-    pkgman = get_pkgman_class(get_pkgman(distro))
-    sudo(pkgman.install_cmd % ' '.join(depends))
-
-    # TODO try to update fpm?
-    out = run('gem list')
-    pattern = re.compile(r'^fpm ', re.MULTILINE)
-    if not re.search(pattern, out):
-        sudo('gem install fpm')
-
-    # TODO dev/prod mode switch
-    if any(('--dev' == arg for arg in args)):
-        sudo('pip install -U --force-reinstall --no-deps empkg')
+def repo(args):
+    from .repo import Repository
+
+    parser = argparse.ArgumentParser(prog='empkg repo', description='Manage a local package repository')
+    parser.add_argument('path')
+    parser.add_argument('--keep', type=int)  # versions of each apt/yum package kept, all by default
+    subparsers = parser.add_subparsers(dest='action')
+    add = subparsers.add_parser('add', help='copy packages into the repository')
+    add.add_argument('packages', nargs='+')
+    remove = subparsers.add_parser('remove', help='remove packages by file or package name')
+    remove.add_argument('packages', nargs='+')
+    subparsers.add_parser('update', help='index packages added or deleted by hand')
+    pargs = parser.parse_args(args)
+
+    repository = Repository(pargs.path, keep=pargs.keep)
+    if pargs.action == 'add':
+        repository.add(pargs.packages)
+    elif pargs.action == 'remove':
+        repository.remove(pargs.packages)
     else:
-        sudo('pip install -U empkg')
+        repository.update()
+    return None
+
+
+def serve(args):
+    from .server import default_socket, serve as run_server
+
+    parser = argparse.ArgumentParser(prog='empkg serve', description='Run a build daemon on a unix socket')
+    parser.add_argument('--socket', default=default_socket())
+    parser.add_argument('--workers', type=int, default=cpu_count())
+    pargs = parser.parse_args(args)
+    # Only builds are run by the daemon, the other commands are cheap to start
+    run_server(pargs.socket, pargs.workers, {'build': build})
+    return None
+
+
+def fetch(args):
+    from multiprocessing.pool import ThreadPool
+    from .sources import fetch as fetch_source, integrity, is_local, location
+
+    parser = argparse.ArgumentParser(prog='empkg fetch', description='Download sources into the source cache')
+    parser.add_argument('pkgbuilds', nargs='+')
+    parser.add_argument('--jobs', type=int, default=8)
+    pargs = parser.parse_args(args)
+
+    downloads = {}
+    for pkgbuild in pargs.pkgbuilds:
+        path = os.path.abspath(os.path.expanduser(pkgbuild))
+        conf = load_pkgbuild(path)
+        # Like api.load, sources are rendered against the PKGBUILD's directory
+        conf['startdir'] = os.path.dirname(path)
+        BasePackager(conf).apply_context()
+        hashname, sums = integrity(conf)
+        for i, source in enumerate(conf['source']):
+            source = location(source)
+            if not is_local(source):
+                download = (source, sums[i] if sums else None, hashname)
+                downloads[repr(download)] = download
+
+    def fetch_one(download):
+        try:
+            print 'Fetched %s' % fetch_source(*download)
+        except Exception as exc:
+            return '%s: %s' % (download[0], exc)
+
+    pool = ThreadPool(max(1, min(pargs.jobs, len(downloads))))
+    try:
+        errors = [err for err in pool.map(fetch_one, downloads.values()) if err]
+    finally:
+        pool.close()
+        pool.join()
+    if errors:
+        return 'Could not fetch %d sources:\n%s' % (len(errors), '\n'.join(errors))
+    return None
+
+
+def cache_server(args):
+    from .stagecache import serve as run_server
+    from .util import cache_dir
+
+    parser = argparse.ArgumentParser(prog='empkg cache-server', description='Serve a shared stage cache over HTTP')
+    parser.add_argument('--bind', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--root')  # where blobs and manifests are kept, defaults to the user cache
+    pargs = parser.parse_args(args)
+    run_server(pargs.bind, pargs.port, pargs.root or cache_dir('stage-server'))
+    return None
+
+
+def stats(args):
+    from . import metrics
+
+    parser = argparse.ArgumentParser(prog='empkg stats', description='Report the recorded build metrics')
+    parser.add_argument('pkgnames', nargs='*')  # only these packages, by pkgname or pkgbase
+    parser.add_argument('--days', type=float)  # only the builds of the last days
+    parser.add_argument('--db')  # metrics database, defaults to the user cache
+    parser.add_argument('--prometheus')  # write a Prometheus textfile here instead of the report
+    pargs = parser.parse_args(args)
+
+    since = metrics.days_ago(pargs.days)
+    db = metrics.connect(pargs.db)
+    try:
+        if pargs.prometheus:
+            metrics.write_textfile(pargs.prometheus, metrics.prometheus(db, pargs.pkgnames, since))
+        else:
+            print metrics.report(db, pargs.pkgnames, since)
+    finally:
+        db.close()
+    return None
+
+
+def store(args):
+    from .artifacts import ArtifactStore
+    from .util import cache_dir
+
+    parser = argparse.ArgumentParser(prog='empkg store', description='Manage the artifact store')
+    parser.add_argument('--root')  # store directory, defaults to the user cache
+    subparsers = parser.add_subparsers(dest='action')
+    list_parser = subparsers.add_parser('list', help='list stored packages, newest first')
+    list_parser.add_argument('pkgname', nargs='?')
+    add = subparsers.add_parser('add', help='store packages')
+    add.add_argument('packages', nargs='+')
+    get = subparsers.add_parser('get', help='write a stored package out by digest or filename')
+    get.add_argument('package')
+    get.add_argument('--output', '-o', default='.')
+    prune = subparsers.add_parser('prune', help='evict packages')
+    prune.add_argument('--keep', type=int)  # packages kept per pkgname
+    prune.add_argument('--max-bytes', type=int)  # least recently used packages are evicted past this
+    pargs = parser.parse_args(args)
+
+    artifacts = ArtifactStore(pargs.root or cache_dir('store'))
+    if pargs.action == 'list':
+        for row in artifacts.find(pkgname=pargs.pkgname):
+            print '%s  %-48s %12d  %s' % (row['digest'][:12], row['filename'], row['size'],
+                                          time.strftime('%Y-%m-%d %H:%M', time.localtime(row['stored'])))
+        packages, size, stored = artifacts.usage()
+        print '%d packages, %d bytes stored for %d bytes of packages' % (packages, stored, size)
+    elif pargs.action == 'add':
+        for package in pargs.packages:
+            print '%s %s' % (artifacts.add(package), package)
+    elif pargs.action == 'get':
+        matches = [row for row in artifacts.find()
+                   if row['digest'].startswith(pargs.package) or row['filename'] == pargs.package]
+        if not matches:
+            return 'No stored package %s' % pargs.package
+        print artifacts.get(matches[0]['digest'], pargs.output)
+    else:
+        for filename in artifacts.prune(keep=pargs.keep, max_bytes=pargs.max_bytes):
+            print 'Evicted %s' % filename
+    return None
+
+
+def cpu_count():
+    from multiprocessing import cpu_count
+    try:
+        return cpu_count()
+    except NotImplementedError:
+        return 1
 
 
-def remote_linux_dist():
-    out = eval(run('python -c "import platform; print(platform.linux_distribution())"', shell=True))
-    if not out[0]:
-        if exists('/etc/arch-release'):
-            return 'arch'
-    return out[0].lower()
+COMMANDS = {
+    'cache-server': cache_server,
+    'delta': delta,
+    'fetch': fetch,
+    'repo': repo,
+    'serve': serve,
+    'stats': stats,
+    'store': store,
+}
 
 
 if __name__ == '__main__':
@@ -0,0 +1,173 @@
+"""
+Programmatic builds
+For build orchestrators: builds run in threads of the calling process, as
+many at a time as wanted, instead of one `empkg` process each. Every build
+has its own Job so its output and progress come back as events rather than
+being printed, and it can be cancelled or given a timeout.
+
+    build = start_build('foo/PKGBUILD.yml', timeout=3600, offline=True)
+    for event in build.events():
+        if event['event'] == 'log':
+            print event['line']
+    result = build.wait()
+    print result.status, result.artifacts
+
+Events are dicts with an 'event' key:
+    stage     pkgname, stage   a stage starts
+    log       line             a line of output
+    artifact  pkgname, path    a package was written
+    finished  result           the build is over, always the last one
+
+Cancelling kills the running script and its children, Python stages stop at
+the next stage.
+"""
+import os
+import threading
+import time
+import traceback
+from Queue import Queue
+
+from .constants import BASE_CONFIG
+from .packagers import BasePackager
+from .util import BuildCancelled, Job, load_pkgbuild, make_conf
+
+OK = 'ok'
+FAILED = 'failed'
+CANCELLED = 'cancelled'
+TIMEOUT = 'timeout'
+
+
+class BuildResult(object):
+    def __init__(self, pkgbase, status, artifacts, error, log, started, finished):
+        self.pkgbase = pkgbase
+        # One of OK, FAILED, CANCELLED and TIMEOUT
+        self.status = status
+        self.artifacts = artifacts
+        self.error = error
+        # Output lines of the build
+        self.log = log
+        self.started = started
+        self.finished = finished
+
+    @property
+    def ok(self):
+        return self.status == OK
+
+    @property
+    def duration(self):
+        return self.finished - self.started
+
+    def __repr__(self):
+        return '<BuildResult %s %s %.1fs>' % (self.pkgbase, self.status, self.duration)
+
+
+class Build(object):
+    """A build running in a thread, see start_build"""
+    def __init__(self, conf, timeout=None, listener=None):
+        self.conf = conf
+        self.timeout = timeout
+        self.listener = listener
+        self.log = []
+        self.queue = Queue()
+        self.result = None
+        self.timed_out = False
+        self.done = threading.Event()
+        self.job = Job(log=self.on_log, listener=self.on_event)
+        self.thread = threading.Thread(target=self.run, name='empkg-%s' % conf['pkgbase'])
+        self.thread.daemon = True
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def on_log(self, line):
+        self.log.append(line)
+        self.on_event('log', {'line': line})
+
+    def on_event(self, event, data):
+        data = dict(data, event=event)
+        self.queue.put(data)
+        if self.listener is not None:
+            self.listener(data)
+
+    def expire(self):
+        self.timed_out = True
+        self.job.cancel('Timed out after %ss' % self.timeout)
+
+    def run(self):
+        started = time.time()
+        timer = None
+        if self.timeout is not None:
+            timer = threading.Timer(self.timeout, self.expire)
+            timer.daemon = True
+            timer.start()
+        status, error, artifacts = OK, None, []
+        try:
+            packager = BasePackager(self.conf, job=self.job)
+            try:
+                packager.run()
+            finally:
+                artifacts = packager.artifacts
+        except Exception as exc:
+            if isinstance(exc, BuildCancelled) or self.job.cancelled.is_set():
+                status = TIMEOUT if self.timed_out else CANCELLED
+                error = self.job.reason or str(exc)
+            else:
+                status, error = FAILED, str(exc) or exc.__class__.__name__
+                for line in traceback.format_exc().splitlines():
+                    self.on_log(line)
+        finally:
+            if timer is not None:
+                timer.cancel()
+        self.result = BuildResult(self.conf['pkgbase'], status, artifacts, error, self.log, started, time.time())
+        self.done.set()
+        self.on_event('finished', {'result': self.result})
+
+    def events(self):
+        """Events of the build as they come, until it finished"""
+        while True:
+            event = self.queue.get()
+            yield event
+            if event['event'] == 'finished':
+                return
+
+    def cancel(self):
+        self.job.cancel('Cancelled')
+
+    def wait(self, timeout=None):
+        """BuildResult once the build is over, None if it still runs after timeout seconds"""
+        self.done.wait(timeout)
+        return self.result
+
+
+def load(config, settings):
+    """Configuration from a PKGBUILD path or a dict of PKGBUILD values, with settings on top"""
+    if isinstance(config, basestring):
+        path = os.path.abspath(os.path.expanduser(config))
+        conf = load_pkgbuild(path)
+        # Not the current directory, several builds share it
+        conf['startdir'] = os.path.dirname(path)
+    else:
+        conf = make_conf(config)
+    unknown = sorted(set(settings) - set(BASE_CONFIG))
+    if unknown:
+        raise ValueError('Unknown settings: %s' % ', '.join(unknown))
+    conf.update(settings)
+    if 'pkgname' in settings and 'pkgbase' not in settings:
+        conf = make_conf(dict(conf, pkgbase=None))
+    return conf
+
+
+def start_build(config, timeout=None, listener=None, **settings):
+    """Start building config, returns its Build
+
+    config is the path of a PKGBUILD or a dict of its values (with startdir,
+    the current directory by default). settings override the PKGBUILD ones.
+    listener is called with each event from the build thread.
+    """
+    return Build(load(config, settings), timeout=timeout, listener=listener).start()
+
+
+def build(config, timeout=None, listener=None, **settings):
+    """Build config and wait for it, returns its BuildResult"""
+    return start_build(config, timeout=timeout, listener=listener, **settings).wait()
@@ -0,0 +1,314 @@
+"""
+Artifact store
+Built packages kept by content: an SQLite index of the packages (digest,
+filename, pkgname, pkgver, pkgrel, arch, build key) over deduplicated, zlib
+compressed chunks stored once however many packages share them.
+
+Chunk boundaries are content defined so versions of a package share the
+chunks of what didn't change even when data moved: a chunk starts at a tar
+or cpio member header once it is MIN_CHUNK long, and large members are cut
+every MAX_CHUNK bytes from their header. This pays off on uncompressed
+payloads, compressed ones only dedupe whole.
+
+Builds find their packages by build key (the stage cache package key) and
+skip packaging, delta finds the previous version here and remote builds
+don't download packages the store already has. Retention keeps the last N
+packages of each pkgname and/or evicts the least recently used packages
+past a size.
+"""
+import errno
+import hashlib
+import os
+import re
+import sqlite3
+import tempfile
+import time
+import zlib
+
+from .repo import package_type
+from .util import cache_dir, file_digest
+
+# What a broken store can raise, a build goes on without it
+STORE_ERRORS = (sqlite3.Error, EnvironmentError, zlib.error)
+MIN_CHUNK = 64 * 1024
+MAX_CHUNK = 1024 * 1024
+READ_SIZE = 4 * MAX_CHUNK
+# ustar magic is 257 bytes into a tar header, cpio newc headers start with theirs
+MEMBER_HEADERS = re.compile(r'ustar|07070[12]')
+USTAR_OFFSET = 257
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS artifacts (
+    digest TEXT PRIMARY KEY,
+    filename TEXT NOT NULL,
+    pkgname TEXT,
+    pkgver TEXT,
+    pkgrel TEXT,
+    arch TEXT,
+    pkgtype TEXT,
+    key TEXT,
+    size INTEGER NOT NULL,
+    stored REAL NOT NULL,
+    accessed REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS parts (
+    artifact TEXT NOT NULL REFERENCES artifacts(digest),
+    seq INTEGER NOT NULL,
+    chunk TEXT NOT NULL REFERENCES chunks(digest),
+    PRIMARY KEY (artifact, seq)
+);
+CREATE TABLE IF NOT EXISTS chunks (
+    digest TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    refs INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS artifacts_pkgname ON artifacts(pkgname, pkgver, pkgrel, arch);
+CREATE INDEX IF NOT EXISTS artifacts_key ON artifacts(key);
+CREATE INDEX IF NOT EXISTS parts_chunk ON parts(chunk);
+'''
+FIELDS = ('digest', 'filename', 'pkgname', 'pkgver', 'pkgrel', 'arch', 'pkgtype', 'key', 'size', 'stored', 'accessed')
+INSERT = 'INSERT INTO artifacts (%s) VALUES (%s)' % (', '.join(FIELDS), ', '.join('?' * len(FIELDS)))
+
+
+def boundaries(data):
+    """Cut points in data, which starts a chunk"""
+    cuts = []
+    last = 0
+    for match in MEMBER_HEADERS.finditer(data, MIN_CHUNK):
+        cut = match.start() - USTAR_OFFSET if match.group() == 'ustar' else match.start()
+        while cut - last > MAX_CHUNK:
+            last += MAX_CHUNK
+            cuts.append(last)
+        if cut - last >= MIN_CHUNK:
+            cuts.append(cut)
+            last = cut
+    return cuts
+
+
+def chunks(path):
+    """Yield the chunks of the file at path, read READ_SIZE bytes at a time
+
+    Cut at the boundaries() found in what was read so far, so members longer
+    than MAX_CHUNK may be cut at other offsets than boundaries() over the
+    whole file would give. The same file always gives the same chunks.
+    """
+    with open(path, 'rb') as fd:
+        buf = ''
+        while True:
+            data = fd.read(READ_SIZE)
+            buf += data
+            last = 0
+            for cut in boundaries(buf):
+                yield buf[last:cut]
+                last = cut
+            # Past the last header only cut where a header straddling the end of buf can't cut first
+            tail = MAX_CHUNK + 512 if data else MAX_CHUNK
+            while len(buf) - last > tail:
+                yield buf[last:last + MAX_CHUNK]
+                last += MAX_CHUNK
+            buf = buf[last:]
+            if not data:
+                break
+        if buf:
+            yield buf
+
+
+class ArtifactStore(object):
+    def __init__(self, root):
+        self.root = os.path.abspath(root)
+        if not os.path.isdir(os.path.join(self.root, 'chunks')):
+            os.makedirs(os.path.join(self.root, 'chunks'))
+        db = self.connect()
+        try:
+            db.executescript(SCHEMA)
+        finally:
+            db.close()
+
+    def connect(self):
+        # A connection per call, split packages use the store from several threads
+        db = sqlite3.connect(os.path.join(self.root, 'index.sqlite'), timeout=60, isolation_level=None)
+        db.row_factory = sqlite3.Row
+        return db
+
+    def chunk_path(self, digest):
+        return os.path.join(self.root, 'chunks', digest[:2], digest)
+
+    def write_chunk(self, digest, data):
+        """Store a chunk unless it is there, returns its stored size"""
+        path = self.chunk_path(digest)
+        if os.path.exists(path):
+            return os.path.getsize(path)
+        if not os.path.isdir(os.path.dirname(path)):
+            try:
+                os.makedirs(os.path.dirname(path))
+            except OSError:
+                pass
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path))
+        with os.fdopen(fd, 'wb') as out:
+            out.write(zlib.compress(data, 1))
+        os.rename(tmp, path)
+        return os.path.getsize(path)
+
+    def has(self, digest):
+        db = self.connect()
+        try:
+            return db.execute('SELECT 1 FROM artifacts WHERE digest = ?', (digest, )).fetchone() is not None
+        finally:
+            db.close()
+
+    def add(self, path, pkgname=None, pkgver=None, pkgrel=None, arch=None, key=None):
+        """Store the package at path, returns its digest"""
+        digest = file_digest(path)
+        now = time.time()
+        db = self.connect()
+        try:
+            # Writers are serialized so pruning never drops a chunk being referenced
+            db.execute('BEGIN IMMEDIATE')
+            try:
+                if db.execute('SELECT 1 FROM artifacts WHERE digest = ?', (digest, )).fetchone() is not None:
+                    db.execute('UPDATE artifacts SET key = COALESCE(?, key), accessed = ? WHERE digest = ?',
+                               (key, now, digest))
+                else:
+                    db.execute(INSERT, (
+                        digest, os.path.basename(path), pkgname, pkgver and str(pkgver), pkgrel and str(pkgrel),
+                        arch, package_type(path), key, os.path.getsize(path), now, now))
+                    for seq, data in enumerate(chunks(path)):
+                        chunk = hashlib.sha256(data).hexdigest()
+                        size = self.write_chunk(chunk, data)
+                        db.execute('INSERT OR IGNORE INTO chunks (digest, size, refs) VALUES (?, ?, 0)', (chunk, size))
+                        db.execute('UPDATE chunks SET refs = refs + 1 WHERE digest = ?', (chunk, ))
+                        db.execute('INSERT INTO parts (artifact, seq, chunk) VALUES (?, ?, ?)', (digest, seq, chunk))
+                db.execute('COMMIT')
+            except BaseException:
+                db.execute('ROLLBACK')
+                raise
+        finally:
+            db.close()
+        return digest
+
+    def find(self, pkgname=None, pkgver=None, pkgrel=None, arch=None, pkgtype=None, key=None):
+        """Stored packages matching the given fields, newest first"""
+        where = [('pkgname', pkgname), ('pkgver', pkgver), ('pkgrel', pkgrel), ('arch', arch), ('pkgtype', pkgtype),
+                 ('key', key)]
+        where = [(field, str(value)) for field, value in where if value is not None]
+        db = self.connect()
+        try:
+            rows = db.execute('SELECT * FROM artifacts %s ORDER BY stored DESC' % (
+                'WHERE ' + ' AND '.join('%s = ?' % field for field, _ in where) if where else ''),
+                [value for _, value in where]).fetchall()
+        finally:
+            db.close()
+        return [dict(row) for row in rows]
+
+    def get(self, digest, destination):
+        """Rebuild a stored package at destination (a file or a directory), returns its path"""
+        db = self.connect()
+        try:
+            row = db.execute('SELECT filename FROM artifacts WHERE digest = ?', (digest, )).fetchone()
+            if row is None:
+                raise IOError(errno.ENOENT, 'Not in the artifact store', digest)
+            parts = [chunk for chunk, in db.execute(
+                'SELECT chunk FROM parts WHERE artifact = ? ORDER BY seq', (digest, ))]
+            db.execute('UPDATE artifacts SET accessed = ? WHERE digest = ?', (time.time(), digest))
+        finally:
+            db.close()
+        path = os.path.join(destination, row['filename']) if os.path.isdir(destination) else destination
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)))
+        try:
+            hasher = hashlib.sha256()
+            with os.fdopen(fd, 'wb') as out:
+                for chunk in parts:
+                    with open(self.chunk_path(chunk), 'rb') as chunk_fd:
+                        data = zlib.decompress(chunk_fd.read())
+                    hasher.update(data)
+                    out.write(data)
+            if hasher.hexdigest() != digest:
+                raise IOError(errno.EIO, 'Corrupt in the artifact store', row['filename'])
+            os.chmod(tmp, 0644)
+            os.rename(tmp, path)
+        finally:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+        return path
+
+    def remove(self, digests, db):
+        """Drop packages in the caller's transaction, returns the chunks only they used"""
+        for digest in digests:
+            for chunk, in db.execute('SELECT chunk FROM parts WHERE artifact = ?', (digest, )).fetchall():
+                db.execute('UPDATE chunks SET refs = refs - 1 WHERE digest = ?', (chunk, ))
+            db.execute('DELETE FROM parts WHERE artifact = ?', (digest, ))
+            db.execute('DELETE FROM artifacts WHERE digest = ?', (digest, ))
+        unused = [chunk for chunk, in db.execute('SELECT digest FROM chunks WHERE refs <= 0').fetchall()]
+        db.execute('DELETE FROM chunks WHERE refs <= 0')
+        return unused
+
+    def prune(self, keep=None, max_bytes=None):
+        """Keep the last keep packages of each pkgname, then evict the least recently used past max_bytes
+
+        Returns the filenames of the packages removed
+        """
+        db = self.connect()
+        try:
+            db.execute('BEGIN IMMEDIATE')
+            try:
+                removed = []
+                unused = []
+                if keep is not None:
+                    seen = {}
+                    for row in db.execute('SELECT digest, filename, pkgname, pkgtype FROM artifacts '
+                                          'ORDER BY stored DESC').fetchall():
+                        group = (row['pkgname'] or row['filename'], row['pkgtype'])
+                        seen[group] = seen.get(group, 0) + 1
+                        if seen[group] > keep:
+                            removed.append(row['filename'])
+                            unused.extend(self.remove([row['digest']], db))
+                if max_bytes is not None:
+                    for row in db.execute('SELECT digest, filename FROM artifacts ORDER BY accessed').fetchall():
+                        if db.execute('SELECT COALESCE(SUM(size), 0) FROM chunks').fetchone()[0] <= max_bytes:
+                            break
+                        removed.append(row['filename'])
+                        unused.extend(self.remove([row['digest']], db))
+                db.execute('COMMIT')
+            except BaseException:
+                db.execute('ROLLBACK')
+                raise
+            if unused:
+                self.unlink(unused, db)
+        finally:
+            db.close()
+        return removed
+
+    def unlink(self, digests, db):
+        """Delete the files of chunks the committed index dropped
+
+        Under the write lock so an add can't reference one of them in between, an
+        interrupted unlink only leaves files that a later add of the chunk reuses
+        """
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            for chunk in digests:
+                if db.execute('SELECT 1 FROM chunks WHERE digest = ?', (chunk, )).fetchone() is None:
+                    try:
+                        os.remove(self.chunk_path(chunk))
+                    except OSError:
+                        pass
+        finally:
+            db.execute('COMMIT')
+
+    def usage(self):
+        """(packages, bytes of the packages, bytes stored)"""
+        db = self.connect()
+        try:
+            packages, size = db.execute('SELECT COUNT(*), COALESCE(SUM(size), 0) FROM artifacts').fetchone()
+            stored = db.execute('SELECT COALESCE(SUM(size), 0) FROM chunks').fetchone()[0]
+        finally:
+            db.close()
+        return packages, size, stored
+
+
+def open_store(conf):
+    """The artifact store of conf, None when it has none"""
+    setting = conf['artifact_store']
+    if not setting:
+        return None
+    return ArtifactStore(cache_dir('store') if setting is True else os.path.expanduser(setting))
@@ -0,0 +1,124 @@
+"""
+Ephemeral build roots
+A build root is a copy-on-write snapshot of a prepared base root (e.g. a tree
+made with `unshare -r debootstrap`). Scripts and makedepends installs run in
+it through unshare(1), so no privileges are needed on kernels that allow
+unprivileged user namespaces. The base root should be owned by the building
+user.
+
+Snapshot methods, fastest first:
+    overlay   overlayfs mounted inside the build namespace, nothing is copied
+    reflink   cp --reflink=always, needs btrfs/xfs
+    hardlink  cp -al, only when asked for: the snapshot shares its files with
+              the base, a build writing to one in place modifies the base
+"""
+import os
+import pipes
+import subprocess
+import tempfile
+
+from .util import default_job, rm_rf
+
+METHODS = ('overlay', 'reflink', 'hardlink')
+# What auto tries, hardlink snapshots are not isolated from the base
+AUTO_METHODS = ('overlay', 'reflink')
+
+
+def quote(args):
+    return ' '.join(pipes.quote(arg) for arg in args)
+
+
+class BuildRoot(object):
+    def __init__(self, base, method='auto', binds=(), job=None):
+        self.base = os.path.abspath(base)
+        self.method = method
+        self.job = job if job is not None else default_job
+        # Host directories made visible at the same path inside the root
+        self.binds = []
+        for path in sorted(os.path.abspath(path) for path in binds):
+            if not any(path == bind or path.startswith(bind + os.sep) for bind in self.binds):
+                self.binds.append(path)
+        self.path = None
+
+    @property
+    def root(self):
+        if self.method == 'overlay':
+            return os.path.join(self.path, 'merged')
+        return os.path.join(self.path, 'root')
+
+    def __enter__(self):
+        self.create()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.destroy()
+
+    def create(self):
+        if not os.path.isdir(self.base):
+            raise ValueError('Build root base %s is not a directory' % self.base)
+        # Next to the base so reflinks and hardlinks stay on one filesystem
+        self.path = tempfile.mkdtemp(prefix='.empkg-root-', dir=os.path.dirname(self.base))
+
+        methods = AUTO_METHODS if self.method == 'auto' else (self.method, )
+        for method in methods:
+            self.method = method
+            if getattr(self, 'create_%s' % method)():
+                self.job.output('Build root %s (%s)' % (self.root, method))
+                return
+        self.destroy()
+        raise RuntimeError('Could not snapshot %s with %s' % (self.base, ', '.join(methods)))
+
+    def create_overlay(self):
+        for name in ('upper', 'work', 'merged'):
+            os.mkdir(os.path.join(self.path, name))
+        # Mounts only live in the build namespace, check the kernel allows them
+        return subprocess.call(self.wrap_setup(['true']), shell=True) == 0
+
+    def create_reflink(self):
+        return self.copy('--reflink=always')
+
+    def create_hardlink(self):
+        return self.copy('-l')
+
+    def copy(self, option):
+        ret = subprocess.call(['cp', '-a', option, self.base, self.root])
+        if ret:
+            rm_rf(self.root)
+        return ret == 0
+
+    def destroy(self):
+        if self.path is None:
+            return
+        # overlayfs leaves its work dir without permissions
+        subprocess.call(['chmod', '-R', 'u+rwX', self.path])
+        rm_rf(self.path)
+        self.path = None
+
+    def namespace_cmd(self):
+        cmd = ['unshare', '--mount', '--pid', '--fork']
+        if os.getuid() != 0:
+            cmd.append('--map-root-user')
+        return cmd
+
+    def wrap_setup(self, cmd):
+        root = self.root
+        setup = []
+        if self.method == 'overlay':
+            options = 'lowerdir=%s,upperdir=%s,workdir=%s' % (
+                self.base, os.path.join(self.path, 'upper'), os.path.join(self.path, 'work'))
+            setup.append(quote(['mount', '-t', 'overlay', 'overlay', '-o', options, root]))
+        for path in ('/dev', ) + tuple(self.binds):
+            target = root + path
+            setup.append(quote(['mkdir', '-p', target]))
+            setup.append(quote(['mount', '--rbind', path, target]))
+        setup.append(quote(['mkdir', '-p', root + '/proc']))
+        setup.append(quote(['mount', '-t', 'proc', 'proc', root + '/proc']))
+        if os.path.isfile('/etc/resolv.conf') and os.path.isfile(root + '/etc/resolv.conf'):
+            setup.append(quote(['mount', '--bind', '/etc/resolv.conf', root + '/etc/resolv.conf']))
+        setup.append('exec %s' % quote(cmd))
+        return '%s /bin/sh -c %s' % (quote(self.namespace_cmd()), pipes.quote(' && '.join(setup)))
+
+    def wrap(self, cmd, workdir=None):
+        """Shell command that runs the shell command cmd inside the root"""
+        inner = 'cd %s && %s' % (pipes.quote(workdir or '/'), cmd)
+        return self.wrap_setup(['chroot', self.root, '/bin/sh', '-c', inner])
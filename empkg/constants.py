@@ -16,8 +16,70 @@ BASE_CONFIG = {
     'template': (),
     # An array of file names corresponding to those from the source array. Files listed here will have {} variables
     # replaced with the current context.
+    # empkg: entries can be glob patterns and name files inside directory sources.
     'maintainer': None,
     'vendor': None,
+    'buildroot': None,
+    # Prepared base root directory. When set, makedepends are installed and the pkgver_fcn, prepare, build, check and
+    # package scripts are run in a copy-on-write snapshot of it that is thrown away after the build. See buildroot.py
+    'buildroot_method': 'auto',
+    # How to snapshot the build root: overlay, reflink, hardlink or auto to use the first of overlay and reflink that
+    # works. hardlink snapshots share files with the base, in place writes by the build change it
+    'metrics': True,
+    # Record stage durations, cache hits and downloads of every build in the user cache, see empkg stats and
+    # metrics.py
+    'workspace': None,
+    # Put the relative srcdir, pkgdir and scriptdir on scratch storage: tmpfs for the first of $XDG_RUNTIME_DIR and
+    # /dev/shm that is writable, or a directory. Packages are still written to the pkgdir next to the PKGBUILD. Builds
+    # that wouldn't fit in the free space there run on disk. See workspace.py
+    'workspace_size': None,
+    # Bytes the workspace needs, estimated from the previous successful build or the sources when not set. Builds
+    # whose size can't be estimated (first build with remote sources not fetched yet) run on disk.
+    'reuse_workspace': False,
+    # Keep srcdir from the previous build instead of wiping it. Only changed local sources are copied again and
+    # sources dropped from source are removed, anything else the previous build left in srcdir stays (files extracted
+    # from a dropped archive too). pkgdir is always emptied.
+    'source_hardlink': False,
+    # Stage local sources in srcdir as hardlinks when on the same filesystem, only for scripts that never write to
+    # them in place (sed -i writes a new file, >> doesn't): that would change the originals. Downloaded sources are
+    # always copied out of the source cache, reflinked where the filesystem can.
+    'optimize': False,
+    # Shrink pkgdir after the package script: drop optimize_exclude matches, handle bytecode as optimize_bytecode
+    # says, strip ELF files (unless options has !strip) and hardlink duplicate files. See optimize.py
+    'optimize_exclude': (),
+    # Globs of paths relative to pkgdir to leave out of the package, * also matches /, e.g. '*/tests'
+    'optimize_bytecode': 'prune',
+    # Python bytecode: keep, prune (remove it where the .py is packaged) or compile (checked-hash pycs built with the
+    # pythonX.Y of each lib/pythonX.Y tree)
+    'delta': False,
+    # Also write <package>.delta to pkgdir, a binary delta from the previous package of the same pkgname in
+    # artifactdir (see delta.py). deb and pacman payloads are gzip compressed by empkg rather than fpm so a delta over
+    # the uncompressed payload can rebuild the package byte for byte, rpm deltas are over the compressed package.
+    'artifactdir': None,
+    # Where built packages are kept to compute deltas against, defaults to the user cache directory.
+    'artifact_store': None,
+    # Keep built packages in a content addressed store with deduplicated chunks: true for the user cache or a directory.
+    # Builds whose packaging inputs were packaged before take the packages from it, delta finds the previous version
+    # there instead of artifactdir and remote builds don't download packages it has. See artifacts.py
+    'artifact_keep': None,
+    # Packages of each pkgname the artifact store keeps, older ones are evicted after a build. artifactdir keeps this
+    # many too, only the last one by default.
+    'artifact_max_bytes': None,
+    # Bytes the artifact store may use, the least recently used packages are evicted past it after a build.
+    'offline': False,
+    # Don't touch the network: remote sources must already be in the source cache (see empkg fetch) and pkgver_fcn is
+    # not run, its last known value is used instead. Missing makedepends/checkdepends fail the build rather than being
+    # installed and the stage cache is not used.
+    'reproducible': False,
+    # Make the same inputs give the same package bytes: pkgdir mtimes are set to source_date_epoch, group/other write
+    # permissions dropped, files owned by root and SOURCE_DATE_EPOCH is exported to the scripts and fpm.
+    'source_date_epoch': None,
+    # Timestamp of reproducible builds, defaults to $SOURCE_DATE_EPOCH or 0.
+    'stage_cache': None,
+    # URL of a stage cache server (empkg cache-server). The built srcdir and the packages are pulled from it when a
+    # build with the same inputs ran before on any builder, and pushed to it otherwise. See stagecache.py
+    'skipinteg': False,
+    # Don't check sources against the integrity arrays (md5sums, sha256sums...)
 
 
     # Options and Directives
@@ -25,10 +87,15 @@ BASE_CONFIG = {
 
     # Mandatory
     'pkgname': (),
-    # TODO support array
     # Either the name of the package or an array of names for split packages. Valid characters for members of this
     # array are alphanumerics, and any of the following characters: "@ . _ + -". Additionally, names are not allowed
     # to start with hyphens or dots.
+    # empkg: split packages are built once and packaged in parallel, each from pkgdir/<name> by its package_<name>
+    # (or package when there is none). package_<name> is either the script or a mapping of keys overriding the
+    # PKGBUILD ones (pkgdesc, depends, backup, hooks...) for that package, with the script under `script`.
+
+    'pkgbase': None,
+    # The name used to refer to the group of split packages, defaults to the first pkgname.
 
     # Mandatory
     'pkgver': None,
@@ -38,6 +105,9 @@ BASE_CONFIG = {
     # The pkgver variable can be automatically updated by providing a pkgver_fcn() function in the PKGBUILD that outputs
     # the new package version. This is run after downloading and extracting the sources so it can use those files in
     # determining the new pkgver. This is most useful when used with sources from version control systems (see below).
+    'pkgver_ttl': 0,
+    # Seconds the pkgver_fcn output is reused for the same rendered script and source digests, shared by all builds of
+    # the user. When pkgver_fcn fails the last known value is used.
 
     # Mandatory
     'pkgrel': None,
@@ -90,6 +160,11 @@ BASE_CONFIG = {
     # e.g., source_x86_64=(). There must be a corresponding integrity array with checksums, e.g. md5sums_x86_64=().
     # It is also possible to change the name of the downloaded file, which is helpful with weird URLs and for
     # handling multiple source files with the same name. The syntax is: source=('filename::url').
+    # empkg: a source can also be a list of mirror urls of the same file, they are tried fastest first and a failed
+    # download resumes on the next one. Local sources can be directories or glob patterns, their files are staged in
+    # srcdir with the same relative paths. An entry can also be a mapping with the source under url and include and/or
+    # exclude globs of archive members, e.g. {url: ..., include: [sdk-*/lib]}: members are filtered while the archive
+    # is streamed, a pattern matching a directory applies to everything below it.
     # makepkg also supports building developmental versions of packages using sources downloaded from version
     # control systems (VCS). For more information, see Using VCS Sources below.
     # Files in the source array with extensions .sig, .sign or, .asc are recognized by makepkg as PGP signatures and
@@ -104,6 +179,7 @@ BASE_CONFIG = {
     'noextract': (),
     # An array of file names corresponding to those from the source array. Files listed here will not be extracted
     # with the rest of the source files. This is useful for packages that use compressed data directly.
+    # empkg: entries can be glob patterns and name files inside directory sources.
 
     'md5sums': (),
     # This array contains an MD5 hash for every source file specified in the source array (in the same order).
@@ -118,6 +194,8 @@ BASE_CONFIG = {
     # Alternative integrity checks that makepkg supports; these all behave similar to the md5sums option described
     # above. To enable use and generation of these checksums, be sure to set up the INTEGRITY_CHECK option in
     # makepkg.conf(5).
+    # empkg: the first array that is set is used. Remote sources are downloaded once into the user source cache and
+    # checked every time they are used.
 
     # groups (array)
     # An array of symbolic names that represent groups of packages, allowing you to install multiple packages by
@@ -0,0 +1,330 @@
+"""
+Binary deltas between package versions
+Packages are compared on their decompressed payloads (the gzip compressed
+tarballs in a deb, a gzip compressed pacman package), a change in one file
+would otherwise change every compressed byte after it. The delta is made the
+rsync way: each block of the old payload is indexed by a weak rolling
+checksum, the checksum rolled byte by byte over the new payload finds those
+blocks at any offset and their md5 confirms the match. What is left is
+literal data, the delta itself is gzip compressed.
+
+Builds with delta have fpm leave the payload uncompressed and compress it
+with compress_package, without timestamps, so applying a delta rebuilds the
+new payload and compresses it again to the same bytes. Both digests are
+checked. rpm payloads stay as fpm compressed them, their deltas are over the
+compressed bytes.
+"""
+import gzip
+import hashlib
+import itertools
+import json
+import mmap
+import operator
+import os
+import re
+import struct
+import tempfile
+import zlib
+
+from .util import file_digest as sha256, rm_rf
+
+FORMAT = 'empkg-delta-2'
+BLOCK_SIZE = 4096
+CHUNK_SIZE = 1 << 20
+GZIP_LEVEL = 9
+AR_MAGIC = '!<arch>\n'
+AR_HEADER_SIZE = 60
+
+COPY = 'C'
+LITERAL = 'L'
+
+
+def open_map(path):
+    """Read only mmap of path, None for empty files"""
+    with open(path, 'rb') as fd:
+        if os.fstat(fd.fileno()).st_size == 0:
+            return None
+        return mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def weak_checksum(block):
+    """rsync's checksum of block, a | b << 16, which rolls one byte at a time"""
+    data = bytearray(block)
+    a = sum(data)
+    b = sum(itertools.imap(operator.mul, xrange(len(data), 0, -1), data))
+    return (a & 0xffff) | (b & 0xffff) << 16
+
+
+def diff(old, new, block_size):
+    """Yield (COPY, offset, length) and (LITERAL, data) ops that build new from old"""
+    index = {}
+    if old is not None:
+        for start in xrange(0, len(old) - block_size + 1, block_size):
+            block = old[start:start + block_size]
+            index.setdefault(weak_checksum(block), {}).setdefault(hashlib.md5(block).digest(), start)
+    size = len(new) if new is not None else 0
+    copy = None
+    literal = 0
+    position = 0
+    weak = None
+    while position + block_size <= size:
+        if weak is None:
+            weak = weak_checksum(new[position:position + block_size])
+        blocks = index.get(weak)
+        offset = None
+        if blocks is not None:
+            offset = blocks.get(hashlib.md5(new[position:position + block_size]).digest())
+        if offset is not None:
+            if literal < position:
+                if copy:
+                    yield (COPY, ) + copy
+                    copy = None
+                yield LITERAL, new[literal:position]
+            if copy and copy[0] + copy[1] == offset:
+                copy = (copy[0], copy[1] + block_size)
+            else:
+                if copy:
+                    yield (COPY, ) + copy
+                copy = (offset, block_size)
+            position += block_size
+            literal = position
+            weak = None
+            continue
+        if position + block_size < size:
+            # Roll the window one byte
+            out = ord(new[position])
+            a = ((weak & 0xffff) - out + ord(new[position + block_size])) & 0xffff
+            b = ((weak >> 16) - block_size * out + a) & 0xffff
+            weak = a | b << 16
+        position += 1
+    if copy:
+        yield (COPY, ) + copy
+    if literal < size:
+        yield LITERAL, new[literal:]
+
+
+def copy_stream(src, dst, length=None):
+    """Copy length bytes (all of them when None) from src to dst, returns the bytes written"""
+    written = 0
+    while length is None or written < length:
+        data = src.read(CHUNK_SIZE if length is None else min(CHUNK_SIZE, length - written))
+        if not data:
+            break
+        dst.write(data)
+        written += len(data)
+    return written
+
+
+def gunzip_stream(src, dst, length=None):
+    """Decompress length bytes of gzip data from src into dst, returns the bytes written"""
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    written = 0
+    read = 0
+    while length is None or read < length:
+        data = src.read(CHUNK_SIZE if length is None else min(CHUNK_SIZE, length - read))
+        if not data:
+            break
+        read += len(data)
+        data = decompressor.decompress(data)
+        dst.write(data)
+        written += len(data)
+    data = decompressor.flush()
+    dst.write(data)
+    return written + len(data)
+
+
+def gzip_stream(src, dst, length=None):
+    """Compress length bytes from src into dst, returns the bytes written
+
+    No file name and no timestamp in the header, the same data always gives the same bytes.
+    """
+    start = dst.tell()
+    with gzip.GzipFile(filename='', mode='wb', compresslevel=GZIP_LEVEL, fileobj=dst, mtime=0) as fd:
+        copy_stream(src, fd, length)
+    return dst.tell() - start
+
+
+def rewrite_ar(src, dst, convert):
+    """Copy the ar archive src to dst, convert(name) gives the new name of a member and how to copy it"""
+    if src.read(len(AR_MAGIC)) != AR_MAGIC:
+        raise ValueError('%s is not an ar archive' % src.name)
+    dst.write(AR_MAGIC)
+    while True:
+        header = src.read(AR_HEADER_SIZE)
+        if len(header) < AR_HEADER_SIZE:
+            break
+        size = int(header[48:58])
+        name = header[:16].rstrip(' ')
+        # GNU ar ends names with a slash
+        slash = '/' if name.endswith('/') else ''
+        name, stream = convert(name.rstrip('/'))
+        start = dst.tell()
+        # The header is written once the size of the new data is known
+        dst.write(' ' * AR_HEADER_SIZE)
+        length = (stream or copy_stream)(src, dst, size)
+        if size % 2:
+            src.read(1)
+        if length % 2:
+            dst.write('\n')
+        end = dst.tell()
+        dst.seek(start)
+        dst.write((name + slash).ljust(16) + header[16:48] + str(length).ljust(10) + header[58:])
+        dst.seek(end)
+
+
+def expand_member(name):
+    if name.endswith('.tar.gz'):
+        return name[:-len('.gz')], gunzip_stream
+    return name, None
+
+
+def compress_member(name):
+    if name.endswith('.tar'):
+        return name + '.gz', gzip_stream
+    return name, None
+
+
+def expand(path, directory):
+    """Path of a copy of the package with its payload decompressed in directory, path itself when there is none"""
+    if path.endswith('.deb'):
+        stream = lambda src, dst: rewrite_ar(src, dst, expand_member)
+    elif path.endswith('.pkg.tar.gz'):
+        stream = gunzip_stream
+    else:
+        return path
+    dest = os.path.join(directory, 'expanded-' + os.path.basename(path))
+    with open(path, 'rb') as src:
+        with open(dest, 'wb') as dst:
+            stream(src, dst)
+    return dest
+
+
+def compress(payload, filename, dest):
+    """Compress the payload of the package filename into dest the way compress_package does"""
+    with open(payload, 'rb') as src:
+        with open(dest, 'wb') as dst:
+            if filename.endswith('.deb'):
+                rewrite_ar(src, dst, compress_member)
+            elif filename.endswith('.pkg.tar.gz'):
+                gzip_stream(src, dst)
+            else:
+                copy_stream(src, dst)
+
+
+def compress_package(path):
+    """Compress the payload of a package fpm wrote uncompressed, returns the path of the package
+
+    debs keep their name, pacman packages get .gz appended and rpms are left as they are.
+    """
+    if path.endswith('.deb'):
+        dest = path
+    elif re.search(r'\.pkg\.tar$', path):
+        dest = path + '.gz'
+    else:
+        return path
+    tmp = '%s.%d' % (dest, os.getpid())
+    compress(path, dest, tmp)
+    os.rename(tmp, dest)
+    if dest != path:
+        os.remove(path)
+    return dest
+
+
+def make_delta(old_path, new_path, delta_path, block_size=BLOCK_SIZE):
+    """Write the delta from old_path to new_path, returns its size"""
+    header = {
+        'format': FORMAT,
+        'block_size': block_size,
+        'old': {'filename': os.path.basename(old_path), 'sha256': sha256(old_path)},
+        'new': {'filename': os.path.basename(new_path), 'sha256': sha256(new_path)},
+    }
+    tmpdir = tempfile.mkdtemp(prefix='.empkg-delta-', dir=os.path.dirname(os.path.abspath(delta_path)))
+    old = new = None
+    try:
+        old_payload = expand(old_path, tmpdir)
+        new_payload = expand(new_path, tmpdir)
+        if new_payload != new_path:
+            # Only a payload that compresses back to the same bytes can be rebuilt from its delta, packages that
+            # weren't compressed by compress_package are taken as they are
+            check = os.path.join(tmpdir, 'check')
+            compress(new_payload, new_path, check)
+            if sha256(check) == header['new']['sha256']:
+                header['new']['payload'] = sha256(new_payload)
+            else:
+                new_payload = new_path
+        old = open_map(old_payload)
+        new = open_map(new_payload)
+        # No timestamp in the gzip header, the same packages give the same delta
+        with gzip.GzipFile(delta_path, 'wb', mtime=0) as fd:
+            fd.write(json.dumps(header, sort_keys=True) + '\n')
+            for op in diff(old, new, block_size):
+                if op[0] == COPY:
+                    fd.write(COPY + struct.pack('>QQ', op[1], op[2]))
+                else:
+                    fd.write(LITERAL + struct.pack('>Q', len(op[1])))
+                    fd.write(op[1])
+    finally:
+        for data in (old, new):
+            if data is not None:
+                data.close()
+        rm_rf(tmpdir)
+    return os.path.getsize(delta_path)
+
+
+def read_header(delta_path):
+    with gzip.open(delta_path, 'rb') as fd:
+        header = json.loads(fd.readline())
+    if header.get('format') != FORMAT:
+        raise ValueError('%s is not an empkg delta' % delta_path)
+    return header
+
+
+def apply_delta(old_path, delta_path, new_path):
+    """Rebuild the new package from the old one and a delta"""
+    tmpdir = tempfile.mkdtemp(prefix='.empkg-delta-', dir=os.path.dirname(os.path.abspath(new_path)))
+    try:
+        with gzip.open(delta_path, 'rb') as fd:
+            header = json.loads(fd.readline())
+            if header.get('format') != FORMAT:
+                raise ValueError('%s is not an empkg delta' % delta_path)
+            if sha256(old_path) != header['old']['sha256']:
+                raise ValueError('%s is not the package this delta was made from (%s)' % (
+                    old_path, header['old']['filename']))
+
+            old = open_map(expand(old_path, tmpdir))
+            payload = os.path.join(tmpdir, 'payload')
+            try:
+                with open(payload, 'wb') as out:
+                    while True:
+                        op = fd.read(1)
+                        if not op:
+                            break
+                        if op == COPY:
+                            offset, length = struct.unpack('>QQ', fd.read(16))
+                            out.write(old[offset:offset + length])
+                        elif op == LITERAL:
+                            length, = struct.unpack('>Q', fd.read(8))
+                            out.write(fd.read(length))
+                        else:
+                            raise ValueError('Corrupt delta %s' % delta_path)
+            finally:
+                if old is not None:
+                    old.close()
+
+        new = header['new']
+        if 'payload' in new:
+            if sha256(payload) != new['payload']:
+                raise ValueError('Applying %s did not reproduce the payload of %s' % (delta_path, new['filename']))
+            rebuilt = os.path.join(tmpdir, 'package')
+            compress(payload, new['filename'], rebuilt)
+            if sha256(rebuilt) != new['sha256']:
+                raise ValueError('Compressing the payload did not reproduce %s, zlib may differ from the build host\'s'
+                                 % new['filename'])
+        else:
+            rebuilt = payload
+            if sha256(rebuilt) != new['sha256']:
+                raise ValueError('Applying %s did not reproduce %s' % (delta_path, new['filename']))
+        os.rename(rebuilt, new_path)
+    finally:
+        rm_rf(tmpdir)
+    return new_path
@@ -0,0 +1,156 @@
+"""
+File tree fingerprints
+Like git's index: each tree gets a persistent index of path -> (size, mtime,
+inode, mode, content digest). A file is only hashed again when its stat data
+changed, so an unchanged tree is fingerprinted with a stat per file. Files to
+hash are spread over a thread pool, hashlib releases the GIL on large mmap'd
+buffers so big files are hashed on all cores.
+
+Files modified within the timestamp granularity of the index write can't be
+told apart from unchanged ones by stat (racily clean), their mtime is not
+recorded so they are hashed again next time.
+"""
+import hashlib
+import json
+import mmap
+import os
+import stat
+import time
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
+
+from .util import cache_dir
+
+HASH = 'sha256'
+# Below this files are read, mmap setup costs more than it saves
+MMAP_THRESHOLD = 1024 * 1024
+# Coarsest mtime granularity of common filesystems
+RACY_SECONDS = 2
+VERSION = 1
+
+
+def hash_file(path):
+    hasher = hashlib.new(HASH)
+    with open(path, 'rb') as fd:
+        size = os.fstat(fd.fileno()).st_size
+        if size >= MMAP_THRESHOLD:
+            data = mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                hasher.update(data)
+            finally:
+                data.close()
+        elif size:
+            hasher.update(fd.read())
+    return hasher.hexdigest()
+
+
+def stat_key(st):
+    return [st.st_size, st.st_mtime, st.st_ino, st.st_mode]
+
+
+class FingerprintIndex(object):
+    """Fingerprints of the files under root, persisted in the user cache"""
+    def __init__(self, root, path=None):
+        self.root = os.path.abspath(root)
+        if path is None:
+            path = os.path.join(cache_dir('fingerprints'), '%s.json' % hashlib.sha256(self.root).hexdigest())
+        self.path = path
+        self.entries = {}
+        # Paths whose digest changed, or that were not indexed, in the last update
+        self.changed = []
+        self.load()
+
+    def load(self):
+        try:
+            with open(self.path) as fd:
+                index = json.load(fd)
+        except (IOError, ValueError):
+            return
+        if index.get('version') == VERSION and index.get('root') == self.root:
+            self.entries = index['entries']
+
+    def save(self):
+        now = time.time()
+        entries = {}
+        for path, entry in self.entries.iteritems():
+            if entry[1] >= now - RACY_SECONDS:
+                # Racily clean, never matches a stat so it is hashed again next time
+                entry = [entry[0], -1] + entry[2:]
+            entries[path] = entry
+        tmp = '%s.%d' % (self.path, os.getpid())
+        with open(tmp, 'w') as fd:
+            json.dump({'version': VERSION, 'root': self.root, 'entries': entries}, fd)
+        os.rename(tmp, self.path)
+
+    def scan(self):
+        """Relative paths of everything under root"""
+        paths = []
+        for dirpath, dirnames, filenames in os.walk(self.root):
+            rel = os.path.relpath(dirpath, self.root)
+            for name in dirnames + filenames:
+                paths.append(os.path.normpath(os.path.join(rel, name)))
+        return paths
+
+    def update(self, paths=None):
+        """Refresh the entries of paths (relative to root, default everything), returns {path: digest}"""
+        previous = self.entries
+        if paths is None:
+            paths = self.scan()
+            # Drop the entries of removed files
+            self.entries = {}
+        else:
+            self.entries = dict(previous)
+        digests = {}
+        to_hash = []
+        for rel in paths:
+            path = os.path.join(self.root, rel)
+            try:
+                st = os.lstat(path)
+            except OSError:
+                self.entries.pop(rel, None)
+                continue
+            key = stat_key(st)
+            entry = previous.get(rel)
+            if entry is not None and entry[:4] == key and entry[4] is not None:
+                digests[rel] = entry[4]
+            elif stat.S_ISLNK(st.st_mode):
+                digests[rel] = 'link:%s' % os.readlink(path)
+            elif stat.S_ISDIR(st.st_mode):
+                digests[rel] = 'dir'
+            elif stat.S_ISREG(st.st_mode):
+                to_hash.append(rel)
+            else:
+                digests[rel] = 'special:%o' % stat.S_IFMT(st.st_mode)
+            self.entries[rel] = key + [digests.get(rel)]
+
+        if to_hash:
+            if len(to_hash) > 1:
+                pool = ThreadPool(min(cpu_count(), len(to_hash)))
+                try:
+                    hashed = pool.map(hash_file, [os.path.join(self.root, rel) for rel in to_hash])
+                finally:
+                    pool.close()
+                    pool.join()
+            else:
+                hashed = [hash_file(os.path.join(self.root, to_hash[0]))]
+            for rel, digest in zip(to_hash, hashed):
+                digests[rel] = digest
+                self.entries[rel][4] = digest
+
+        self.changed = sorted(rel for rel, digest in digests.iteritems() if previous.get(rel, [None] * 5)[4] != digest)
+        return digests
+
+    def digest(self, paths=None):
+        """One digest for the tree, or for paths in it, covering names, executable bits and contents"""
+        digests = self.update(paths)
+        hasher = hashlib.new(HASH)
+        for rel in sorted(digests):
+            executable = self.entries[rel][3] & 0111 and not stat.S_ISDIR(self.entries[rel][3])
+            hasher.update('%s\0%s\0%s\n' % (rel, 'x' if executable else '-', digests[rel]))
+        self.save()
+        return hasher.hexdigest()
+
+
+def tree_digest(root, paths=None):
+    """Digest of the tree at root, files unchanged since the last call are not read"""
+    return FingerprintIndex(root).digest(paths)
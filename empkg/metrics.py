@@ -0,0 +1,268 @@
+"""
+Build metrics
+Every build appends what it measured to an SQLite database in the user cache:
+
+    builds    id, pkgbase, pkgver, pkgrel, started, duration, status
+    stages    build, pkgname, stage, seconds
+    counters  build, name, value
+
+Counters are cache lookups (<cache>_hit and <cache>_miss for source_cache,
+pkgver_cache, stage_cache_build, stage_cache_package and artifact_store) and
+what was downloaded (download_bytes, download_seconds).
+
+`empkg stats` shows stage duration percentiles, regressions, cache hit rates
+and download throughput per package. `empkg stats --prometheus FILE` writes
+them in the Prometheus textfile format for node_exporter.
+"""
+import os
+import sqlite3
+import time
+from collections import defaultdict
+
+from .util import cache_dir
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS builds (
+    id INTEGER PRIMARY KEY,
+    pkgbase TEXT NOT NULL,
+    pkgver TEXT,
+    pkgrel TEXT,
+    started REAL NOT NULL,
+    duration REAL NOT NULL,
+    status TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS stages (
+    build INTEGER NOT NULL REFERENCES builds(id),
+    pkgname TEXT NOT NULL,
+    stage TEXT NOT NULL,
+    seconds REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS counters (
+    build INTEGER NOT NULL REFERENCES builds(id),
+    name TEXT NOT NULL,
+    value REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS builds_pkgbase ON builds(pkgbase, started);
+CREATE INDEX IF NOT EXISTS stages_build ON stages(build);
+CREATE INDEX IF NOT EXISTS counters_build ON counters(build);
+'''
+CACHES = ('source_cache', 'pkgver_cache', 'stage_cache_build', 'stage_cache_package', 'artifact_store')
+QUANTILES = (0.5, 0.9, 0.99)
+# Builds compared against the ones before them to find regressions
+RECENT = 3
+BASELINE = 20
+# Slowdown of the recent median over the baseline one reported as a regression
+REGRESSION = 1.25
+# Stages quicker than this are noise
+MIN_SECONDS = 0.1
+
+
+def default_path():
+    return os.path.join(cache_dir('metrics'), 'metrics.sqlite')
+
+
+def connect(path=None):
+    db = sqlite3.connect(path or default_path(), timeout=30)
+    # Builds running side by side append without blocking readers
+    db.execute('PRAGMA journal_mode=WAL')
+    db.executescript(SCHEMA)
+    return db
+
+
+def record(conf, status, started, finished, timings, counters, path=None):
+    """Append a build: timings are (pkgname, stage, seconds), counters {name: value}"""
+    db = connect(path)
+    try:
+        with db:
+            cursor = db.execute(
+                'INSERT INTO builds (pkgbase, pkgver, pkgrel, started, duration, status) VALUES (?, ?, ?, ?, ?, ?)',
+                (conf['pkgbase'], str(conf['pkgver']), str(conf['pkgrel']), started, finished - started, status))
+            build = cursor.lastrowid
+            db.executemany('INSERT INTO stages (build, pkgname, stage, seconds) VALUES (?, ?, ?, ?)',
+                           [(build, ) + tuple(timing) for timing in timings])
+            db.executemany('INSERT INTO counters (build, name, value) VALUES (?, ?, ?)',
+                           [(build, name, value) for name, value in sorted(counters.items())])
+    finally:
+        db.close()
+
+
+def percentile(values, quantile):
+    """Linear interpolation between the closest ranks of sorted values"""
+    if not values:
+        return None
+    position = (len(values) - 1) * quantile
+    lower = int(position)
+    upper = min(lower + 1, len(values) - 1)
+    return values[lower] + (values[upper] - values[lower]) * (position - lower)
+
+
+def median(values):
+    return percentile(sorted(values), 0.5)
+
+
+def matches(names, *candidates):
+    return not names or any(candidate in names for candidate in candidates)
+
+
+def stage_history(db, names=(), since=None):
+    """{(pkgname, stage): [seconds, oldest build first]} of the successful builds"""
+    history = defaultdict(list)
+    rows = db.execute(
+        'SELECT builds.pkgbase, stages.pkgname, stages.stage, SUM(stages.seconds) FROM stages '
+        'JOIN builds ON builds.id = stages.build WHERE builds.status = ? AND builds.started >= ? '
+        'GROUP BY builds.id, stages.pkgname, stages.stage ORDER BY builds.started, builds.id',
+        ('ok', since or 0))
+    for pkgbase, pkgname, stage, seconds in rows:
+        if matches(names, pkgbase, pkgname):
+            history[pkgname, stage].append(seconds)
+    return history
+
+
+def counter_totals(db, names=(), since=None):
+    """{pkgbase: {counter: total}}"""
+    totals = defaultdict(lambda: defaultdict(float))
+    rows = db.execute(
+        'SELECT builds.pkgbase, counters.name, SUM(counters.value) FROM counters '
+        'JOIN builds ON builds.id = counters.build WHERE builds.started >= ? GROUP BY builds.pkgbase, counters.name',
+        (since or 0, ))
+    for pkgbase, name, value in rows:
+        if matches(names, pkgbase):
+            totals[pkgbase][name] = value
+    return totals
+
+
+def build_totals(db, names=(), since=None):
+    """{(pkgbase, status): (builds, last started)}"""
+    rows = db.execute(
+        'SELECT pkgbase, status, COUNT(*), MAX(started) FROM builds WHERE started >= ? GROUP BY pkgbase, status',
+        (since or 0, ))
+    return dict(((pkgbase, status), (count, last)) for pkgbase, status, count, last in rows
+                if matches(names, pkgbase))
+
+
+def regressions(history):
+    """(pkgname, stage, baseline median, recent median) of the stages that got slower"""
+    found = []
+    for (pkgname, stage), seconds in sorted(history.items()):
+        recent = seconds[-RECENT:]
+        baseline = seconds[-RECENT - BASELINE:-RECENT]
+        if len(recent) < RECENT or len(baseline) < RECENT:
+            continue
+        before, after = median(baseline), median(recent)
+        if before > 0 and after >= MIN_SECONDS and after > before * REGRESSION:
+            found.append((pkgname, stage, before, after))
+    return found
+
+
+def hit_rates(counters):
+    """{cache: (hits, lookups)} of the caches that were looked up"""
+    rates = {}
+    for cache in CACHES:
+        hits = counters.get('%s_hit' % cache, 0)
+        lookups = hits + counters.get('%s_miss' % cache, 0)
+        if lookups:
+            rates[cache] = (int(hits), int(lookups))
+    return rates
+
+
+def report(db, names=(), since=None):
+    """Text report of the recorded builds"""
+    lines = []
+    history = stage_history(db, names, since)
+    if history:
+        lines.append('%-24s %-14s %6s %9s %9s %9s %9s' % ('pkgname', 'stage', 'runs', 'p50', 'p90', 'p99', 'last'))
+        for (pkgname, stage), seconds in sorted(history.items()):
+            ordered = sorted(seconds)
+            lines.append('%-24s %-14s %6d %8.2fs %8.2fs %8.2fs %8.2fs' % (
+                (pkgname, stage, len(seconds)) + tuple(percentile(ordered, q) for q in QUANTILES) + (seconds[-1], )))
+    else:
+        lines.append('No builds recorded')
+
+    found = regressions(history)
+    if found:
+        lines.append('')
+        lines.append('Regressions (median of the last %d builds against the %d before):' % (RECENT, BASELINE))
+        for pkgname, stage, before, after in found:
+            lines.append('  %s %s: %.2fs -> %.2fs (+%.0f%%)' % (
+                pkgname, stage, before, after, 100 * (after / before - 1)))
+
+    totals = counter_totals(db, names, since)
+    if totals:
+        lines.append('')
+        lines.append('Caches and downloads:')
+        for pkgbase, counters in sorted(totals.items()):
+            rates = ', '.join('%s %d/%d (%.0f%%)' % (cache, hits, lookups, 100.0 * hits / lookups)
+                              for cache, (hits, lookups) in sorted(hit_rates(counters).items()))
+            if counters.get('download_seconds'):
+                rates += '%sdownloaded %.1f MB at %.1f MB/s' % (
+                    ', ' if rates else '', counters['download_bytes'] / 1e6,
+                    counters['download_bytes'] / 1e6 / counters['download_seconds'])
+            if rates:
+                lines.append('  %s: %s' % (pkgbase, rates))
+    return '\n'.join(lines)
+
+
+def labels(**values):
+    return '{%s}' % ','.join('%s="%s"' % (name, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                             for name, value in sorted(values.items()))
+
+
+def prometheus(db, names=(), since=None):
+    """The metrics in the Prometheus text exposition format"""
+    lines = [
+        '# HELP empkg_stage_duration_seconds Duration of the build stages',
+        '# TYPE empkg_stage_duration_seconds summary',
+    ]
+    for (pkgname, stage), seconds in sorted(stage_history(db, names, since).items()):
+        ordered = sorted(seconds)
+        for quantile in QUANTILES:
+            lines.append('empkg_stage_duration_seconds%s %f' % (
+                labels(pkgname=pkgname, stage=stage, quantile=quantile), percentile(ordered, quantile)))
+        lines.append('empkg_stage_duration_seconds_sum%s %f' % (labels(pkgname=pkgname, stage=stage), sum(seconds)))
+        lines.append('empkg_stage_duration_seconds_count%s %d' % (labels(pkgname=pkgname, stage=stage), len(seconds)))
+
+    totals = counter_totals(db, names, since)
+    lines.extend([
+        '# HELP empkg_cache_lookups_total Cache lookups by result',
+        '# TYPE empkg_cache_lookups_total counter',
+    ])
+    for pkgbase, counters in sorted(totals.items()):
+        for cache, (hits, lookups) in sorted(hit_rates(counters).items()):
+            lines.append('empkg_cache_lookups_total%s %d' % (labels(pkgbase=pkgbase, cache=cache, result='hit'), hits))
+            lines.append('empkg_cache_lookups_total%s %d' % (
+                labels(pkgbase=pkgbase, cache=cache, result='miss'), lookups - hits))
+    for name, description in (('bytes', 'Bytes of sources downloaded'), ('seconds', 'Time spent downloading sources')):
+        lines.extend([
+            '# HELP empkg_download_%s_total %s' % (name, description),
+            '# TYPE empkg_download_%s_total counter' % name,
+        ])
+        for pkgbase, counters in sorted(totals.items()):
+            lines.append('empkg_download_%s_total%s %f' % (
+                name, labels(pkgbase=pkgbase), counters.get('download_%s' % name, 0)))
+
+    builds = build_totals(db, names, since)
+    lines.extend([
+        '# HELP empkg_builds_total Builds by status',
+        '# TYPE empkg_builds_total counter',
+    ])
+    for (pkgbase, status), (count, last) in sorted(builds.items()):
+        lines.append('empkg_builds_total%s %d' % (labels(pkgbase=pkgbase, status=status), count))
+    lines.extend([
+        '# HELP empkg_last_build_timestamp_seconds When the last build started',
+        '# TYPE empkg_last_build_timestamp_seconds gauge',
+    ])
+    for (pkgbase, status), (count, last) in sorted(builds.items()):
+        lines.append('empkg_last_build_timestamp_seconds%s %f' % (labels(pkgbase=pkgbase, status=status), last))
+    return '\n'.join(lines) + '\n'
+
+
+def write_textfile(path, text):
+    """Replace path atomically, the textfile collector may read it at any time"""
+    tmp = '%s.%d.tmp' % (path, os.getpid())
+    with open(tmp, 'w') as fd:
+        fd.write(text)
+    os.rename(tmp, path)
+
+
+def days_ago(days):
+    return time.time() - days * 86400 if days is not None else None
@@ -0,0 +1,224 @@
+"""
+Package payload optimization
+Run on pkgdir between the package script and fpm, in this order:
+    exclude   remove paths matching the optimize_exclude globs
+    bytecode  prune: remove .pyc/.pyo that have their .py next to them
+              compile: byte-compile with the interpreter of each lib/pythonX.Y
+              tree, checked-hash pycs (PEP 552) so they are reproducible
+    strip     strip ELF objects like makepkg does, unless options has !strip
+    dedupe    hardlink files with identical contents and modes
+Stripping and hashing run on a thread pool sized to the cores.
+"""
+import fnmatch
+import os
+import re
+import stat
+import struct
+import subprocess
+from collections import defaultdict
+from distutils.spawn import find_executable
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
+
+from .fingerprint import hash_file
+from .util import default_job, rm_rf
+
+BYTECODE_MODES = ('keep', 'prune', 'compile')
+PYTHON_LIB = re.compile(r'^python(\d+\.\d+)$')
+
+# ELF e_type
+ET_REL = 1
+ET_EXEC = 2
+ET_DYN = 3
+
+
+def tree_size(root):
+    """Bytes of the regular files under root, hardlinks counted once"""
+    seen = set()
+    size = 0
+    for dirpath, dirnames, filenames in os.walk(root):
+        for filename in filenames:
+            st = os.lstat(os.path.join(dirpath, filename))
+            if stat.S_ISREG(st.st_mode) and (st.st_dev, st.st_ino) not in seen:
+                seen.add((st.st_dev, st.st_ino))
+                size += st.st_size
+    return size
+
+
+def regular_files(root):
+    for dirpath, dirnames, filenames in os.walk(root):
+        for filename in filenames:
+            path = os.path.join(dirpath, filename)
+            if stat.S_ISREG(os.lstat(path).st_mode):
+                yield path
+
+
+def parallel(function, items):
+    items = list(items)
+    if len(items) < 2:
+        return map(function, items)
+    pool = ThreadPool(min(cpu_count(), len(items)))
+    try:
+        return pool.map(function, items)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def exclude(root, patterns):
+    """Remove what matches patterns, globs on paths relative to root where * also matches /"""
+    if not patterns:
+        return
+    regex = re.compile('|'.join(fnmatch.translate(pattern.lstrip('/')) for pattern in patterns))
+    for dirpath, dirnames, filenames in os.walk(root):
+        rel = os.path.relpath(dirpath, root)
+        for name in list(dirnames):
+            if regex.match(os.path.normpath(os.path.join(rel, name))):
+                dirnames.remove(name)
+                path = os.path.join(dirpath, name)
+                if os.path.islink(path):
+                    os.remove(path)
+                else:
+                    rm_rf(path)
+        for name in filenames:
+            if regex.match(os.path.normpath(os.path.join(rel, name))):
+                os.remove(os.path.join(dirpath, name))
+
+
+def bytecode_source(path):
+    """The .py a .pyc/.pyo was compiled from"""
+    dirname, filename = os.path.split(path)
+    if os.path.basename(dirname) == '__pycache__':
+        # PEP 3147: __pycache__/name.cpython-XY.pyc
+        return os.path.join(os.path.dirname(dirname), filename.split('.')[0] + '.py')
+    return os.path.splitext(path)[0] + '.py'
+
+
+def prune_bytecode(root):
+    for path in regular_files(root):
+        if path.endswith(('.pyc', '.pyo')) and os.path.exists(bytecode_source(path)):
+            os.remove(path)
+    for dirpath, dirnames, filenames in os.walk(root, topdown=False):
+        if os.path.basename(dirpath) == '__pycache__' and not os.listdir(dirpath):
+            os.rmdir(dirpath)
+
+
+def compile_bytecode(root, job):
+    """Byte-compile each lib/pythonX.Y tree with pythonX.Y, paths recorded as installed"""
+    for dirpath, dirnames, filenames in os.walk(root):
+        for name in list(dirnames):
+            match = PYTHON_LIB.match(name)
+            if not match or os.path.basename(dirpath) not in ('lib', 'lib64'):
+                continue
+            dirnames.remove(name)
+            path = os.path.join(dirpath, name)
+            python = find_executable('python%s' % match.group(1))
+            if python is None:
+                job.output('No python%s to compile %s, skipped' % (match.group(1), path))
+                continue
+            prune_bytecode(path)
+            cmd = [python, '-m', 'compileall', '-q', '-f', '-d', '/' + os.path.relpath(path, root), path]
+            if tuple(int(part) for part in match.group(1).split('.')) >= (3, 7):
+                cmd[3:3] = ['-j', '0', '--invalidation-mode', 'checked-hash']
+            # Failures are files that don't compile with this interpreter, leave them be
+            with open(os.devnull, 'w') as devnull:
+                subprocess.call(cmd, stdout=devnull)
+
+
+def elf_type(path):
+    """ELF e_type of path, None when it isn't an ELF object"""
+    with open(path, 'rb') as fd:
+        header = fd.read(18)
+    if len(header) < 18 or header[:4] != '\x7fELF':
+        return None
+    # EI_DATA: 1 little endian, 2 big endian
+    return struct.unpack('<H' if header[5] == '\x01' else '>H', header[16:18])[0]
+
+
+def strip_file(path):
+    """Strip path like makepkg, returns whether it was stripped"""
+    try:
+        kind = elf_type(path)
+    except IOError:
+        return False
+    if kind in (ET_EXEC, ET_DYN):
+        option = '--strip-unneeded'
+    elif kind == ET_REL and path.endswith(('.a', '.o')):
+        option = '--strip-debug'
+    else:
+        return False
+    st = os.stat(path)
+    if not st.st_mode & stat.S_IWUSR:
+        os.chmod(path, st.st_mode | stat.S_IWUSR)
+    with open(os.devnull, 'w') as devnull:
+        ret = subprocess.call(['strip', option, path], stdout=devnull, stderr=devnull)
+    os.chmod(path, stat.S_IMODE(st.st_mode))
+    return ret == 0
+
+
+def strip(root, job):
+    if find_executable('strip') is None:
+        job.output('No strip, ELF files left as they are')
+        return 0
+    return sum(parallel(strip_file, regular_files(root)))
+
+
+def is_conffile(relpath, conffiles):
+    """Whether relpath is one of conffiles (backup entries, files or directories) or under one"""
+    for conffile in conffiles:
+        conffile = conffile.strip('/')
+        if relpath == conffile or relpath.startswith(conffile + '/'):
+            return True
+    return False
+
+
+def dedupe(root, conffiles=()):
+    """Hardlink files with the same contents and mode, returns how many were linked
+
+    Config files are left alone: once installed, editing one would edit its twins
+    and package managers track them one by one
+    """
+    by_size = defaultdict(list)
+    seen = set()
+    for path in regular_files(root):
+        if conffiles and is_conffile(os.path.relpath(path, root), conffiles):
+            continue
+        st = os.lstat(path)
+        if st.st_size and (st.st_dev, st.st_ino) not in seen:
+            seen.add((st.st_dev, st.st_ino))
+            by_size[st.st_size, st.st_mode, st.st_uid, st.st_gid].append(path)
+    # Only files sharing a size can be duplicates, hash those
+    candidates = sorted((key, path) for key, paths in by_size.iteritems() if len(paths) > 1 for path in paths)
+
+    by_content = defaultdict(list)
+    digests = parallel(hash_file, [path for key, path in candidates])
+    for (key, path), digest in zip(candidates, digests):
+        by_content[key, digest].append(path)
+    linked = 0
+    for paths in by_content.values():
+        for path in paths[1:]:
+            tmp = '%s.empkg-link' % path
+            os.link(paths[0], tmp)
+            os.rename(tmp, path)
+            linked += 1
+    return linked
+
+
+def optimize(root, exclude_patterns=(), bytecode='prune', strip_elf=True, conffiles=(), job=None):
+    """Shrink the payload under root, returns the bytes saved, conffiles are never hardlinked"""
+    if job is None:
+        job = default_job
+    if bytecode not in BYTECODE_MODES:
+        raise ValueError('optimize_bytecode must be one of %s' % ', '.join(BYTECODE_MODES))
+    before = tree_size(root)
+    exclude(root, exclude_patterns)
+    if bytecode == 'prune':
+        prune_bytecode(root)
+    elif bytecode == 'compile':
+        compile_bytecode(root, job)
+    stripped = strip(root, job) if strip_elf else 0
+    linked = dedupe(root, conffiles)
+    after = tree_size(root)
+    job.output('Optimized %s: %d -> %d bytes, %d saved (%d ELF files stripped, %d duplicates hardlinked)' % (
+        root, before, after, before - after, stripped, linked))
+    return before - after
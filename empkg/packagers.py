@@ -3,12 +3,34 @@ Base class to create project packagers
 Projects should implement a class that inherits BasePackager and add any
 extra required build/packaging steps
 """
+import hashlib
+import json
 import os
-
-from jinja2 import Template
+import platform
+import re
+import shutil
+import subprocess
+import tempfile
+import time
+from collections import defaultdict
+from copy import copy
+from multiprocessing.pool import ThreadPool
 
 from . import sources
+from .buildroot import BuildRoot
+from .delta import compress_package, make_delta
+from .fingerprint import tree_digest
+from .optimize import optimize
+from .repo import package_type
+from .reproducible import normalize_tree, source_date_epoch
+from .stagecache import CACHE_ERRORS, StageCache, stage_key
 from .util import (
+    BuildCancelled,
+    cache_dir,
+    cache_get,
+    cache_set,
+    default_job,
+    file_digest,
     get_pkgman,
     get_pkgman_class,
     get_pkgtype,
@@ -16,9 +38,18 @@ from .util import (
     mkdir_p,
     produce_and_run_script,
     produce_script,
+    render,
     rm_rf,
+    rm_rf_async,
     run_script,
 )
+from .workspace import (
+    estimate as workspace_estimate,
+    fits as workspace_fits,
+    record as workspace_record,
+    scratch_dir,
+    workspace_path,
+)
 
 INSTALL_HOOKS = (
     ('--before-remove', 'pre_remove'),
@@ -29,13 +60,70 @@ INSTALL_HOOKS = (
     ('--after-upgrade', 'post_upgrade'),
 )
 HOOK_NAMES = [hook_name for _, hook_name in INSTALL_HOOKS]
+# Settings that don't change what the stages produce
+STAGE_CACHE_IGNORED = (
+    'artifact_keep',
+    'artifact_max_bytes',
+    'artifact_store',
+    'artifactdir',
+    'metrics',
+    'offline',
+    'pkgdir',
+    'reuse_workspace',
+    'scriptdir',
+    'skipinteg',
+    'source_hardlink',
+    'srcdir',
+    'stage_cache',
+    'startdir',
+    'workspace',
+    'workspace_size',
+)
+# Settings only used once prepare and build ran
+PACKAGE_STAGE_KEYS = tuple(HOOK_NAMES) + (
+    'backup',
+    'changelog',
+    'check',
+    'checkdepends',
+    'conflicts',
+    'delta',
+    'depends',
+    'install',
+    'license',
+    'maintainer',
+    'optdepends',
+    'optimize',
+    'optimize_bytecode',
+    'optimize_exclude',
+    'package',
+    'pkgdesc',
+    'pkgrel',
+    'provides',
+    'replaces',
+    'url',
+    'vendor',
+)
+# Sources staged in srcdir by the last build, a reused srcdir drops the ones no longer in source
+SOURCES_MANIFEST = '.empkg-sources'
+# Artifacts written to pkgdir
+PACKAGE_FILES = re.compile(r'\.(deb|rpm|pkg\.tar(\.\w+)?)(\.delta)?$')
+
+
+def package_arch(conf):
+    """Architecture of the package as the package type names it"""
+    if conf['arch'] == 'any' and conf['pkgtype'] == 'deb':
+        return 'all'
+    return conf['arch']
 
 
 class BasePackager(object):
-    def __init__(self, conf):
+    def __init__(self, conf, job=None):
         self.conf = conf
-        conf['startdir'] = os.getcwd()
+        if conf['startdir'] is None:
+            conf['startdir'] = os.getcwd()
         self.startdir = conf['startdir']
+        # Output, environment and cancellation of the scripts
+        self.job = job or default_job
 
         if os.path.isabs(conf['srcdir']):
             self.srcdir = conf['srcdir']
@@ -52,6 +140,32 @@ class BasePackager(object):
         else:
             self.scriptdir = os.path.join(conf['startdir'], conf['scriptdir'])
 
+        # Where fpm writes packages, split packages share their parent's and workspaces keep them on disk
+        self.outdir = self.pkgdir
+        # Packagers of the split packages, once packaged
+        self.subpackagers = []
+
+        # Set while a build runs in a build root
+        self.root = None
+        # Paths of the packages produced by fpm
+        self.artifacts = []
+        # Sources as staged in srcdir
+        self.source_files = []
+        # Key of the packaging inputs, set when a stage cache or artifact store needs it
+        self.package_key = None
+        if conf['artifact_store']:
+            # sqlite3 is only loaded when there is a store
+            from .artifacts import open_store
+            self.store = open_store(conf)
+        else:
+            self.store = None
+        # (pkgname, stage, seconds) of the stages run, shared with the split packages
+        self.timings = []
+        # The package and stage running, and when it started
+        self.current_stage = None
+        # Cache lookups and downloads, see metrics.py
+        self.counters = defaultdict(float)
+
         self.set_pkgtype()
         self.makepkgman = None
         self.set_makepkgman()
@@ -65,59 +179,272 @@ class BasePackager(object):
         if self.conf['pkgtype'] is None:
             self.conf['pkgtype'] = get_pkgtype(linux_dist())
 
+    def log(self, message):
+        self.job.output(message)
+
+    def stage(self, name, message=None):
+        """Announce a stage, raises BuildCancelled instead once the build was cancelled"""
+        self.end_stage()
+        self.job.check()
+        # Stages before the split packages are packaged are the pkgbase's
+        pkgname = self.conf['pkgbase'] if isinstance(self.conf['pkgname'], (list, tuple)) else self.conf['pkgname']
+        self.job.event('stage', pkgname=pkgname, stage=name)
+        self.log(message or 'Running %s...' % name)
+        self.current_stage = (pkgname, name, time.time())
+
+    def end_stage(self):
+        if self.current_stage is not None:
+            pkgname, name, started = self.current_stage
+            self.timings.append((pkgname, name, time.time() - started))
+            self.current_stage = None
+
+    def count(self, name, value=1):
+        self.counters[name] += value
+
     def run(self):
+        started = time.time()
+        status = 'failed'
+        workspace = self.place_workspace()
+        try:
+            self.build()
+            status = 'ok'
+        except BuildCancelled:
+            status = 'cancelled'
+            raise
+        finally:
+            self.end_stage()
+            if self.conf['workspace'] and status == 'ok':
+                # On disk too, the next build knows whether it fits
+                try:
+                    workspace_record(self.workspace_key, self.srcdir, self.pkgdir)
+                except EnvironmentError as exc:
+                    self.log('Could not record the workspace size: %s' % exc)
+            if workspace is not None and not self.conf['reuse_workspace']:
+                rm_rf_async(workspace)
+            if self.conf['metrics']:
+                self.record_metrics(status, started)
+
+    def record_metrics(self, status, started):
+        """Append the build to the metrics database, a failure only costs a warning"""
+        # sqlite3 is only loaded once a build is over
+        from . import metrics
+        try:
+            metrics.record(self.conf, status, started, time.time(), self.timings, self.counters)
+        except (metrics.sqlite3.Error, EnvironmentError) as exc:
+            # A locked or broken database, or a cache directory that can't be created
+            self.log('Could not record metrics: %s' % exc)
+
+    def build(self):
         self.clean()
 
+        if self.conf['buildroot']:
+            self.root = BuildRoot(
+                self.conf['buildroot'],
+                method=self.conf['buildroot_method'],
+                binds=(self.startdir, self.srcdir, self.pkgdir, self.scriptdir),
+                job=self.job,
+            )
+            self.root.create()
+        try:
+            self.run_stages()
+        finally:
+            if self.root is not None:
+                self.root.destroy()
+                self.root = None
+
+    def run_stages(self):
+        if self.conf['reproducible']:
+            # For the tools the scripts run
+            self.job.env['SOURCE_DATE_EPOCH'] = str(source_date_epoch(self.conf))
         self.apply_context()
         self.get_makedepends()
+        self.get_checkdepends()
         self.get_sources()
         if self.conf['pkgver_fcn']:
             # TODO rebuild names after this?
-            print 'Running pkgver_fcn...'
-            self.conf['pkgver'] = produce_and_run_script(
-                self.conf['pkgver_fcn'],
-                os.path.join(self.scriptdir, 'pkgver_fcn'),
+            self.stage('pkgver_fcn')
+            self.conf['pkgver'] = self.pkgver()
+
+        # The stage cache is a server, offline builds go without it
+        cache = StageCache(self.conf['stage_cache']) if self.conf['stage_cache'] and not self.conf['offline'] else None
+        upload = None
+        if cache is not None or self.store is not None:
+            inputs = self.stage_inputs()
+            self.package_key = package_key = stage_key('package', inputs)
+        if self.store is not None:
+            restored = self.stored(self.restore_stored, package_key)
+            self.count('artifact_store_%s' % ('hit' if restored else 'miss'))
+            if restored:
+                return
+        if cache is not None:
+            # Changing how the build is packaged keeps the build, the built tree may refer to where it was built
+            inputs['conf'] = dict((key, value) for key, value in inputs['conf'].items()
+                                  if key not in PACKAGE_STAGE_KEYS and not key.startswith('package_'))
+            build_key = stage_key('build', inputs, self.srcdir)
+            restored = self.restore_packages(cache, package_key)
+            self.count('stage_cache_package_%s' % ('hit' if restored else 'miss'))
+            if restored:
+                return
+
+        if cache is not None and self.cached(cache.restore_tree, build_key, self.srcdir):
+            self.count('stage_cache_build_hit')
+            self.log('Restored prepare and build from the stage cache')
+        else:
+            if cache is not None:
+                self.count('stage_cache_build_miss')
+            self.prepare_and_build()
+            if cache is not None:
+                # Uploaded while the next stages run
+                upload = self.cached(cache.save_tree, build_key, self.srcdir)
+
+        if self.conf['check']:
+            self.stage('check')
+            produce_and_run_script(
+                self.conf['check'],
+                os.path.join(self.scriptdir, 'check'),
                 context=self.conf,
                 workdir=self.srcdir,
+                root=self.root,
+                job=self.job,
             )
 
+        if isinstance(self.conf['pkgname'], (list, tuple)):
+            self.package_split()
+        else:
+            self.package()
+
+        if cache is not None:
+            self.cached(cache.save_files, package_key, self.artifacts)
+        if upload is not None:
+            self.cached(upload.join)
+
+    def prepare_and_build(self):
         if self.conf['prepare']:
-            print 'Running prepare...'
+            self.stage('prepare')
             produce_and_run_script(
                 self.conf['prepare'],
                 os.path.join(self.scriptdir, 'prepare'),
                 context=self.conf,
                 workdir=self.srcdir,
+                root=self.root,
+                job=self.job,
             )
 
         if self.conf['build']:
-            print 'Running build...'
+            self.stage('build')
             produce_and_run_script(
                 self.conf['build'],
                 os.path.join(self.scriptdir, 'build'),
                 context=self.conf,
                 workdir=self.srcdir,
+                root=self.root,
+                job=self.job,
             )
 
-        if self.conf['check']:
-            print 'Running check...'
-            produce_and_run_script(
-                self.conf['check'],
-                os.path.join(self.scriptdir, 'check'),
-                context=self.conf,
-                workdir=self.srcdir,
-            )
+    def stage_inputs(self):
+        """What the stages depend on, build paths left out so every builder agrees"""
+        return {
+            'conf': dict((key, value) for key, value in self.conf.items() if key not in STAGE_CACHE_IGNORED),
+            'sources': tree_digest(self.srcdir, self.source_files),
+            'dist': linux_dist(),
+            'machine': platform.machine(),
+        }
+
+    def cached(self, action, *args):
+        """Run a stage cache action, an unavailable cache only costs a warning"""
+        try:
+            return action(*args)
+        except CACHE_ERRORS as exc:
+            self.log('Stage cache unavailable: %s' % exc)
+            return None
+
+    def restore_packages(self, cache, key):
+        """Take the packages from the stage cache, False when they aren't there"""
+        artifacts = self.cached(cache.restore_files, key, self.outdir)
+        if not artifacts:
+            return False
+        self.restored(artifacts, 'the stage cache')
+        return True
 
+    @property
+    def pkgnames(self):
+        return self.conf['pkgname'] if isinstance(self.conf['pkgname'], (list, tuple)) else [self.conf['pkgname']]
+
+    def restore_stored(self, key):
+        """Take the packages of a build with the same inputs from the artifact store, False when it has none"""
+        latest = {}
+        for row in self.store.find(key=key, pkgtype=self.conf['pkgtype']):
+            latest.setdefault(row['pkgname'], row)
+        if not all(name in latest for name in self.pkgnames):
+            return False
+        self.restored([self.store.get(latest[name]['digest'], self.outdir) for name in self.pkgnames],
+                      'the artifact store')
+        return True
+
+    def restored(self, artifacts, origin):
+        """Use packages taken from origin instead of packaging"""
+        for artifact in artifacts:
+            # Same format as fpm, remote builds pick it up
+            self.log('Restored package {:path=>"%s"} from %s' % (artifact, origin))
+            self.job.event('artifact', pkgname=self.conf['pkgname'], path=artifact)
+        self.artifacts.extend(artifacts)
+        if self.conf['delta'] and not isinstance(self.conf['pkgname'], (list, tuple)):
+            for artifact in artifacts:
+                self.delta(artifact)
+        if self.store is not None and len(artifacts) == len(self.pkgnames):
+            # Packages are in pkgname order
+            for name, artifact in zip(self.pkgnames, artifacts):
+                self.stored(self.keep, artifact, name)
+
+    def stored(self, action, *args):
+        """Run an artifact store action, a broken store only costs a warning"""
+        from .artifacts import STORE_ERRORS
+        try:
+            return action(*args)
+        except STORE_ERRORS as exc:
+            self.log('Artifact store unavailable: %s' % exc)
+            return None
+
+    def keep(self, artifact, pkgname=None):
+        """Add a package to the artifact store and apply the retention settings"""
+        self.store.add(
+            artifact,
+            pkgname=pkgname or self.conf['pkgname'],
+            pkgver=self.conf['pkgver'],
+            pkgrel=self.conf['pkgrel'],
+            arch=self.arch,
+            key=self.package_key,
+        )
+        if self.conf['artifact_keep'] is not None or self.conf['artifact_max_bytes'] is not None:
+            removed = self.store.prune(keep=self.conf['artifact_keep'], max_bytes=self.conf['artifact_max_bytes'])
+            if removed:
+                self.log('Evicted from the artifact store: %s' % ', '.join(removed))
+
+    def package(self):
+        """Package stages, from the package script to the package file"""
         if self.conf['package']:
-            print 'Running package...'
+            self.stage('package', 'Running package for %s...' % self.conf['pkgname'])
             produce_and_run_script(
                 self.conf['package'],
                 os.path.join(self.scriptdir, 'package'),
                 context=self.conf,
                 workdir=self.startdir,
+                root=self.root,
+                job=self.job,
+            )
+
+        if self.conf['optimize']:
+            self.stage('optimize')
+            optimize(
+                self.pkgdir,
+                exclude_patterns=self.conf['optimize_exclude'],
+                bytecode=self.conf['optimize_bytecode'],
+                strip_elf='!strip' not in self.conf['options'],
+                conffiles=self.conf['backup'],
+                job=self.job,
             )
 
-        print 'Generating install hooks...'
+        self.stage('hooks', 'Generating install hooks...')
         if self.conf['install']:
             raise NotImplementedError('Meh')
         else:
@@ -129,58 +456,326 @@ class BasePackager(object):
                         context=self.conf,
                     )
 
-        print self.fpm()
+        if self.conf['reproducible']:
+            epoch = source_date_epoch(self.conf)
+            normalize_tree(self.pkgdir, epoch)
+            normalize_tree(self.scriptdir, epoch)
+
+        self.log(self.fpm())
+
+        if self.conf['delta']:
+            self.delta(self.artifacts[-1])
+        if self.store is not None:
+            self.stored(self.keep, self.artifacts[-1])
+
+    def package_split(self):
+        """Package each split package from its own pkgdir, in parallel"""
+        self.end_stage()
+        self.subpackagers = [self.subpackager(name) for name in self.conf['pkgname']]
+
+        def package(packager):
+            try:
+                packager.package()
+            finally:
+                packager.end_stage()
+        pool = ThreadPool(len(self.subpackagers))
+        try:
+            pool.map(package, self.subpackagers)
+        finally:
+            pool.close()
+            pool.join()
+        for packager in self.subpackagers:
+            self.artifacts.extend(packager.artifacts)
+
+    def subpackager(self, name):
+        """Packager of the split package name, package_<name> is its script or a dict of overrides with a script"""
+        overrides = self.conf.get('package_%s' % name)
+        if not isinstance(overrides, dict):
+            overrides = {'script': overrides}
+        packager = copy(self)
+        packager.conf = dict(self.conf)
+        packager.conf.update((key, value) for key, value in overrides.items() if key != 'script')
+        packager.conf['pkgname'] = name
+        packager.conf['package'] = overrides.get('script') or self.conf['package']
+        packager.conf['pkgdir'] = os.path.join(self.conf['pkgdir'], name)
+        if 'backup' in overrides:
+            packager.conf['backup'] = [render(template, packager.conf) for template in packager.conf['backup']]
+        packager.pkgdir = os.path.join(self.pkgdir, name)
+        packager.scriptdir = os.path.join(self.scriptdir, name)
+        packager.outdir = self.outdir
+        packager.artifacts = []
+        packager.subpackagers = []
+        packager.current_stage = None
+        mkdir_p(packager.pkgdir)
+        mkdir_p(packager.scriptdir)
+        return packager
+
+    @property
+    def workspace_key(self):
+        return hashlib.sha256(self.startdir).hexdigest()
+
+    def place_workspace(self):
+        """Move the relative work dirs to scratch when the build should fit there, returns the workspace"""
+        if not self.conf['workspace']:
+            return None
+        scratch = scratch_dir(self.conf['workspace'])
+        if scratch is None:
+            self.log('No scratch directory for workspace %s, building on disk' % self.conf['workspace'])
+            return None
+        needed = self.conf['workspace_size']
+        if needed is None:
+            paths = []
+            for location in (sources.location(source) for source in self.conf['source']):
+                if sources.is_local(location):
+                    paths.extend(os.path.join(self.startdir, path) for path in sources.expand(location, self.startdir))
+                else:
+                    paths.append(sources.cached(location))
+            # Remote sources that were never fetched have no known size
+            needed = workspace_estimate(self.workspace_key, None if None in paths else paths)
+        if needed is None:
+            self.log('Size of the workspace unknown until a build succeeded or workspace_size is set, building on disk')
+            return None
+        if not workspace_fits(scratch, needed):
+            self.log('Workspace needs about %d bytes, more than %s has free, building on disk' % (needed, scratch))
+            return None
+
+        workspace = workspace_path(scratch, self.startdir)
+        self.log('Workspace in %s (about %d bytes)' % (workspace, needed))
+        # Packages still go to the pkgdir on disk
+        self.outdir = self.pkgdir
+        for name in ('srcdir', 'pkgdir', 'scriptdir'):
+            if not os.path.isabs(self.conf[name]):
+                path = os.path.join(workspace, self.conf[name])
+                setattr(self, name, path)
+                self.conf[name] = path
+        return workspace
 
     def clean(self):
-        rm_rf(self.srcdir)
+        if self.outdir != self.pkgdir:
+            # Previous packages next to the PKGBUILD
+            mkdir_p(self.outdir)
+            for name in os.listdir(self.outdir):
+                if PACKAGE_FILES.search(name):
+                    os.remove(os.path.join(self.outdir, name))
+        if not self.conf['reuse_workspace']:
+            rm_rf_async(self.srcdir)
+        # Always from scratch, files an older package() installed would end up in the new package
+        rm_rf_async(self.pkgdir)
+        rm_rf_async(self.scriptdir)
         mkdir_p(self.srcdir)
-        rm_rf(self.pkgdir)
         mkdir_p(self.pkgdir)
-        rm_rf(self.scriptdir)
         mkdir_p(self.scriptdir)
 
+    def pkgver(self):
+        """pkgver_fcn output, cached by script and source digests for pkgver_ttl seconds"""
+        destination = os.path.join(self.scriptdir, 'pkgver_fcn')
+        script = produce_script(self.conf['pkgver_fcn'], destination, context=self.conf)
+        key = hashlib.sha256('%s\0%s' % (script, tree_digest(self.srcdir, self.source_files))).hexdigest()
+        # Offline builds take the last value whatever the sources
+        last_key = hashlib.sha256(self.conf['pkgbase']).hexdigest()
+
+        pkgver = cache_get('pkgver', key, ttl=self.conf['pkgver_ttl'])
+        if pkgver is not None:
+            self.count('pkgver_cache_hit')
+            self.log('Using cached pkgver %s' % pkgver)
+            return pkgver
+        self.count('pkgver_cache_miss')
+        if self.conf['offline']:
+            pkgver = cache_get('pkgver', key) or cache_get('pkgver', last_key)
+            if pkgver is None:
+                raise RuntimeError('Offline and no pkgver known for %s' % self.conf['pkgbase'])
+            self.log('Offline, using last known pkgver %s' % pkgver)
+            return pkgver
+
+        try:
+            pkgver = run_script(destination, workdir=self.srcdir, root=self.root, job=self.job)
+        except subprocess.CalledProcessError:
+            pkgver = cache_get('pkgver', key) or cache_get('pkgver', last_key)
+            if pkgver is None:
+                raise
+            self.log('pkgver_fcn failed, using last known pkgver %s' % pkgver)
+            return pkgver
+        cache_set('pkgver', key, pkgver)
+        cache_set('pkgver', last_key, pkgver)
+        return pkgver
+
     def get_makedepends(self):
-        print 'Running makedepends...'
+        self.stage('makedepends')
         if self.conf['makedepends']:
-            self.makepkgman.install(self.conf['makedepends'])
+            self.makepkgman.install(
+                self.conf['makedepends'], root=self.root, offline=self.conf['offline'], job=self.job)
+
+    def get_checkdepends(self):
+        # Only needed when there is a check to run
+        if self.conf['check'] and self.conf['checkdepends']:
+            self.stage('checkdepends')
+            self.makepkgman.install(
+                self.conf['checkdepends'], root=self.root, offline=self.conf['offline'], job=self.job)
 
     def apply_context(self):
-        self.conf['source'] = [Template(source).render(**self.conf) for source in self.conf['source']]
-        self.conf['noextract'] = [Template(noextract).render(**self.conf) for noextract in self.conf['noextract']]
-        self.conf['template'] = [Template(template).render(**self.conf) for template in self.conf['template']]
-        self.conf['backup'] = [Template(template).render(**self.conf) for template in self.conf['backup']]
-        self.conf['changelog'] = Template(self.conf['changelog']).render(**self.conf)
+        self.conf['source'] = [self.render_source(source) for source in self.conf['source']]
+        self.conf['noextract'] = [render(noextract, self.conf) for noextract in self.conf['noextract']]
+        self.conf['template'] = [render(template, self.conf) for template in self.conf['template']]
+        self.conf['backup'] = [render(template, self.conf) for template in self.conf['backup']]
+        if self.conf['changelog']:
+            self.conf['changelog'] = render(self.conf['changelog'], self.conf)
+
+    def render_source(self, source):
+        if isinstance(source, dict):
+            # Location with extraction filters
+            source = dict(source)
+            source['url'] = self.render_source(source['url'])
+            for key in ('include', 'exclude'):
+                source[key] = [render(pattern, self.conf) for pattern in source.get(key, ())]
+            return source
+        if isinstance(source, (list, tuple)):
+            # Mirrors of the same file
+            return [render(mirror, self.conf) for mirror in source]
+        return render(source, self.conf)
 
     def get_sources(self):
-        print 'Running sources...'
-
-        # for hashname in ('md5', 'sha1', 'sha256', 'sha384', 'sha512'):
-        #    if self.conf['%ssums' % hashname]:
-        #        hashes = self.conf['%ssums' % hashname]
-        #        break
-        # else:
-        #    pass
-        #    # TODO raise error
-
-        for source in self.conf['source']:
-            filename = sources.get_url(source, self.srcdir)
-            # TODO
-            # sources.check(filename, hashes[i], hashname)
-            if source not in self.conf['noextract']:
-                sources.extract(os.path.join(self.srcdir, filename), self.srcdir)
-
-            if source in self.conf['template']:
-                with open(os.path.join(self.srcdir, filename), 'r') as fd:
-                    template = fd.read()
-                template = Template(template).render(**self.conf)
-                with open(os.path.join(self.srcdir, filename), 'w') as fd:
-                    fd.write(template)
+        self.stage('sources')
+
+        hashname, sums = sources.integrity(self.conf)
+        if self.conf['skipinteg']:
+            sums = ()
+
+        locations = [sources.location(source) for source in self.conf['source']]
+        local = dict((location, sources.expand(location, self.startdir))
+                     for location in locations if sources.is_local(location))
+        sources.stage(
+            sorted(set(filename for filenames in local.values() for filename in filenames)),
+            self.srcdir,
+            hardlink=self.conf['source_hardlink'],
+            root=self.startdir,
+        )
+
+        noextract = sources.matcher(self.conf['noextract'])
+        template = sources.matcher(self.conf['template'])
+        self.source_files = []
+        for i, source in enumerate(self.conf['source']):
+            hashvalue = sums[i] if sums else None
+            location = locations[i]
+            if sources.is_local(location):
+                filenames = local[location]
+                if hashvalue is not None and hashvalue != 'SKIP':
+                    if filenames != [location]:
+                        raise ValueError('Directory and glob source %s can only be checked with SKIP' % location)
+                    sources.check(os.path.join(self.startdir, location), hashvalue, hashname)
+            else:
+                hit = sources.cached(location) is not None
+                started = time.time()
+                filenames = [sources.get_url(
+                    location,
+                    self.srcdir,
+                    hashvalue=hashvalue,
+                    hashname=hashname,
+                    offline=self.conf['offline'],
+                    hardlink=self.conf['source_hardlink'],
+                    job=self.job,
+                )]
+                self.count('source_cache_%s' % ('hit' if hit else 'miss'))
+                if not hit:
+                    self.count('download_bytes', os.path.getsize(os.path.join(self.srcdir, filenames[0])))
+                    self.count('download_seconds', time.time() - started)
+            include, exclude = sources.filters(source)
+            for filename in filenames:
+                self.source_files.append(filename)
+                names = (filename, location)
+                path = os.path.join(self.srcdir, filename)
+                if not any(noextract(name) for name in names):
+                    sources.extract(path, self.srcdir, include=include, exclude=exclude, job=self.job)
+                if any(template(name) for name in names):
+                    self.render_template(path)
+        self.prune_sources()
+
+    def prune_sources(self):
+        """Remove the sources a reused srcdir has from builds that had them, record the current ones"""
+        manifest = os.path.join(self.srcdir, SOURCES_MANIFEST)
+        if self.conf['reuse_workspace']:
+            try:
+                with open(manifest) as fd:
+                    previous = json.load(fd)
+            except (IOError, ValueError):
+                previous = []
+            for filename in set(previous) - set(self.source_files):
+                path = os.path.join(self.srcdir, filename)
+                # Absolute local sources are used where they are
+                if sources.is_within_directory(self.srcdir, path) and os.path.lexists(path):
+                    self.log('Removing %s, no longer a source' % filename)
+                    if os.path.isdir(path) and not os.path.islink(path):
+                        rm_rf(path)
+                    else:
+                        os.remove(path)
+        with open(manifest, 'w') as fd:
+            json.dump(sorted(self.source_files), fd)
+
+    def render_template(self, path):
+        """Render a template source in srcdir, replaced so a hardlinked original is left alone"""
+        with open(path, 'r') as fd:
+            template = fd.read()
+        tmp = '%s.empkg-tmp' % path
+        with open(tmp, 'w') as fd:
+            fd.write(render(template, self.conf))
+        shutil.copymode(path, tmp)
+        os.rename(tmp, path)
 
     def fpm(self):
-        print 'Running fpm...'
+        self.stage('fpm')
         cmd = self.get_fpm_cmd()
-        fpm_output = run_script(cmd, self.pkgdir)
-        return os.path.basename(fpm_output.split('"')[-2])
+        fpm_output = run_script(cmd, self.pkgdir, job=self.job)
+        artifact = os.path.basename(fpm_output.split('"')[-2])
+        if self.conf['delta']:
+            artifact = os.path.basename(compress_package(os.path.join(self.outdir, artifact)))
+            # Same format as fpm, remote builds download this one instead of fpm's
+            self.log('Compressed package {:path=>"%s"}' % os.path.join(self.outdir, artifact))
+        self.artifacts.append(os.path.join(self.outdir, artifact))
+        self.job.event('artifact', pkgname=self.conf['pkgname'], path=self.artifacts[-1])
+        return artifact
+
+    def delta(self, artifact):
+        """Delta from the previous package in the artifact store, or artifactdir where this one is kept"""
+        self.stage('delta')
+        pkgtype = package_type(artifact)
+        if self.store is not None:
+            # A copy of the previous version for the delta, this one is stored once packaged
+            tmpdir = tempfile.mkdtemp(prefix='.empkg-delta-', dir=os.path.dirname(artifact))
+            try:
+                self.make_delta(self.stored(self.previous_stored, artifact, pkgtype, tmpdir), artifact)
+            finally:
+                rm_rf(tmpdir)
+            return
+
+        store = os.path.join(self.conf['artifactdir'] or cache_dir('artifacts'), self.conf['pkgname'])
+        mkdir_p(store)
+        previous = [os.path.join(store, name) for name in os.listdir(store) if package_type(name) == pkgtype]
+        self.make_delta(max(previous, key=os.path.getmtime) if previous else None, artifact)
+
+        dest = os.path.join(store, os.path.basename(artifact))
+        if os.path.exists(dest):
+            os.remove(dest)
+        shutil.copy2(artifact, dest)
+        # Only the latest is needed for the next delta
+        kept = sorted(set(previous + [dest]), key=os.path.getmtime, reverse=True)
+        for path in kept[self.conf['artifact_keep'] or 1:]:
+            if path != dest:
+                os.remove(path)
+
+    def previous_stored(self, artifact, pkgtype, directory):
+        """Latest other stored package of this pkgname, fetched into directory"""
+        digest = file_digest(artifact)
+        for row in self.store.find(pkgname=self.conf['pkgname'], pkgtype=pkgtype):
+            if row['digest'] != digest:
+                return self.store.get(row['digest'], directory)
+        return None
+
+    def make_delta(self, previous, artifact):
+        if previous is None:
+            self.log('No previous %s package to make a delta from' % self.conf['pkgname'])
+            return
+        size = make_delta(previous, artifact, artifact + '.delta')
+        self.log('Delta from %s is %d bytes, %.1f%% of the package' % (
+            os.path.basename(previous), size, 100.0 * size / max(os.path.getsize(artifact), 1)))
 
     def get_fpm_cmd(self):
         context = {}
@@ -196,10 +791,15 @@ class BasePackager(object):
             'url': self.url,
             'vendor': self.vendor,
             'paths': '*',
+            'compression': self.compression,
+            'output': self.output,
+            'environment': self.environment,
+            'reproducible': self.reproducible,
 
         })
 
-        cmd = ('fpm '
+        cmd = ('{environment}'
+               'fpm '
                '-s dir '
                '-t {pkgtype} '
                '-n {pkgname} '
@@ -208,6 +808,9 @@ class BasePackager(object):
                '--description "{pkgdesc}" '
                '-x "**/*.bak" -x "**/*.orig" -x "**/.git*" -x "**/.hg*" '
                '{backup} '
+               '{compression} '
+               '{output} '
+               '{reproducible} '
                '{changelog} '
                '{depends} '
                '{hooks} '
@@ -221,15 +824,34 @@ class BasePackager(object):
 
     @property
     def arch(self):
-        if self.conf['arch'] == 'any' and self.conf['pkgtype'] == 'deb':
-            return 'all'
-        else:
-            return self.conf['arch']
+        return package_arch(self.conf)
 
     @property
     def backup(self):
         return '--config-files ' + ' --config-files '.join(self.conf['backup']) if self.conf['backup'] else ''
 
+    @property
+    def compression(self):
+        # compress_package compresses the payload once fpm is done, in a way delta.apply_delta can repeat
+        if self.conf['delta'] and self.conf['pkgtype'] in ('deb', 'pacman'):
+            return '--%s-compression none' % self.conf['pkgtype']
+        return ''
+
+    @property
+    def environment(self):
+        return 'SOURCE_DATE_EPOCH=%d ' % source_date_epoch(self.conf) if self.conf['reproducible'] else ''
+
+    @property
+    def reproducible(self):
+        if not self.conf['reproducible']:
+            return ''
+        return '--source-date-epoch-default %d --%s-user root --%s-group root' % (
+            source_date_epoch(self.conf), self.conf['pkgtype'], self.conf['pkgtype'])
+
+    @property
+    def output(self):
+        return '-p %s' % self.outdir if self.outdir != self.pkgdir else ''
+
     @property
     def changelog(self):
         return '--%s-changelog %s' % (self.conf['pkgtype'], self.conf['changelog']) if self.conf['changelog'] else ''
@@ -1,38 +1,206 @@
+import json
+import os
+import pipes
+import re
 import subprocess
 
+from .util import cache_dir, default_job
+
+
+SHOWPKG_SECTIONS = ('Versions:', 'Reverse Depends:', 'Dependencies:', 'Provides:', 'Reverse Provides:')
+
+
+def package_name(package):
+    """Package name without a version constraint, None if it has one"""
+    name = re.split(r'[<>=]', package, 1)[0]
+    return name if name == package else None
+
+
+def parse_reverse_provides(out):
+    """{virtual package: names of the packages providing it} from apt-cache showpkg output"""
+    providers = {}
+    package = None
+    section = None
+    for line in out.splitlines():
+        if line.startswith('Package: '):
+            package = line.split(':', 1)[1].strip()
+            providers[package] = set()
+        elif line.rstrip() in SHOWPKG_SECTIONS:
+            section = line.rstrip()
+        elif section == 'Reverse Provides:' and package is not None and line.strip():
+            providers[package].add(line.split()[0])
+    return providers
+
 
 class BasePackageManger(object):
+    install_cmd = None
+    # argv to query installed state, package names are appended
+    query_cmd = None
+    # Files/dirs whose mtime changes when packages are installed or removed
+    db_paths = ()
+
+    @classmethod
+    def install(cls, packages, root=None, offline=False, job=None):
+        """Install the packages that are not installed yet in one transaction
+
+        With a build root they are installed in it instead of the host,
+        offline missing packages are an error
+        """
+        if job is None:
+            job = default_job
+        missing = cls.missing(packages, root=root)
+        if not missing:
+            job.output('All dependencies installed')
+            return
+        if offline:
+            raise RuntimeError('Offline and not installed: %s' % ' '.join(missing))
+        cmd = cls.install_cmd % ' '.join(missing)
+        if root is not None:
+            # Already root in the build namespace
+            cmd = root.wrap(re.sub(r'^sudo ', '', cmd))
+        # The package manager may prompt, it keeps the terminal
+        ret = subprocess.call(cmd, shell=True)
+        if ret:
+            raise subprocess.CalledProcessError(ret, cmd)
+
+    @classmethod
+    def missing(cls, packages, root=None):
+        """Packages not installed, versioned dependencies are always left to the package manager"""
+        # Build roots are short lived, only the host state is cached
+        mtime = cls.db_mtime() if root is None else None
+        cache = cls.load_cache(mtime)
+        unknown = [name for name in map(package_name, packages) if name and name not in cache]
+        if unknown:
+            found = cls.installed(unknown, root=root)
+            # Virtual packages and other names an installed package provides
+            found |= cls.provided(sorted(set(unknown) - found), root=root)
+            cache.update(found)
+            cls.save_cache(mtime, cache)
+        return [package for package in packages if package_name(package) not in cache]
+
+    @classmethod
+    def installed(cls, names, root=None):
+        """Installed subset of names, queried with a single package manager call"""
+        _, out = cls.query(cls.query_cmd + list(names), root=root)
+        # Not found packages make the query fail, parse whatever was found
+        return cls.parse_query(out) & set(names)
+
+    @classmethod
+    def provided(cls, names, root=None):
+        """Subset of names provided by installed packages under another name"""
+        return set()
+
     @classmethod
-    def install(cls, packages):
+    def query(cls, cmd, root=None):
+        """Run a query argv on the host or in the build root, returns (status, stdout), (None, '') without the tool"""
+        if root is not None:
+            cmd = root.wrap(' '.join(pipes.quote(arg) for arg in cmd))
+        try:
+            proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, shell=root is not None)
+        except OSError:
+            return None, ''
+        out, _ = proc.communicate()
+        return proc.returncode, out
+
+    @classmethod
+    def parse_query(cls, out):
         raise NotImplementedError()
 
+    @classmethod
+    def db_mtime(cls):
+        mtimes = [os.stat(path).st_mtime for path in cls.db_paths if os.path.exists(path)]
+        return max(mtimes) if mtimes else None
+
+    @classmethod
+    def cache_file(cls):
+        return os.path.join(cache_dir('pkgmanagers'), '%s.json' % cls.__name__.lower())
+
+    @classmethod
+    def load_cache(cls, mtime):
+        if mtime is None:
+            return set()
+        try:
+            with open(cls.cache_file()) as fd:
+                cache = json.load(fd)
+        except (IOError, ValueError):
+            return set()
+        if cache.get('mtime') != mtime:
+            return set()
+        return set(cache['installed'])
+
+    @classmethod
+    def save_cache(cls, mtime, installed):
+        if mtime is None:
+            return
+        tmp = '%s.%d' % (cls.cache_file(), os.getpid())
+        with open(tmp, 'w') as fd:
+            json.dump({'mtime': mtime, 'installed': sorted(installed)}, fd)
+        os.rename(tmp, cls.cache_file())
+
 
 class Pacman(BasePackageManger):
     # TODO uncomment
     # install_cmd = 'sudo pacman -Sq --noconfirm %s'
     install_cmd = 'sudo pacman -Sq %s'
+    query_cmd = ['pacman', '-Q']
+    db_paths = ('/var/lib/pacman/local', )
+
+    @classmethod
+    def parse_query(cls, out):
+        return set(line.split()[0] for line in out.splitlines() if line.strip())
 
     @classmethod
-    def install(cls, packages):
-        cmd = cls.install_cmd % ' '.join(packages)
-        subprocess.call(cmd, shell=True)
+    def provided(cls, names, root=None):
+        if not names:
+            return set()
+        # -T prints the dependencies installed packages don't satisfy, provides included
+        status, out = cls.query(['pacman', '-T'] + list(names), root=root)
+        if status is None:
+            return set()
+        return set(names) - set(line.strip() for line in out.splitlines())
 
     # TODO set packager https://wiki.archlinux.org/index.php/makepkg#Packager_information
 
 
 class AptGet(BasePackageManger):
     install_cmd = 'sudo apt-get install -qq %s'
+    query_cmd = ['dpkg-query', '-W', '-f', '${Package} ${db:Status-Abbrev}\\n']
+    db_paths = ('/var/lib/dpkg/status', )
 
     @classmethod
-    def install(cls, packages):
-        cmd = cls.install_cmd % ' '.join(packages)
-        subprocess.call(cmd, shell=True)
+    def parse_query(cls, out):
+        installed = set()
+        for line in out.splitlines():
+            fields = line.split()
+            if len(fields) == 2 and fields[1].startswith('ii'):
+                installed.add(fields[0])
+        return installed
+
+    @classmethod
+    def provided(cls, names, root=None):
+        if not names:
+            return set()
+        _, out = cls.query(['apt-cache', 'showpkg'] + list(names), root=root)
+        providers = parse_reverse_provides(out)
+        installed = cls.installed(sorted(set.union(set(), *providers.values())), root=root)
+        return set(name for name in names if providers.get(name, set()) & installed)
 
 
 class Yum(BasePackageManger):
     install_cmd = 'sudo yum install -y -q %s'
+    query_cmd = ['rpm', '-q', '--qf', '%{NAME}\\n']
+    db_paths = (
+        '/var/lib/rpm/Packages',
+        '/var/lib/rpm/rpmdb.sqlite',
+        '/usr/lib/sysimage/rpm/rpmdb.sqlite',
+    )
+
+    @classmethod
+    def parse_query(cls, out):
+        # Missing packages are reported on stdout as "package foo is not installed"
+        return set(line.strip() for line in out.splitlines() if ' ' not in line.strip())
 
     @classmethod
-    def install(cls, packages):
-        cmd = cls.install_cmd % ' '.join(packages)
-        subprocess.call(cmd, shell=True)
+    def provided(cls, names, root=None):
+        # One query per name, the output doesn't tell which capability a package was listed for
+        return set(name for name in names if cls.query(['rpm', '-q', '--whatprovides', name], root=root)[0] == 0)
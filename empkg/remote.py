@@ -0,0 +1,287 @@
+"""
+Remote builds over SSH
+Kept apart from __main__ so the Fabric/paramiko stack is only loaded when a
+build is sent to a --target
+"""
+import os
+import re
+import tarfile
+import uuid
+
+from fabric.api import (
+    env,
+    execute,
+    get,
+    hide,
+    parallel,
+    run,
+    settings,
+    sudo,
+)
+from fabric.contrib.files import exists
+from fabric.state import connections
+from fabric.utils import abort
+
+from .artifacts import STORE_ERRORS, open_store
+from .packagers import package_arch
+from .util import Background, default_job, get_pkgman_class, get_pkgman, get_pkgtype
+
+# Every build gets its own workdir, a held lock in it marks a running build
+WORKDIR_PREFIX = '/tmp/empkg-build-'
+LOCK = '.empkg.lock'
+PROBE_CMD = (
+    'cat /proc/loadavg; nproc; '
+    'for lock in %s*/%s; do [ -e "$lock" ] && ! flock -n "$lock" true && echo running; done; true'
+    % (WORKDIR_PREFIX, LOCK)
+)
+
+
+PATH_PATTERN = re.compile(r':path=>"(.*?)"')
+
+
+class BuildFailed(Exception):
+    pass
+
+
+def remote_package(args, conf, job=None):
+    """Build on the current host, returns the local paths of the fetched packages
+
+    Provisioning and the upload of the build tree run at the same time over
+    separate channels of the one SSH connection, the package download starts
+    as soon as fpm reports it. Packages the artifact store has are not
+    downloaded again
+    """
+    if job is None:
+        job = default_job
+    remotedir = '%s%s-%s' % (WORKDIR_PREFIX, conf['pkgbase'], uuid.uuid4().hex[:12])
+    store = open_store(conf)
+    run('mkdir -p %s' % remotedir)
+    try:
+        upload = Background(upload_tree, remotedir, conf)
+        remote_install(args)
+        upload.join()
+
+        downloads = []
+
+        def on_line(line):
+            match = PATH_PATTERN.search(line)
+            # With delta fpm's package is compressed again, the build reports that one
+            if match and not (conf['delta'] and 'Created package' in line):
+                # Split packages report absolute paths
+                remote_path = os.path.join(remotedir, conf['pkgdir'], match.group(1))
+                local_path = os.path.basename(match.group(1))
+                downloads.append((local_path, Background(fetch_package, remote_path, local_path, store, conf, job)))
+
+        stream_run('cd %s && flock %s empkg %s' % (remotedir, LOCK, ' '.join(args)), on_line, job)
+        for _, download in downloads:
+            download.join()
+    finally:
+        run('rm -rf %s' % remotedir)
+    if not downloads:
+        abort('No package was built on %s' % env.host_string)
+    return [os.path.abspath(local_path) for local_path, _ in downloads]
+
+
+def fetch_package(remote_path, local_path, store, conf, job):
+    """Download a built package, unless the artifact store already has the same one"""
+    if store is not None:
+        channel = open_channel('sha256sum %s' % remote_path)
+        out = channel.makefile('rb').read()
+        digest = out.split()[0] if out and not channel.recv_exit_status() else None
+        try:
+            if digest and store.has(digest):
+                store.get(digest, local_path)
+                job.output('Took %s from the artifact store' % local_path)
+                return
+        except STORE_ERRORS as exc:
+            job.output('Artifact store unavailable: %s' % exc)
+    get(remote_path=remote_path, local_path=local_path)
+    if store is not None:
+        pkgname = conf['pkgname'] if not isinstance(conf['pkgname'], (list, tuple)) else None
+        try:
+            store.add(local_path, pkgname=pkgname, pkgver=conf['pkgver'], pkgrel=conf['pkgrel'], arch=package_arch(conf))
+        except STORE_ERRORS as exc:
+            job.output('Artifact store unavailable: %s' % exc)
+
+
+def open_channel(command):
+    channel = connections[env.host_string].get_transport().open_session()
+    channel.exec_command(command)
+    return channel
+
+
+def upload_tree(remotedir, conf):
+    """Stream the build tree as a tar over its own channel"""
+    # Like put('*'), without what the remote build regenerates anyway
+    skip = set(os.path.normpath(conf[name]) for name in ('srcdir', 'pkgdir', 'scriptdir')
+               if not os.path.isabs(conf[name]))
+    channel = open_channel('tar -xzf - -C %s' % remotedir)
+    stream = channel.makefile('wb')
+    with tarfile.open(fileobj=stream, mode='w|gz') as tar:
+        for name in sorted(os.listdir('.')):
+            if not name.startswith('.') and name not in skip:
+                tar.add(name)
+    stream.flush()
+    channel.shutdown_write()
+    if channel.recv_exit_status():
+        abort('Upload to %s:%s failed: %s' % (env.host_string, remotedir, channel.makefile_stderr().read()))
+
+
+def stream_run(command, on_line, job):
+    """run() that sends the output live to the job and hands each line to on_line"""
+    channel = open_channel(command)
+    channel.set_combine_stderr(True)
+    buf = ''
+    while True:
+        data = channel.recv(4096)
+        if not data:
+            break
+        lines = (buf + data).split('\n')
+        buf = lines.pop()
+        for line in lines:
+            job.output(line)
+            on_line(line)
+    if buf:
+        job.output(buf)
+        on_line(buf)
+    status = channel.recv_exit_status()
+    if status:
+        abort('%s failed on %s with status %d' % (command, env.host_string, status))
+
+
+def load_inventory(path):
+    """Builder pool: a yaml list of {host, distro, capacity}"""
+    import yaml
+    with open(path) as fd:
+        inventory = yaml.safe_load(fd)
+    for builder in inventory:
+        builder.setdefault('distro', None)
+        builder.setdefault('capacity', 1)
+    return inventory
+
+
+@parallel
+def probe_builder():
+    with settings(hide('everything'), warn_only=True):
+        out = run(PROBE_CMD)
+    if out.failed:
+        return None
+    lines = out.splitlines()
+    try:
+        return {
+            'load': float(lines[0].split()[0]),
+            'cpus': int(lines[1]),
+            'running': lines[2:].count('running'),
+        }
+    except (ValueError, IndexError):
+        # A login banner or a missing nproc, not a builder we can rank
+        return None
+
+
+def rank_builders(inventory, conf, job):
+    """Compatible reachable builders, least loaded first"""
+    builders = [builder for builder in inventory if compatible(builder, conf)]
+    if not builders:
+        return []
+    with settings(skip_bad_hosts=True):
+        probes = execute(probe_builder, hosts=[builder['host'] for builder in builders])
+
+    ranked = []
+    for builder in builders:
+        probe = probes.get(builder['host'])
+        if not probe:
+            job.output('Builder %s is unreachable' % builder['host'])
+            continue
+        job.output('Builder %s: %d/%d jobs, load %.2f on %d cpus' % (
+            builder['host'], probe['running'], builder['capacity'], probe['load'], probe['cpus']))
+        ranked.append((
+            probe['running'] >= builder['capacity'],
+            float(probe['running']) / builder['capacity'],
+            probe['load'] / max(probe['cpus'], 1),
+            builder['host'],
+        ))
+    return [rank[-1] for rank in sorted(ranked)]
+
+
+def compatible(builder, conf):
+    if not builder['distro']:
+        return True
+    if conf['pkgtype'] and get_pkgtype(builder['distro']) != conf['pkgtype']:
+        return False
+    if conf['makepkgman'] and get_pkgman(builder['distro']) != conf['makepkgman']:
+        return False
+    return True
+
+
+def pool_package(args, conf, inventory, job=None):
+    """Build on the least loaded compatible builder, moving on to the next one on failure, returns the packages"""
+    if job is None:
+        job = default_job
+    hosts = rank_builders(inventory, conf, job)
+    if not hosts:
+        raise BuildFailed('No compatible builder for %s' % conf['pkgbase'])
+    for host in hosts:
+        job.output('Building %s on %s...' % (conf['pkgbase'], host))
+        try:
+            with settings(host_string=host, abort_exception=BuildFailed):
+                return remote_package(args, conf, job)
+        except BuildFailed as exc:
+            job.output('Build on %s failed: %s' % (host, exc))
+    raise BuildFailed('%s failed on every builder' % conf['pkgbase'])
+
+
+def remote_install(args):
+    distro = remote_linux_dist()
+    depends = ()
+    if distro == 'arch':
+        # TODO if yaourt available use to install fpm?
+        # TODO arch depends
+        depends = ()
+    elif distro in ('debian', 'ubuntu'):
+        depends = (
+            'build-essential',
+            'openssl',
+            'libssl-dev',
+            'ruby',  # fpm
+            'ruby-dev',  # fpm
+            'python-pip',
+            'libyaml-dev',  # PyYAML
+            'python-dev',  # PyYAML
+        )
+    elif distro == 'centos':
+        depends = (
+            'gcc',
+            'gcc-c++',
+            'kernel-devel',
+            'openssl',
+            'openssl-devel',
+            'ruby',
+            'ruby-devel',
+            'rubygems',
+            'rpm',
+            'rpm-build',
+            'python-devel',
+            'python-pip',
+        )
+    pkgman = get_pkgman_class(get_pkgman(distro))
+    sudo(pkgman.install_cmd % ' '.join(depends))
+
+    # TODO try to update fpm?
+    out = run('gem list')
+    pattern = re.compile(r'^fpm ', re.MULTILINE)
+    if not re.search(pattern, out):
+        sudo('gem install fpm')
+
+    # TODO dev/prod mode switch
+    if any(('--dev' == arg for arg in args)):
+        sudo('pip install -U --force-reinstall --no-deps empkg')
+    else:
+        sudo('pip install -U empkg')
+
+
+def remote_linux_dist():
+    out = eval(run('python -c "import platform; print(platform.linux_distribution())"', shell=True))
+    if not out[0]:
+        if exists('/etc/arch-release'):
+            return 'arch'
+    return out[0].lower()
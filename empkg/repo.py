@@ -0,0 +1,407 @@
+"""
+Local package repositories
+A repository is a directory of packages with an index of what was published
+(name, version, arch, size, digests and control fields). Adding or removing
+packages only hashes and inspects the new files, the apt (flat Packages and
+Release), rpm (repodata) and pacman (.db) metadata is then regenerated from
+the index.
+
+    deb [trusted=yes] file:/srv/repo ./
+    baseurl=file:///srv/repo
+    [repo] Server = file:///srv/repo
+
+A new package replaces the older ones with the same name and arch in pacman
+repositories (like repo-add, a pacman db can't list a name twice). apt and yum
+keep every version unless keep bounds how many are kept.
+"""
+import gzip
+import hashlib
+import json
+import os
+import re
+import shutil
+import subprocess
+import tarfile
+import time
+from cStringIO import StringIO
+from xml.sax.saxutils import escape, quoteattr
+
+from .util import default_job
+
+INDEX = 'empkg-index.json'
+HASHES = ('md5', 'sha1', 'sha256')
+PACKAGE_TYPES = (
+    ('deb', re.compile(r'\.deb$')),
+    ('rpm', re.compile(r'\.rpm$')),
+    ('pacman', re.compile(r'\.pkg\.tar(\.\w+)?$')),
+)
+
+RPM_QUERYFORMAT = '\\n'.join((
+    '%{NAME}',
+    '%{EPOCHNUM}',
+    '%{VERSION}',
+    '%{RELEASE}',
+    '%{ARCH}',
+    '%{SUMMARY}',
+    '%{URL}',
+    '%{LICENSE}',
+    '%{VENDOR}',
+    '%{PACKAGER}',
+    '%{GROUP}',
+    '%{BUILDHOST}',
+    '%{SOURCERPM}',
+    '%{BUILDTIME}',
+    '%{SIZE}',
+    '[%{REQUIRENAME}\\t]',
+    '[%{PROVIDENAME}\\t]',
+    '%{DESCRIPTION}',
+))
+RPM_FIELDS = (
+    'name', 'epoch', 'version', 'release', 'arch', 'summary', 'url', 'license', 'vendor', 'packager', 'group',
+    'buildhost', 'sourcerpm', 'buildtime', 'installed_size', 'requires', 'provides', 'description',
+)
+
+# .PKGINFO keys that can appear more than once and their desc names
+PACMAN_LISTS = {
+    'license': 'LICENSE',
+    'group': 'GROUPS',
+    'depend': 'DEPENDS',
+    'optdepend': 'OPTDEPENDS',
+    'makedepend': 'MAKEDEPENDS',
+    'checkdepend': 'CHECKDEPENDS',
+    'conflict': 'CONFLICTS',
+    'provides': 'PROVIDES',
+    'replaces': 'REPLACES',
+}
+PACMAN_FIELDS = (
+    ('pkgbase', 'BASE'),
+    ('pkgdesc', 'DESC'),
+    ('url', 'URL'),
+    ('arch', 'ARCH'),
+    ('builddate', 'BUILDDATE'),
+    ('packager', 'PACKAGER'),
+)
+
+
+def package_type(filename):
+    for pkgtype, pattern in PACKAGE_TYPES:
+        if pattern.search(filename):
+            return pkgtype
+    return None
+
+
+def digests(path, hashes=HASHES):
+    """Digests of a file, computed in one pass"""
+    hashers = [hashlib.new(name) for name in hashes]
+    with open(path, 'rb') as fd:
+        while True:
+            data = fd.read(1024 * 1024)
+            if not data:
+                break
+            for hasher in hashers:
+                hasher.update(data)
+    return dict((name, hasher.hexdigest()) for name, hasher in zip(hashes, hashers))
+
+
+def parse_control(text):
+    """deb control paragraph as an ordered list of [field, value]"""
+    fields = []
+    for line in text.splitlines():
+        if line[:1] in (' ', '\t') and fields:
+            fields[-1][1] += '\n' + line
+        elif ':' in line:
+            key, value = line.split(':', 1)
+            fields.append([key, value.strip()])
+    return fields
+
+
+def inspect_deb(path):
+    fields = parse_control(subprocess.check_output(['dpkg-deb', '-f', path]))
+    control = dict(fields)
+    return {
+        'name': control['Package'],
+        'version': control['Version'],
+        'arch': control.get('Architecture'),
+        'fields': fields,
+    }
+
+
+def inspect_rpm(path):
+    out = subprocess.check_output(['rpm', '-qp', '--nosignature', '--qf', RPM_QUERYFORMAT, path])
+    fields = dict(zip(RPM_FIELDS, out.split('\n', len(RPM_FIELDS) - 1)))
+    for key in ('requires', 'provides'):
+        fields[key] = [value for value in fields[key].split('\t') if value and not value.startswith('rpmlib(')]
+    version = '%s-%s' % (fields['version'], fields['release'])
+    if fields['epoch'] != '0':
+        version = '%s:%s' % (fields['epoch'], version)
+    return {
+        'name': fields['name'],
+        'version': version,
+        'arch': fields['arch'],
+        'fields': fields,
+    }
+
+
+def inspect_pacman(path):
+    info = subprocess.check_output(['tar', '-xOf', path, '.PKGINFO'])
+    fields = {}
+    for line in info.splitlines():
+        if ' = ' not in line or line.startswith('#'):
+            continue
+        key, value = line.split(' = ', 1)
+        if key in PACMAN_LISTS:
+            fields.setdefault(key, []).append(value)
+        else:
+            fields[key] = value
+    return {
+        'name': fields['pkgname'],
+        'version': fields['pkgver'],
+        'arch': fields.get('arch'),
+        'fields': fields,
+    }
+
+
+def gzip_bytes(data):
+    buf = StringIO()
+    # Fixed mtime so unchanged metadata compresses to the same bytes
+    with gzip.GzipFile(fileobj=buf, mode='wb', mtime=0) as fd:
+        fd.write(data)
+    return buf.getvalue()
+
+
+def write_atomic(path, data):
+    tmp = '%s.%d' % (path, os.getpid())
+    with open(tmp, 'wb') as fd:
+        fd.write(data)
+    os.rename(tmp, path)
+
+
+class Repository(object):
+    def __init__(self, path, name=None, keep=None, job=None):
+        self.path = os.path.abspath(path)
+        self.name = name or os.path.basename(self.path)
+        # Versions of each name and arch kept in apt and yum repositories, all of them when None
+        self.keep = keep
+        self.job = job if job is not None else default_job
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+        self.index_file = os.path.join(self.path, INDEX)
+        try:
+            with open(self.index_file) as fd:
+                self.packages = json.load(fd)['packages']
+        except IOError:
+            self.packages = {}
+        # Package types whose metadata must be regenerated
+        self.dirty = set()
+
+    def add(self, paths):
+        """Copy packages into the repository and index them"""
+        for path in paths:
+            filename = os.path.basename(path)
+            dest = os.path.join(self.path, filename)
+            if os.path.abspath(path) != dest:
+                if os.path.exists(dest):
+                    os.remove(dest)
+                try:
+                    os.link(path, dest)
+                except OSError:
+                    shutil.copy2(path, dest)
+            self.index(filename)
+        self.supersede()
+        self.publish()
+
+    def remove(self, names):
+        """Remove packages by file name or package name"""
+        for filename, entry in self.packages.items():
+            if filename in names or entry['name'] in names:
+                self.drop(filename)
+        self.publish()
+
+    def drop(self, filename):
+        entry = self.packages.pop(filename)
+        self.dirty.add(entry['type'])
+        path = os.path.join(self.path, filename)
+        if os.path.exists(path):
+            os.remove(path)
+
+    def supersede(self):
+        """Drop the older versions of each (type, name, arch) past what the repository keeps"""
+        versions = {}
+        for filename, entry in self.packages.items():
+            versions.setdefault((entry['type'], entry['name'], entry['arch']), []).append(entry)
+        for (pkgtype, name, arch), entries in sorted(versions.items()):
+            keep = 1 if pkgtype == 'pacman' else self.keep
+            if keep is None or len(entries) <= keep:
+                continue
+            # Most recently added first, entries indexed before 'added' existed go by their mtime
+            entries.sort(key=lambda entry: (entry.get('added', entry['mtime']), entry['filename']), reverse=True)
+            for entry in entries[keep:]:
+                self.job.output('Replacing %s with %s' % (entry['filename'], entries[0]['filename']))
+                self.drop(entry['filename'])
+
+    def update(self):
+        """Index packages copied into the directory by other means and forget deleted ones"""
+        present = set()
+        for filename in os.listdir(self.path):
+            if package_type(filename) is None:
+                continue
+            present.add(filename)
+            stat = os.stat(os.path.join(self.path, filename))
+            entry = self.packages.get(filename)
+            if entry is None or entry['size'] != stat.st_size or entry['mtime'] != stat.st_mtime:
+                self.index(filename)
+        for filename in set(self.packages) - present:
+            self.dirty.add(self.packages.pop(filename)['type'])
+        self.supersede()
+        self.publish()
+
+    def index(self, filename):
+        path = os.path.join(self.path, filename)
+        pkgtype = package_type(filename)
+        if pkgtype is None:
+            raise ValueError('Unknown package type %s' % filename)
+        self.job.output('Indexing %s...' % filename)
+        entry = globals()['inspect_%s' % pkgtype](path)
+        stat = os.stat(path)
+        entry.update({
+            'filename': filename,
+            'type': pkgtype,
+            'size': stat.st_size,
+            'mtime': stat.st_mtime,
+            'added': time.time(),
+        })
+        entry.update(digests(path))
+        self.packages[filename] = entry
+        self.dirty.add(pkgtype)
+
+    def entries(self, pkgtype):
+        return [entry for _, entry in sorted(self.packages.items()) if entry['type'] == pkgtype]
+
+    def publish(self):
+        for pkgtype in sorted(self.dirty):
+            getattr(self, 'write_%s' % pkgtype)(self.entries(pkgtype))
+        self.dirty = set()
+        write_atomic(self.index_file, json.dumps({'packages': self.packages}, indent=1, sort_keys=True))
+
+    def write_deb(self, entries):
+        paragraphs = []
+        for entry in entries:
+            fields = [field for field in entry['fields'] if field[0] not in ('Filename', 'Size')]
+            fields += [
+                ['Filename', './%s' % entry['filename']],
+                ['Size', str(entry['size'])],
+                ['MD5sum', entry['md5']],
+                ['SHA1', entry['sha1']],
+                ['SHA256', entry['sha256']],
+            ]
+            paragraphs.append(''.join('%s: %s\n' % (key, value) for key, value in fields))
+        packages = '\n'.join(paragraphs)
+        files = {'Packages': packages, 'Packages.gz': gzip_bytes(packages)}
+        for filename, data in files.items():
+            write_atomic(os.path.join(self.path, filename), data)
+
+        release = [
+            'Origin: %s' % self.name,
+            'Label: %s' % self.name,
+            'Date: %s' % time.strftime('%a, %d %b %Y %H:%M:%S UTC', time.gmtime()),
+        ]
+        for title, hashname in (('MD5Sum', 'md5'), ('SHA1', 'sha1'), ('SHA256', 'sha256')):
+            release.append('%s:' % title)
+            for filename, data in sorted(files.items()):
+                release.append(' %s %d %s' % (hashlib.new(hashname, data).hexdigest(), len(data), filename))
+        write_atomic(os.path.join(self.path, 'Release'), '\n'.join(release) + '\n')
+
+    def write_rpm(self, entries):
+        xml = [
+            '<?xml version="1.0" encoding="UTF-8"?>',
+            '<metadata xmlns="http://linux.duke.edu/metadata/common" xmlns:rpm="http://linux.duke.edu/metadata/rpm" '
+            'packages="%d">' % len(entries),
+        ]
+        for entry in entries:
+            fields = entry['fields']
+            xml += [
+                '<package type="rpm">',
+                '<name>%s</name>' % escape(fields['name']),
+                '<arch>%s</arch>' % escape(fields['arch']),
+                '<version epoch=%s ver=%s rel=%s/>' % (
+                    quoteattr(fields['epoch']), quoteattr(fields['version']), quoteattr(fields['release'])),
+                '<checksum type="sha256" pkgid="YES">%s</checksum>' % entry['sha256'],
+                '<summary>%s</summary>' % escape(fields['summary']),
+                '<description>%s</description>' % escape(fields['description']),
+                '<packager>%s</packager>' % escape(fields['packager']),
+                '<url>%s</url>' % escape(fields['url']),
+                '<time file="%d" build=%s/>' % (entry['mtime'], quoteattr(fields['buildtime'])),
+                '<size package="%d" installed=%s archive="0"/>' % (entry['size'], quoteattr(fields['installed_size'])),
+                '<location href=%s/>' % quoteattr(entry['filename']),
+                '<format>',
+                '<rpm:license>%s</rpm:license>' % escape(fields['license']),
+                '<rpm:vendor>%s</rpm:vendor>' % escape(fields['vendor']),
+                '<rpm:group>%s</rpm:group>' % escape(fields['group']),
+                '<rpm:buildhost>%s</rpm:buildhost>' % escape(fields['buildhost']),
+                '<rpm:sourcerpm>%s</rpm:sourcerpm>' % escape(fields['sourcerpm']),
+            ]
+            for key in ('provides', 'requires'):
+                if fields[key]:
+                    xml.append('<rpm:%s>' % key)
+                    xml += ['<rpm:entry name=%s/>' % quoteattr(name) for name in fields[key]]
+                    xml.append('</rpm:%s>' % key)
+            xml += ['</format>', '</package>']
+        xml.append('</metadata>')
+        primary = '\n'.join(xml) + '\n'
+        compressed = gzip_bytes(primary)
+
+        repodata = os.path.join(self.path, 'repodata')
+        if not os.path.isdir(repodata):
+            os.makedirs(repodata)
+        write_atomic(os.path.join(repodata, 'primary.xml.gz'), compressed)
+        repomd = '\n'.join((
+            '<?xml version="1.0" encoding="UTF-8"?>',
+            '<repomd xmlns="http://linux.duke.edu/metadata/repo" xmlns:rpm="http://linux.duke.edu/metadata/rpm">',
+            '<revision>%d</revision>' % time.time(),
+            '<data type="primary">',
+            '<checksum type="sha256">%s</checksum>' % hashlib.sha256(compressed).hexdigest(),
+            '<open-checksum type="sha256">%s</open-checksum>' % hashlib.sha256(primary).hexdigest(),
+            '<location href="repodata/primary.xml.gz"/>',
+            '<timestamp>%d</timestamp>' % time.time(),
+            '<size>%d</size>' % len(compressed),
+            '<open-size>%d</open-size>' % len(primary),
+            '</data>',
+            '</repomd>',
+        ))
+        write_atomic(os.path.join(repodata, 'repomd.xml'), repomd + '\n')
+
+    def write_pacman(self, entries):
+        buf = StringIO()
+        with tarfile.open(fileobj=buf, mode='w:gz') as tar:
+            for entry in entries:
+                fields = entry['fields']
+                desc = [
+                    ('FILENAME', [entry['filename']]),
+                    ('NAME', [entry['name']]),
+                    ('VERSION', [entry['version']]),
+                    ('CSIZE', [str(entry['size'])]),
+                    ('ISIZE', [fields.get('size', '0')]),
+                    ('MD5SUM', [entry['md5']]),
+                    ('SHA256SUM', [entry['sha256']]),
+                ]
+                desc += [(title, [fields[key]]) for key, title in PACMAN_FIELDS if key in fields]
+                desc += [(title, fields[key]) for key, title in sorted(PACMAN_LISTS.items()) if key in fields]
+                data = ''.join('%%%s%%\n%s\n\n' % (title, '\n'.join(values)) for title, values in desc)
+
+                dirname = '%s-%s' % (entry['name'], entry['version'])
+                info = tarfile.TarInfo(dirname)
+                info.type = tarfile.DIRTYPE
+                info.mode = 0755
+                info.mtime = entry['mtime']
+                tar.addfile(info)
+                info = tarfile.TarInfo('%s/desc' % dirname)
+                info.size = len(data)
+                info.mode = 0644
+                info.mtime = entry['mtime']
+                tar.addfile(info, StringIO(data))
+
+        filename = '%s.db.tar.gz' % self.name
+        write_atomic(os.path.join(self.path, filename), buf.getvalue())
+        link = os.path.join(self.path, '%s.db' % self.name)
+        if not os.path.lexists(link):
+            os.symlink(filename, link)
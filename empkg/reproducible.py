@@ -0,0 +1,45 @@
+"""
+Reproducible builds
+Two builds of the same inputs should give the same bytes. What the build
+environment leaks into pkgdir is normalized before fpm runs: every mtime is
+set to SOURCE_DATE_EPOCH and permissions lose the group/other write bits a
+umask may or may not have cleared. fpm gets the epoch and root ownership.
+See https://reproducible-builds.org/docs/source-date-epoch/
+"""
+import os
+import stat
+import subprocess
+
+
+def source_date_epoch(conf):
+    """The build timestamp: source_date_epoch, then $SOURCE_DATE_EPOCH, then 0"""
+    epoch = conf['source_date_epoch']
+    if epoch is None:
+        epoch = os.environ.get('SOURCE_DATE_EPOCH', 0)
+    return int(epoch)
+
+
+def walk_sorted(root):
+    """Paths under root in a stable order, parents first"""
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames.sort()
+        for name in dirnames + sorted(filenames):
+            yield os.path.join(dirpath, name)
+
+
+def normalize_tree(root, epoch):
+    """Set mtimes to epoch and drop group/other write permissions under root"""
+    links = []
+    for path in walk_sorted(root):
+        st = os.lstat(path)
+        if stat.S_ISLNK(st.st_mode):
+            links.append(path)
+            continue
+        mode = stat.S_IMODE(st.st_mode)
+        if mode & 022:
+            os.chmod(path, mode & ~022)
+        os.utime(path, (epoch, epoch))
+    os.utime(root, (epoch, epoch))
+    # No lutime in python 2
+    for i in range(0, len(links), 1000):
+        subprocess.check_call(['touch', '-h', '-d', '@%d' % epoch] + links[i:i + 1000])
@@ -0,0 +1,181 @@
+"""
+Build daemon
+`empkg serve` keeps a warm interpreter listening on a unix socket. Each
+request is read by a forked worker, so a slow client only holds up its own
+worker, which runs the command the request names with its own working
+directory. Workers tell the daemon which PKGBUILD they build and the daemon
+parses it and compiles its templates before forking the next worker: the
+daemon caches (imports, parsed PKGBUILDs, compiled templates, distro facts)
+are then inherited for free. The worker output is streamed back to the client.
+
+The daemon is single threaded: workers are forked from the accept loop, never
+while another thread could hold a lock the worker would inherit.
+"""
+import errno
+import fcntl
+import json
+import os
+import socket
+import sys
+import tempfile
+import traceback
+from SocketServer import BaseRequestHandler, ForkingMixIn, UnixStreamServer
+
+from .util import linux_dist, load_pkgbuild, warm_templates
+
+# Sent after the command output, carries the worker exit status
+EXIT_MARKER = '\0empkg-exit %d\n'
+# Seconds a client has to send its request
+REQUEST_TIMEOUT = 10
+
+
+def default_socket():
+    rundir = os.environ.get('XDG_RUNTIME_DIR') or tempfile.gettempdir()
+    return os.path.join(rundir, 'empkg-%d.sock' % os.getuid())
+
+
+class BuildHandler(BaseRequestHandler):
+    def handle(self):
+        # In the forked worker
+        connection = self.request
+        self.server.socket.close()
+        connection.settimeout(REQUEST_TIMEOUT)
+        try:
+            request = json.loads(connection.makefile('rb').readline())
+            name = request['command']
+        except (socket.error, ValueError, KeyError, TypeError):
+            return
+        connection.settimeout(None)
+        command = self.server.commands.get(name)
+        if command is None:
+            connection.sendall('Unknown command %r\n' % (name, ) + EXIT_MARKER % 2)
+            return
+        if request.get('pkgbuild'):
+            self.server.warm_later(request['pkgbuild'])
+
+        status = 1
+        try:
+            os.dup2(connection.fileno(), 1)
+            os.dup2(connection.fileno(), 2)
+            sys.stdout = os.fdopen(1, 'w', 1)
+            sys.stderr = os.fdopen(2, 'w', 1)
+            os.chdir(request['cwd'])
+            err = command(request['args'])
+            if err:
+                print err
+            status = 1 if err else 0
+        except SystemExit as exc:
+            status = exc.code if isinstance(exc.code, int) else 1
+        except BaseException:
+            traceback.print_exc()
+        finally:
+            sys.stdout.flush()
+            sys.stderr.flush()
+        connection.sendall(EXIT_MARKER % status)
+
+
+class BuildServer(ForkingMixIn, UnixStreamServer):
+    def __init__(self, path, workers, commands):
+        """commands are {name: function}, a worker calls the one its request names with the request argv"""
+        # Past it the accept loop waits for a worker to exit
+        self.max_children = workers
+        self.commands = commands
+        # Workers write the PKGBUILDs they build to it, the daemon loads them
+        self.warm_pipe = os.pipe()
+        for fd in self.warm_pipe:
+            fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+        UnixStreamServer.__init__(self, path, BuildHandler)
+
+    def warm_later(self, pkgbuild):
+        """From a worker, have the daemon load pkgbuild before it forks the next ones"""
+        try:
+            os.write(self.warm_pipe[1], pkgbuild + '\n')
+        except OSError:
+            # The daemon is behind, it warms what it already has
+            pass
+
+    def collect_children(self):
+        # Called by the accept loop before each fork
+        ForkingMixIn.collect_children(self)
+        self.warm()
+
+    def warm(self):
+        """Populate the caches with the PKGBUILDs workers reported, so the next workers fork with them"""
+        try:
+            data = os.read(self.warm_pipe[0], 65536)
+        except OSError as exc:
+            if exc.errno != errno.EAGAIN:
+                raise
+            return
+        for path in sorted(set(data.splitlines())):
+            try:
+                warm_templates(load_pkgbuild(path))
+            except Exception:
+                # The worker reports it to its client
+                pass
+
+    def server_close(self):
+        UnixStreamServer.server_close(self)
+        for fd in self.warm_pipe:
+            os.close(fd)
+
+
+def serve(path, workers, commands):
+    if os.path.exists(path):
+        os.unlink(path)
+    # Fill the distro facts cache before any worker is forked
+    linux_dist()
+    server = BuildServer(path, workers, commands)
+    os.chmod(path, 0600)
+    print 'Serving on %s with %d workers' % (path, workers)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.unlink(path)
+
+
+def submit(path, pkgbuild, args):
+    """Send a build to the daemon at path and stream its output, returns an error message on failure"""
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+    except socket.error as exc:
+        return 'Could not connect to build server at %s: %s' % (path, exc)
+
+    request = {
+        'command': 'build',
+        'pkgbuild': os.path.abspath(os.path.expanduser(pkgbuild)),
+        'cwd': os.getcwd(),
+        'args': args,
+    }
+    sock.sendall(json.dumps(request) + '\n')
+
+    # Hold back enough of the stream to never print a partial exit marker
+    holdback = len(EXIT_MARKER % 255)
+    buf = ''
+    status = None
+    while True:
+        data = sock.recv(4096)
+        if not data:
+            break
+        buf += data
+        marker = buf.rfind('\0empkg-exit ')
+        if marker >= 0 and buf.endswith('\n'):
+            sys.stdout.write(buf[:marker])
+            status = int(buf[marker:].split()[-1])
+            break
+        if len(buf) > holdback:
+            sys.stdout.write(buf[:-holdback])
+            buf = buf[-holdback:]
+    sock.close()
+    sys.stdout.flush()
+
+    if status is None:
+        sys.stdout.write(buf)
+        return 'Build server closed the connection'
+    if status:
+        return 'Build failed with status %d' % status
+    return None
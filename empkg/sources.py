@@ -1,21 +1,38 @@
+import copy
+import errno
+import fnmatch
+import glob
+import hashlib
 import os
+import re
 import tarfile
+import tempfile
 import shutil
-from urllib2 import urlopen
+import subprocess
+from multiprocessing.pool import ThreadPool
 from urlparse import urlparse
 
+from . import transport
+from .util import cache_dir, default_job, file_digest, rm_rf
 
-def get_url(source, destination):
+STAGE_THREADS = 8
+# Smaller files are copied before cp would have started
+REFLINK_MIN_SIZE = 1 << 20
+HASH_NAMES = ('md5', 'sha1', 'sha256', 'sha384', 'sha512')
+
+
+def get_url(source, destination, hashvalue=None, hashname=None, offline=False, hardlink=False, job=None):
+    """Stage source in destination, hardlink only applies to local files, downloads are copied out of the cache"""
+    if isinstance(source, (list, tuple)):
+        # Mirrors of the same file
+        return stage_download(source, destination, hashvalue, hashname, offline, job)
     src = urlparse(source)
     filename = None
     if src.scheme in ('', 'file'):
-        dest = os.path.join(destination, source)
-        if not os.path.isdir(os.path.dirname(dest)):
-            os.makedirs(os.path.dirname(dest))
-        shutil.copy2(source, dest)
+        stage([source], destination, hardlink)
         filename = source
     elif src.scheme in ('http', 'https', 'ftp'):
-        filename = download_url(source, destination)
+        filename = stage_download(source, destination, hashvalue, hashname, offline, job)
     elif 'git' in src.scheme:
         # TODO git, git+http
         raise NotImplementedError('Git repo support')
@@ -25,13 +42,216 @@ def get_url(source, destination):
     return filename
 
 
-def download_url(source, destination):
-    remote = urlopen(source)
+def stage_download(source, destination, hashvalue, hashname, offline, job=None):
+    path = fetch(source, hashvalue, hashname, offline, job)
+    filename = os.path.basename(path)
+    # Never a hardlink, the build writing to it (or extracting over it) would change the cached file
+    place(path, os.path.join(destination, filename))
+    return filename
+
+
+def source_cache(source):
+    """Source cache directory of a remote source, mirror lists share one whatever their order"""
+    urls = [source] if isinstance(source, basestring) else source
+    return cache_dir('sources', hashlib.sha256('\n'.join(sorted(urls))).hexdigest())
+
+
+def cached(source):
+    """Path of the cached download of source, None when it isn't cached"""
+    directory = source_cache(source)
+    for filename in os.listdir(directory):
+        if not filename.startswith('.'):
+            return os.path.join(directory, filename)
+    return None
+
+
+def fetch(source, hashvalue=None, hashname=None, offline=False, job=None):
+    """Download a remote source into the source cache unless it is there, returns the cached path"""
+    if job is None:
+        job = default_job
+    path = cached(source)
+    if path is not None and hashvalue is not None:
+        try:
+            check(path, hashvalue, hashname)
+            return path
+        except ValueError:
+            if offline:
+                raise
+            # Upstream may have replaced the file, download it again
+            job.output('%s does not match its %ssum, downloading it again' % (path, hashname))
+    elif path is not None:
+        return path
+    if offline:
+        raise IOError(errno.ENOENT, 'Offline and not in the source cache', str(source))
+
+    directory = source_cache(source)
+    # Concurrent fetches of the same source each get their own partial file
+    tmp = tempfile.mkdtemp(prefix='.fetch-', dir=directory)
+    try:
+        filename = download_url(source, tmp, job)
+        if hashvalue is not None:
+            check(os.path.join(tmp, filename), hashvalue, hashname)
+        if path is not None:
+            os.remove(path)
+        path = os.path.join(directory, filename)
+        os.rename(os.path.join(tmp, filename), path)
+    finally:
+        rm_rf(tmp)
+    return path
+
+
+def integrity(conf):
+    """(hashname, sums) of the first integrity array that is set, (None, ()) when there is none"""
+    for hashname in HASH_NAMES:
+        sums = conf['%ssums' % hashname]
+        if sums:
+            if len(sums) != len(conf['source']):
+                raise ValueError('%ssums has %d entries for %d sources' % (hashname, len(sums), len(conf['source'])))
+            return hashname, sums
+    return None, ()
+
+
+def check(filename, hashvalue, hashname):
+    if hashvalue == 'SKIP':
+        return
+    digest = file_digest(filename, hashname)
+    if digest != hashvalue.lower():
+        raise ValueError('%s failed the %s integrity check: expected %s, got %s' % (
+            filename, hashname, hashvalue, digest))
+
+
+def location(source):
+    """Url, mirror list or path of a source entry"""
+    return source['url'] if isinstance(source, dict) else source
+
+
+def filters(source):
+    """(include, exclude) archive member patterns of a source entry"""
+    if isinstance(source, dict):
+        return tuple(source.get('include', ())), tuple(source.get('exclude', ()))
+    return (), ()
+
+
+def is_local(source):
+    return not isinstance(source, (list, tuple)) and urlparse(source).scheme in ('', 'file')
+
+
+def expand(source, root=None):
+    """Files of a local source entry, directories are walked and glob patterns expanded
+
+    Relative sources are looked up in root, the current directory by default,
+    and the files are returned relative to it.
+    """
+    pattern = os.path.join(root, source) if root is not None else source
+    if glob.has_magic(pattern):
+        paths = sorted(glob.glob(pattern))
+        if not paths:
+            raise IOError(errno.ENOENT, 'No source matches', source)
+    else:
+        paths = [pattern]
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            for dirpath, dirnames, filenames in os.walk(path):
+                dirnames.sort()
+                files.extend(os.path.join(dirpath, filename) for filename in sorted(filenames))
+        else:
+            files.append(path)
+    if root is not None and not os.path.isabs(source):
+        files = [os.path.relpath(path, root) for path in files]
+    return files
+
+
+def stage(files, destination, hardlink=False, root=None):
+    """Copy local files (relative to root) into destination keeping their relative paths, hardlinked if asked"""
+    for dirname in set(os.path.dirname(os.path.join(destination, filename)) for filename in files):
+        if not os.path.isdir(dirname):
+            os.makedirs(dirname)
+
+    def stage_one(filename):
+        place(os.path.join(root, filename) if root is not None else filename,
+              os.path.join(destination, filename), hardlink)
+
+    if len(files) < 2:
+        map(stage_one, files)
+        return
+    pool = ThreadPool(min(STAGE_THREADS, len(files)))
+    try:
+        pool.map(stage_one, files, chunksize=64)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def place(path, dest, hardlink=False):
+    """Put a copy of path at dest, a hardlink when asked and possible"""
+    # A reused srcdir only gets the files that changed
+    if unchanged(path, dest):
+        return
+    if os.path.lexists(dest):
+        os.remove(dest)
+    if hardlink:
+        try:
+            os.link(path, dest)
+            return
+        except OSError:
+            # Other filesystem, or not allowed to link
+            pass
+    copy_file(path, dest)
+
+
+def copy_file(path, dest):
+    """copy2 path to dest, large files share their blocks with path where the filesystem can (btrfs, xfs)"""
+    if os.path.getsize(path) >= REFLINK_MIN_SIZE:
+        with open(os.devnull, 'w') as devnull:
+            if subprocess.call(['cp', '--reflink=auto', '--preserve=mode,timestamps', path, dest], stderr=devnull) == 0:
+                return
+    shutil.copy2(path, dest)
+
+
+def matcher(patterns):
+    """Function telling whether a name is one of patterns, which can be globs"""
+    names = set()
+    globs = []
+    for pattern in patterns:
+        if glob.has_magic(pattern):
+            globs.append(fnmatch.translate(pattern))
+        else:
+            names.add(os.path.normpath(pattern))
+    regex = re.compile('|'.join(globs)) if globs else None
+
+    def match(name):
+        if not isinstance(name, basestring):
+            # A mirror list, match its urls one by one
+            return any(match(url) for url in name)
+        name = os.path.normpath(name)
+        return name in names or (regex is not None and regex.match(name) is not None)
+    return match
+
+
+def unchanged(source, dest):
+    """Whether dest is a copy2 of source that hasn't changed since"""
+    try:
+        src_stat = os.stat(source)
+        dest_stat = os.stat(dest)
+    except OSError:
+        return False
+    return src_stat.st_size == dest_stat.st_size and src_stat.st_mtime == dest_stat.st_mtime
+
+
+def download_url(source, destination, job=None):
+    """Download a url, or the first of a list of mirrors that works, into destination"""
+    urls = [source] if isinstance(source, basestring) else source
+    if all(urlparse(url).scheme in ('http', 'https') for url in urls):
+        return transport.fetch(urls, destination, job=job)
+
+    from urllib2 import urlopen
+    remote = urlopen(urls[0])
     if 'Content-Disposition' in remote.headers:
         content_disposition = remote.headers['Content-Disposition']
-        filename = content_disposition.split('=')[1]
+        filename = transport.safe_filename(content_disposition.split('=')[1].strip('"; '))
     else:
-        filename = os.path.basename(source)
+        filename = transport.safe_filename(urlparse(urls[0]).path)
 
     with open(os.path.join(destination, filename), 'wb') as local:
         while True:
@@ -43,38 +263,106 @@ def download_url(source, destination):
     return filename
 
 
-# TODO
-# def check(filename, hashvalue, hashname):
-#    pass
+def member_filter(include, exclude):
+    """Whether an archive member is wanted, patterns match it or one of its parent directories"""
+    def compile_patterns(patterns):
+        if not patterns:
+            return None
+        return re.compile('|'.join(fnmatch.translate(pattern.strip('/')) for pattern in patterns))
+    include = compile_patterns(include)
+    exclude = compile_patterns(exclude)
+
+    def matches(regex, name):
+        parts = name.split('/')
+        return any(regex.match('/'.join(parts[:i])) for i in range(1, len(parts) + 1))
+
+    def wanted(name):
+        name = os.path.normpath(name).lstrip('/')
+        if include is not None and not matches(include, name):
+            return False
+        return exclude is None or not matches(exclude, name)
+    return wanted
+
+
+def is_within_directory(directory, target):
+    abs_directory = os.path.abspath(directory)
+    abs_target = os.path.abspath(target)
+    return abs_target == abs_directory or abs_target.startswith(os.path.join(abs_directory, ''))
+
+
+def check_member(member, destination):
+    """Raise ValueError for a tar member written outside of destination, hardlinked out of it, or a device
+
+    Symlinks may point anywhere (a virtualenv's bin/python is absolute), what
+    extraction must not do is write through one: a member whose directory
+    resolves outside of destination is refused.
+    """
+    path = os.path.join(destination, member.name)
+    if os.path.isabs(member.name) or not is_within_directory(destination, path):
+        raise ValueError('Attempted Path Traversal in Tar File: %s' % member.name)
+    root = os.path.realpath(destination)
+    # A directory member over an existing symlink would be chmod'ed through it
+    parent = path if member.isdir() else os.path.dirname(path)
+    if not is_within_directory(root, os.path.realpath(parent)):
+        raise ValueError('Tar File member %s is written through a symlink out of it' % member.name)
+    if member.islnk():
+        # Hardlinks are relative to the archive root
+        target = os.path.realpath(os.path.join(destination, member.linkname))
+        if os.path.isabs(member.linkname) or not is_within_directory(root, target):
+            raise ValueError('Tar File member %s links outside of it: %s' % (member.name, member.linkname))
+    if member.isdev():
+        raise ValueError('Tar File member %s is a device' % member.name)
+
+
+def extract_tar(filename, destination, include=(), exclude=(), fileobj=None):
+    """Stream the archive, only members include/exclude let through are written, returns (written, skipped) bytes
+
+    fileobj is read instead of filename when given
+    """
+    wanted = member_filter(include, exclude)
+    written = 0
+    skipped = 0
+    directories = []
+    # Stream mode, members are read once in order and skipped ones are never written
+    with tarfile.open(filename, 'r|*', fileobj=fileobj) as fd:
+        for member in fd:
+            check_member(member, destination)
+            if not wanted(member.name):
+                skipped += member.size
+                continue
+            if member.isdir():
+                # Like extractall, directory permissions are set once their contents are in
+                directories.append(member)
+                member = copy.copy(member)
+                member.mode = 0700
+            else:
+                # tarfile writes into an existing file, which may be a hardlinked source
+                path = os.path.join(destination, member.name)
+                if os.path.lexists(path) and not os.path.isdir(path):
+                    os.remove(path)
+            fd.extract(member, destination)
+            written += member.size
+
+        directories.sort(key=lambda member: member.name, reverse=True)
+        for member in directories:
+            path = os.path.join(destination, member.name)
+            fd.chown(member, path)
+            fd.utime(member, path)
+            fd.chmod(member, path)
+    return written, skipped
 
 
-def extract(filename, destination):
+def extract(filename, destination, include=(), exclude=(), job=None):
+    if job is None:
+        job = default_job
     try:
         _, extension = filename.rsplit('.', 1)
     except ValueError:
         return
     if extension in ('gz', 'bz2', 'tar'):
-        with tarfile.open(filename, 'r:*') as fd:
-            def is_within_directory(directory, target):
-                
-                abs_directory = os.path.abspath(directory)
-                abs_target = os.path.abspath(target)
-            
-                prefix = os.path.commonprefix([abs_directory, abs_target])
-                
-                return prefix == abs_directory
-            
-            def safe_extract(tar, path=".", members=None, *, numeric_owner=False):
-            
-                for member in tar.getmembers():
-                    member_path = os.path.join(path, member.name)
-                    if not is_within_directory(path, member_path):
-                        raise Exception("Attempted Path Traversal in Tar File")
-            
-                tar.extractall(path, members, numeric_owner=numeric_owner) 
-                
-            
-            safe_extract(fd, destination)
+        written, skipped = extract_tar(filename, destination, include, exclude)
+        job.output('Extracted %s: %d bytes written, %d bytes skipped' % (
+            os.path.basename(filename), written, skipped))
     elif extension in ('zip', ):
         # TODO
         raise NotImplementedError('Zip support')
@@ -0,0 +1,315 @@
+"""
+Shared stage cache
+Builders push what a stage produced to an HTTP cache server and pull it
+instead of running the stage when its inputs were seen before. Stage outputs
+are content addressed blobs (the built srcdir as a tar.gz, packages as they
+are) listed by a manifest stored under the hash of the stage inputs:
+
+    HEAD/GET/PUT /blobs/<sha256 of the blob>
+    GET/PUT      /keys/<stage key>        JSON manifest
+
+The server checks uploaded blobs against their address, a manifest is only
+accepted once its blobs are there. `empkg cache-server` runs one, it is meant
+for a trusted network or localhost.
+"""
+import hashlib
+import json
+import os
+import re
+import shutil
+import tarfile
+import tempfile
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+from multiprocessing.pool import ThreadPool
+
+from . import sources, transport
+from .fingerprint import hash_file
+from .reproducible import walk_sorted
+from .util import Background, rm_rf
+
+CHUNK_SIZE = 64 * 1024
+PATH = re.compile(r'^/(blobs|keys)/([0-9a-f]{64})$')
+VERSION = 1
+# Transfers running at the same time
+THREADS = 4
+# What a flaky cache can raise, a build goes on without it
+CACHE_ERRORS = (transport.TransferError, IOError, ValueError) + transport.TRANSFER_ERRORS
+
+
+def stage_key(*inputs):
+    """Key of a stage from its JSON serializable inputs"""
+    return hashlib.sha256(json.dumps([VERSION] + list(inputs), sort_keys=True, default=repr)).hexdigest()
+
+
+class HashingReader(object):
+    """File-like over a response that hashes what goes through"""
+    def __init__(self, response):
+        self.response = response
+        self.hasher = hashlib.sha256()
+
+    def read(self, size=-1):
+        data = self.response.read(size) if size >= 0 else self.response.read()
+        self.hasher.update(data)
+        return data
+
+    def drain(self):
+        while self.read(CHUNK_SIZE):
+            pass
+        return self.hasher.hexdigest()
+
+
+class StageCache(object):
+    def __init__(self, url):
+        self.url = url.rstrip('/')
+
+    def request(self, method, path, headers=None, body=None):
+        key, conn, response = transport.pool.request(method, self.url + path, headers, body)
+        if response.status >= 400 and response.status != 404:
+            response.read()
+            conn.close()
+            raise transport.TransferError('%s %s: HTTP %d' % (method, path, response.status))
+        return key, conn, response
+
+    def read(self, path):
+        """Body of a GET, None on 404"""
+        key, conn, response = self.request('GET', path)
+        data = response.read()
+        transport.pool.release(key, conn, response)
+        return data if response.status != 404 else None
+
+    def put(self, path, body, length):
+        key, conn, response = self.request('PUT', path, {'Content-Length': str(length)}, body)
+        response.read()
+        transport.pool.release(key, conn, response)
+
+    def has_blob(self, digest):
+        key, conn, response = self.request('HEAD', '/blobs/%s' % digest)
+        response.read()
+        transport.pool.release(key, conn, response)
+        return response.status != 404
+
+    def push_blob(self, path):
+        digest = hash_file(path)
+        # Blobs are shared between keys, don't send one twice
+        if not self.has_blob(digest):
+            with open(path, 'rb') as fd:
+                self.put('/blobs/%s' % digest, fd, os.path.getsize(path))
+        return digest
+
+    def pull_blob(self, digest, consume):
+        """Stream a blob into consume(fileobj), its address is checked once it was read"""
+        key, conn, response = self.request('GET', '/blobs/%s' % digest)
+        if response.status == 404:
+            response.read()
+            raise ValueError('Blob %s is missing from the cache' % digest)
+        reader = HashingReader(response)
+        try:
+            consume(reader)
+            if reader.drain() != digest:
+                raise ValueError('Blob %s is corrupt' % digest)
+        except BaseException:
+            conn.close()
+            raise
+        transport.pool.release(key, conn, response)
+
+    def manifest(self, key):
+        data = self.read('/keys/%s' % key)
+        return json.loads(data) if data is not None else None
+
+    def push_manifest(self, key, manifest):
+        data = json.dumps(manifest, sort_keys=True)
+        self.put('/keys/%s' % key, data, len(data))
+
+    def save_files(self, key, paths):
+        """Store files (already compressed packages) under key, uploaded concurrently"""
+        pool = ThreadPool(min(THREADS, max(len(paths), 1)))
+        try:
+            digests = pool.map(self.push_blob, paths)
+        finally:
+            pool.close()
+            pool.join()
+        self.push_manifest(key, {'files': [
+            {'name': os.path.basename(path), 'blob': digest} for path, digest in zip(paths, digests)]})
+
+    def restore_files(self, key, directory):
+        """Fetch the files stored under key into directory, returns their paths or None on a miss"""
+        manifest = self.manifest(key)
+        if manifest is None or 'files' not in manifest:
+            return None
+
+        def pull(entry):
+            path = os.path.join(directory, os.path.basename(entry['name']))
+            tmp = '%s.%d.part' % (path, os.getpid())
+            try:
+                with open(tmp, 'wb') as fd:
+                    self.pull_blob(entry['blob'], lambda reader: shutil.copyfileobj(reader, fd, CHUNK_SIZE))
+                os.rename(tmp, path)
+            finally:
+                if os.path.exists(tmp):
+                    os.remove(tmp)
+            return path
+
+        pool = ThreadPool(min(THREADS, max(len(manifest['files']), 1)))
+        try:
+            return pool.map(pull, manifest['files'])
+        finally:
+            pool.close()
+            pool.join()
+
+    def save_tree(self, key, root):
+        """Snapshot the tree at root now and upload it in the background, join() the returned thread"""
+        fd, archive = tempfile.mkstemp(prefix='.empkg-stage-', suffix='.tar.gz', dir=os.path.dirname(root))
+        os.close(fd)
+        try:
+            with tarfile.open(archive, 'w:gz') as tar:
+                # Same tree, same blob
+                for path in walk_sorted(root):
+                    tar.add(path, arcname=os.path.relpath(path, root), recursive=False)
+        except BaseException:
+            os.remove(archive)
+            raise
+
+        def upload():
+            try:
+                self.push_manifest(key, {'tree': self.push_blob(archive)})
+            finally:
+                os.remove(archive)
+        return Background(upload)
+
+    def restore_tree(self, key, root):
+        """Replace root with the tree stored under key, streamed straight from the server, False on a miss"""
+        manifest = self.manifest(key)
+        if manifest is None or 'tree' not in manifest:
+            return False
+        # root is only replaced once the whole tree is in
+        tmp = tempfile.mkdtemp(prefix='.empkg-stage-', dir=os.path.dirname(root))
+
+        def extract(reader):
+            # Members are checked like source archives, a rogue server can't write outside of srcdir
+            sources.extract_tar(None, tmp, fileobj=reader)
+        try:
+            self.pull_blob(manifest['tree'], extract)
+            rm_rf(root)
+            os.rename(tmp, root)
+        finally:
+            rm_rf(tmp)
+        return True
+
+
+class CacheHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        if not self.server.quiet:
+            BaseHTTPRequestHandler.log_message(self, format, *args)
+
+    def target(self):
+        match = PATH.match(self.path)
+        if match is None:
+            self.reply(400)
+            return None, None
+        kind, name = match.groups()
+        return kind, self.server.path(kind, name)
+
+    def reply(self, status, body=''):
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(body)))
+        if status >= 400:
+            # The request body may not have been read
+            self.send_header('Connection', 'close')
+            self.close_connection = 1
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+
+    def do_HEAD(self):
+        kind, path = self.target()
+        if path is None:
+            return
+        if not os.path.isfile(path):
+            return self.reply(404)
+        self.send_response(200)
+        self.send_header('Content-Length', str(os.path.getsize(path)))
+        self.end_headers()
+
+    def do_GET(self):
+        kind, path = self.target()
+        if path is None:
+            return
+        try:
+            fd = open(path, 'rb')
+        except IOError:
+            return self.reply(404)
+        with fd:
+            self.send_response(200)
+            self.send_header('Content-Length', str(os.fstat(fd.fileno()).st_size))
+            self.end_headers()
+            shutil.copyfileobj(fd, self.wfile, CHUNK_SIZE)
+
+    def do_PUT(self):
+        kind, path = self.target()
+        if path is None:
+            return
+        length = int(self.headers.getheader('Content-Length') or 0)
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path))
+        hasher = hashlib.sha256()
+        try:
+            with os.fdopen(fd, 'wb') as out:
+                while length:
+                    data = self.rfile.read(min(length, CHUNK_SIZE))
+                    if not data:
+                        break
+                    hasher.update(data)
+                    out.write(data)
+                    length -= len(data)
+            if length:
+                return self.reply(400, 'Short upload\n')
+            if kind == 'blobs' and hasher.hexdigest() != os.path.basename(path):
+                return self.reply(422, 'Content does not match its address\n')
+            if kind == 'keys' and not self.server.complete(tmp):
+                return self.reply(409, 'Manifest refers to missing blobs\n')
+            os.rename(tmp, path)
+            tmp = None
+            self.reply(201)
+        finally:
+            if tmp is not None:
+                os.remove(tmp)
+
+
+class CacheServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, root, quiet=False):
+        self.root = os.path.abspath(root)
+        self.quiet = quiet
+        for kind in ('blobs', 'keys'):
+            if not os.path.isdir(os.path.join(self.root, kind)):
+                os.makedirs(os.path.join(self.root, kind))
+        HTTPServer.__init__(self, address, CacheHandler)
+
+    def path(self, kind, name):
+        return os.path.join(self.root, kind, name)
+
+    def complete(self, manifest_path):
+        """Whether the manifest is valid and its blobs are stored"""
+        try:
+            with open(manifest_path) as fd:
+                manifest = json.load(fd)
+        except ValueError:
+            return False
+        blobs = [entry['blob'] for entry in manifest.get('files', ())]
+        if 'tree' in manifest:
+            blobs.append(manifest['tree'])
+        return all(PATH.match('/blobs/%s' % blob) and os.path.isfile(self.path('blobs', blob)) for blob in blobs)
+
+
+def serve(host, port, root):
+    server = CacheServer((host, port), root)
+    print 'Stage cache on http://%s:%d/ storing in %s' % (host, server.server_port, server.root)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
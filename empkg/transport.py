@@ -0,0 +1,238 @@
+"""
+HTTP transport for sources
+Connections are kept alive in a per host pool so several sources from one
+server share the TCP/TLS setup. A source can list mirrors: they are tried in
+order of measured latency and a transfer that fails or stalls resumes on the
+next mirror from where it stopped, with exponential backoff between tries.
+"""
+import httplib
+import os
+import socket
+import threading
+import re
+import time
+import urllib
+from urlparse import urljoin, urlsplit
+
+from .util import default_job
+
+TIMEOUT = 30
+RETRIES = 3
+BACKOFF = 0.5
+CHUNK_SIZE = 64 * 1024
+REDIRECTS = (301, 302, 303, 307, 308)
+MAX_REDIRECTS = 10
+CONTENT_RANGE = re.compile(r'^bytes (\d+)-')
+
+# Errors that move a transfer to the next mirror
+TRANSFER_ERRORS = (socket.error, socket.timeout, httplib.HTTPException)
+
+
+class TransferError(Exception):
+    pass
+
+
+class ConnectionPool(object):
+    """Idle keep-alive connections by (scheme, host, port, proxy)"""
+    def __init__(self, timeout=TIMEOUT):
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.idle = {}
+
+    def key(self, url):
+        parts = urlsplit(url)
+        port = parts.port or (443 if parts.scheme == 'https' else 80)
+        proxy = None
+        if not urllib.proxy_bypass(parts.hostname):
+            proxy = urllib.getproxies().get(parts.scheme)
+        return parts.scheme, parts.hostname, port, proxy
+
+    def connect(self, key):
+        scheme, host, port, proxy = key
+        if proxy:
+            proxy = urlsplit(proxy)
+            if scheme == 'https':
+                conn = httplib.HTTPSConnection(proxy.hostname, proxy.port or 80, timeout=self.timeout)
+                conn.set_tunnel(host, port)
+            else:
+                conn = httplib.HTTPConnection(proxy.hostname, proxy.port or 80, timeout=self.timeout)
+        elif scheme == 'https':
+            conn = httplib.HTTPSConnection(host, port, timeout=self.timeout)
+        else:
+            conn = httplib.HTTPConnection(host, port, timeout=self.timeout)
+        return conn
+
+    def request(self, method, url, headers=None, body=None):
+        """Send a request, returns (pool key, connection, response), release() them when done reading
+
+        body can be a file, it is streamed
+        """
+        key = self.key(url)
+        parts = urlsplit(url)
+        # Plain http proxies take the absolute url
+        path = url if key[3] and key[0] == 'http' else (parts.path or '/') + ('?' + parts.query if parts.query else '')
+        headers = dict(headers or {})
+        headers.setdefault('User-Agent', 'empkg')
+
+        with self.lock:
+            conns = self.idle.get(key)
+            conn = conns.pop() if conns else None
+        if conn is not None:
+            try:
+                conn.request(method, path, body=body, headers=headers)
+                return key, conn, conn.getresponse()
+            except TRANSFER_ERRORS:
+                # The server closed the idle connection
+                conn.close()
+                if hasattr(body, 'seek'):
+                    body.seek(0)
+        conn = self.connect(key)
+        conn.request(method, path, body=body, headers=headers)
+        return key, conn, conn.getresponse()
+
+    def release(self, key, conn, response):
+        if response.will_close or not response.isclosed():
+            conn.close()
+            return
+        with self.lock:
+            self.idle.setdefault(key, []).append(conn)
+
+    def close(self):
+        with self.lock:
+            for conns in self.idle.values():
+                for conn in conns:
+                    conn.close()
+            self.idle = {}
+
+
+pool = ConnectionPool()
+
+
+def follow(url, headers=None):
+    """GET url through its redirects, returns (pool key, connection, response) of the last one
+
+    Each hop goes through the pool of its own host
+    """
+    for _ in range(MAX_REDIRECTS + 1):
+        key, conn, response = pool.request('GET', url, headers)
+        location = response.getheader('Location')
+        if response.status not in REDIRECTS or not location:
+            return key, conn, response
+        response.read()
+        pool.release(key, conn, response)
+        url = urljoin(url, location)
+    raise TransferError('More than %d redirects' % MAX_REDIRECTS)
+
+
+def latency(url):
+    """Seconds a HEAD request to url takes, None when it fails"""
+    start = time.time()
+    try:
+        key, conn, response = pool.request('HEAD', url)
+        response.read()
+        pool.release(key, conn, response)
+    except TRANSFER_ERRORS:
+        return None
+    if response.status >= 400:
+        return None
+    return time.time() - start
+
+
+def rank_mirrors(urls):
+    """Mirrors by increasing latency, probed concurrently, failing ones last"""
+    if len(urls) < 2:
+        return list(urls)
+    latencies = {}
+
+    def probe(url):
+        latencies[url] = latency(url)
+
+    threads = [threading.Thread(target=probe, args=(url, )) for url in urls]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    for thread in threads:
+        thread.join(pool.timeout)
+    return sorted(urls, key=lambda url: (latencies.get(url) is None, latencies.get(url), urls.index(url)))
+
+
+def safe_filename(name):
+    """The base name of a file name sent by a server, TransferError for one that isn't usable"""
+    filename = os.path.basename(name)
+    if filename in ('', '.', '..'):
+        raise TransferError('Unusable file name %r' % name)
+    return filename
+
+
+def response_filename(response, url):
+    content_disposition = response.getheader('Content-Disposition')
+    if content_disposition and '=' in content_disposition:
+        return safe_filename(content_disposition.split('=')[1].strip('"; '))
+    return safe_filename(urlsplit(url).path)
+
+
+def fetch(urls, destination, retries=RETRIES, backoff=BACKOFF, job=None):
+    """Download the first of urls (mirrors of one file) that works into destination, returns the filename"""
+    if job is None:
+        job = default_job
+    if isinstance(urls, basestring):
+        urls = [urls]
+    mirrors = rank_mirrors(urls)
+    filename = None
+    tmp = None
+    offset = 0
+    errors = []
+
+    for attempt in range(retries * len(mirrors)):
+        url = mirrors[attempt % len(mirrors)]
+        if attempt >= len(mirrors):
+            time.sleep(backoff * 2 ** (attempt // len(mirrors) - 1))
+        headers = {'Range': 'bytes=%d-' % offset} if offset else {}
+        try:
+            key, conn, response = follow(url, headers)
+        except (TransferError, ) + TRANSFER_ERRORS as exc:
+            errors.append('%s: %s' % (url, exc))
+            continue
+        try:
+            if response.status not in (200, 206):
+                response.read()
+                raise TransferError('HTTP %d' % response.status)
+            if filename is None:
+                filename = response_filename(response, url)
+                tmp = os.path.join(destination, '.%s.part' % filename)
+            if response.status == 200 and offset:
+                # This mirror can't resume, start over
+                offset = 0
+            elif response.status == 206:
+                match = CONTENT_RANGE.match(response.getheader('Content-Range') or '')
+                if match is None or int(match.group(1)) != offset:
+                    response.read()
+                    resumed = match.group(1) if match else 'an unknown byte'
+                    requested, offset = offset, 0
+                    # Appending another range would corrupt the file, the next try starts over
+                    raise TransferError('Resumed at %s instead of byte %d' % (resumed, requested))
+            start = offset
+            with open(tmp, 'r+b' if offset else 'wb') as local:
+                local.seek(offset)
+                local.truncate()
+                while True:
+                    data = response.read(CHUNK_SIZE)
+                    if not data:
+                        break
+                    local.write(data)
+                    offset += len(data)
+            length = response.getheader('Content-Length')
+            if length is not None and int(length) != offset - start:
+                raise TransferError('Short read, %d of %s bytes' % (offset - start, length))
+        except (TransferError, ) + TRANSFER_ERRORS as exc:
+            conn.close()
+            errors.append('%s: %s' % (url, exc))
+            job.output('Download from %s failed (%s), trying next mirror...' % (url, exc))
+            continue
+        pool.release(key, conn, response)
+        os.rename(tmp, os.path.join(destination, filename))
+        return filename
+
+    if tmp and os.path.exists(tmp):
+        os.remove(tmp)
+    raise TransferError('Could not download %s:\n%s' % (urls[0], '\n'.join(errors)))
@@ -1,20 +1,91 @@
 import errno
+import hashlib
+import json
 import platform
 import os
 import shutil
+import signal
+import sys
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from copy import copy, deepcopy
 
 import subprocess
-from jinja2 import Template
 
-from . import pkgmanagers
+from .constants import BASE_CONFIG
+
+# Compiled jinja2 templates by source string, least recently used first
+_templates = OrderedDict()
+TEMPLATE_CACHE_SIZE = 1024
+# Parsed PKGBUILDs by (path, mtime, size), least recently used first
+_pkgbuilds = OrderedDict()
+PKGBUILD_CACHE_SIZE = 256
+# The daemon and split packages use the caches from several threads
+_lru_lock = threading.Lock()
+# Seconds after which a trash entry is taken as left by an interrupted delete
+TRASH_STALE = 3600
+# Facts about the running host, they don't change during the process lifetime
+_facts = {}
 
 
 def linux_dist():
-    dist = platform.linux_distribution()
-    if not dist[0]:
-        if os.path.exists('/etc/arch-release'):
-            return 'arch'
-    return dist[0].lower()
+    if 'linux_dist' not in _facts:
+        dist = platform.linux_distribution()
+        if not dist[0] and os.path.exists('/etc/arch-release'):
+            _facts['linux_dist'] = 'arch'
+        else:
+            _facts['linux_dist'] = dist[0].lower()
+    return _facts['linux_dist']
+
+
+def lru_get(cache, key):
+    """Cached value of key, raises KeyError on a miss"""
+    with _lru_lock:
+        value = cache.pop(key)
+        cache[key] = value
+        return value
+
+
+def lru_put(cache, key, value, size):
+    """Cache value under key, dropping the least recently used entries past size"""
+    with _lru_lock:
+        cache.pop(key, None)
+        cache[key] = value
+        while len(cache) > size:
+            cache.popitem(last=False)
+    return value
+
+
+def load_pkgbuild(path):
+    """Load a PKGBUILD on top of BASE_CONFIG, parsed files are cached until they change"""
+    path = os.path.abspath(path)
+    stat = os.stat(path)
+    key = (path, stat.st_mtime, stat.st_size)
+    try:
+        values = lru_get(_pkgbuilds, key)
+    except KeyError:
+        import yaml
+        with open(path) as fd:
+            values = yaml.safe_load(fd)
+        with _lru_lock:
+            # Older versions of the file won't be asked for again
+            for stale in [cached for cached in _pkgbuilds if cached[0] == path]:
+                del _pkgbuilds[stale]
+        lru_put(_pkgbuilds, key, values, PKGBUILD_CACHE_SIZE)
+    return make_conf(values)
+
+
+def make_conf(values):
+    """Build configuration from the values of a PKGBUILD on top of BASE_CONFIG"""
+    conf = copy(BASE_CONFIG)
+    conf.update(deepcopy(values))
+    if isinstance(conf['pkgname'], (list, tuple)) and len(conf['pkgname']) == 1:
+        conf['pkgname'] = conf['pkgname'][0]
+    if conf['pkgbase'] is None:
+        conf['pkgbase'] = conf['pkgname'][0] if isinstance(conf['pkgname'], (list, tuple)) else conf['pkgname']
+    return conf
 
 
 def get_pkgtype(distro=None):
@@ -46,6 +117,7 @@ def get_pkgman(distro=None):
 
 
 def get_pkgman_class(name):
+    from . import pkgmanagers
     if name == 'pacman':
         return pkgmanagers.Pacman
     elif name == 'apt-get':
@@ -54,49 +126,222 @@ def get_pkgman_class(name):
         return pkgmanagers.Yum
 
 
+def cache_dir(*parts):
+    """Per user cache directory, created on demand"""
+    base = os.environ.get('EMPKG_CACHE_DIR')
+    if not base:
+        base = os.path.join(os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache'), 'empkg')
+    path = os.path.join(base, *parts)
+    mkdir_p(path)
+    return path
+
+
+class Background(threading.Thread):
+    """Run fcn in a thread, join() re-raises what it raised"""
+    def __init__(self, fcn, *args, **kwargs):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.fcn = fcn
+        self.args = args
+        self.kwargs = kwargs
+        self.exc_info = None
+        self.start()
+
+    def run(self):
+        try:
+            self.fcn(*self.args, **self.kwargs)
+        except BaseException:
+            self.exc_info = sys.exc_info()
+
+    def join(self, timeout=None):
+        threading.Thread.join(self, timeout)
+        if self.exc_info:
+            raise self.exc_info[0], self.exc_info[1], self.exc_info[2]
+
+
+def cache_get(namespace, key, ttl=None):
+    """Value stored with cache_set, None when missing or older than ttl seconds"""
+    try:
+        with open(os.path.join(cache_dir(namespace), '%s.json' % key)) as fd:
+            entry = json.load(fd)
+    except (IOError, ValueError):
+        return None
+    if ttl is not None and time.time() - entry['time'] > ttl:
+        return None
+    return entry['value']
+
+
+def cache_set(namespace, key, value):
+    path = os.path.join(cache_dir(namespace), '%s.json' % key)
+    tmp = '%s.%d' % (path, os.getpid())
+    with open(tmp, 'w') as fd:
+        json.dump({'value': value, 'time': time.time()}, fd)
+    os.rename(tmp, path)
+
+
+def file_digest(path, hashname='sha256'):
+    hasher = hashlib.new(hashname)
+    with open(path, 'rb') as fd:
+        while True:
+            data = fd.read(1024 * 1024)
+            if not data:
+                break
+            hasher.update(data)
+    return hasher.hexdigest()
+
+
 def get_import(name):
     module, name = name.rsplit('.', 1)
     _temp = __import__(module, fromlist=[name])
     return getattr(_temp, name)
 
 
+def compile_template(template):
+    """Compiled jinja2 template for a string, jinja2 is only imported on first use"""
+    try:
+        return lru_get(_templates, template)
+    except KeyError:
+        from jinja2 import Template
+        return lru_put(_templates, template, Template(template), TEMPLATE_CACHE_SIZE)
+
+
+def render(template, context):
+    return compile_template(template).render(**context)
+
+
+def warm_templates(conf):
+    """Compile every string value of conf so later renders hit the cache"""
+    for value in conf.values():
+        values = value if isinstance(value, (list, tuple)) else (value, )
+        for template in values:
+            if isinstance(template, basestring):
+                compile_template(template)
+
+
 def produce_script(script, destination, context=None):
     max_filename = 255
     if len(script) < max_filename and os.path.isfile(script):
         with open(script) as fd:
             script = fd.read()
     if context is not None:
-        script = Template(script).render(**context)
+        script = render(script, context)
     with open(destination, 'w') as fd:
         fd.write(script)
     os.chmod(destination, 0755)
+    return script
 
 
-def produce_and_run_script(script, destination, context=None, workdir=None):
+def produce_and_run_script(script, destination, context=None, workdir=None, root=None, job=None):
     produce_script(script, destination, context=context)
     if not os.path.isabs(destination):
         currdir = os.getcwd()
         destination = os.path.join(os.path.abspath(currdir), destination)
-    return run_script(destination, workdir=workdir)
+    return run_script(destination, workdir=workdir, root=root, job=job)
 
 
-def run_script(cmd, workdir=None):
-    if workdir:
-        currdir = os.getcwd()
-        os.chdir(workdir)
-    print os.getcwd()
-    print cmd
-    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, shell=True)
-    out, err = proc.communicate()
-    if workdir:
-        os.chdir(currdir)
-    if out:
-        print out
-    if err:
-        print err
+def run_script(cmd, workdir=None, root=None, job=None):
+    """Run cmd in a shell, its output goes to the job line by line, returns the stdout"""
+    if job is None:
+        job = default_job
+    if root is not None:
+        # Host paths are bind mounted in the build root, change dir inside it
+        cmd = root.wrap(cmd, workdir)
+        workdir = None
+    # Not chdir, split packages and concurrent builds run scripts from several threads
+    job.output(workdir or os.getcwd())
+    job.output(cmd)
+    proc = job.popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, shell=True, cwd=workdir or None)
+    out = []
+    try:
+        errors = Background(lambda: [job.output(line.rstrip('\n')) for line in iter(proc.stderr.readline, '')])
+        for line in iter(proc.stdout.readline, ''):
+            out.append(line)
+            job.output(line.rstrip('\n'))
+        errors.join()
+        proc.wait()
+    finally:
+        job.release(proc)
+    job.check()
     if proc.returncode == 1:
         raise subprocess.CalledProcessError(proc.returncode, cmd)
-    return out
+    return ''.join(out)
+
+
+class BuildCancelled(Exception):
+    pass
+
+
+class Job(object):
+    """What the scripts of one build share: where their output goes, environment and cancellation
+
+    Builds running side by side in one process each have their own. With
+    detach scripts run in their own process group so cancel() takes their
+    children down too, without they stay in the terminal's like before.
+    """
+    def __init__(self, log=None, listener=None, detach=True):
+        # Called with each output line, printed when None
+        self.log = log
+        # Called with (event, data) as the build goes
+        self.listener = listener
+        # Environment of the scripts on top of os.environ
+        self.env = {}
+        self.detach = detach
+        self.reason = None
+        self.cancelled = threading.Event()
+        self.procs = set()
+        self.lock = threading.Lock()
+
+    def output(self, line):
+        if self.log is None:
+            print line
+        else:
+            self.log(line)
+
+    def event(self, event, **data):
+        if self.listener is not None:
+            self.listener(event, data)
+
+    def popen(self, cmd, **kwargs):
+        with self.lock:
+            self.check()
+            env = dict(os.environ, **self.env) if self.env else None
+            proc = subprocess.Popen(cmd, env=env, preexec_fn=os.setpgrp if self.detach else None, **kwargs)
+            self.procs.add(proc)
+        return proc
+
+    def release(self, proc):
+        """Forget proc, killed if it still runs (the caller is unwinding)"""
+        with self.lock:
+            self.procs.discard(proc)
+        if proc.poll() is None:
+            self.kill(proc)
+            proc.wait()
+
+    def check(self):
+        """Raise BuildCancelled once the job was cancelled"""
+        if self.cancelled.is_set():
+            raise BuildCancelled(self.reason or 'Build cancelled')
+
+    def cancel(self, reason=None):
+        with self.lock:
+            if not self.cancelled.is_set():
+                self.reason = reason
+                self.cancelled.set()
+            for proc in self.procs:
+                self.kill(proc)
+
+    def kill(self, proc):
+        try:
+            if self.detach:
+                os.killpg(proc.pid, signal.SIGTERM)
+            else:
+                proc.terminate()
+        except OSError:
+            pass
+
+
+# Job of the command line builds and those that weren't given one
+default_job = Job(detach=False)
 
 
 def rm_rf(path):
@@ -107,6 +352,40 @@ def rm_rf(path):
             pass
 
 
+def rm_rf_async(path):
+    """rm -rf that returns right away
+
+    path is renamed into a trash dir next to it and deleted by a background
+    process, along with entries older than TRASH_STALE an interrupted delete
+    left in the trash (newer ones may be other builds' deletes in progress)
+    """
+    if not os.path.lexists(path):
+        return
+    path = os.path.abspath(path)
+    trash = os.path.join(os.path.dirname(path), '.empkg-trash')
+    try:
+        mkdir_p(trash)
+        entry = tempfile.mkdtemp(prefix=os.path.basename(path) + '.', dir=trash)
+        os.rename(path, entry + '/_')
+    except OSError:
+        # No rename across filesystems or without permissions on the parent
+        rm_rf(path)
+        return
+    entries = [entry]
+    for name in os.listdir(trash):
+        other = os.path.join(trash, name)
+        try:
+            if other != entry and time.time() - os.lstat(other).st_mtime > TRASH_STALE:
+                entries.append(other)
+        except OSError:
+            # Deleted meanwhile
+            pass
+    with open(os.devnull, 'w') as devnull:
+        proc = subprocess.Popen(['rm', '-rf'] + entries, stdout=devnull, stderr=devnull, close_fds=True)
+    # Reaped from a thread, a long running empkg serve would pile up zombies
+    Background(proc.wait)
+
+
 def mkdir_p(*args):
     """mkdir -p"""
     try:
@@ -124,7 +403,7 @@ class chroot(object):
     def __enter__(self):
         os.chroot(self.new_root)
 
-    def __exit__(self):
+    def __exit__(self, exc_type, exc_value, traceback):
         os.fchdir(self.real_root)
         os.chroot('.')
         os.close(self.real_root)
@@ -0,0 +1,85 @@
+"""
+Scratch workspaces
+The relative srcdir, pkgdir and scriptdir of a build can live on tmpfs (or
+any scratch path) instead of next to the PKGBUILD, so small-file heavy builds
+don't pay the latency of the build volume. Only the packages are written back
+to the pkgdir on disk.
+
+Before a build moves to scratch its size is estimated, from what the last
+build of the same PKGBUILD used or else from its sources, and checked against
+the free space there. Builds that wouldn't fit stay on disk, and so do builds
+nothing is known about yet (no successful build, remote sources not fetched)
+unless workspace_size is set: running out of space halfway is worse.
+"""
+import hashlib
+import os
+import stat
+
+from .util import cache_get, cache_set
+
+TMPFS = ('/dev/shm', )
+# Sources usually grow this much once extracted, built and packaged
+SOURCE_FACTOR = 4
+# Free space kept on scratch on top of the estimate
+MARGIN = 1.25
+
+
+def scratch_dir(setting):
+    """Directory for workspaces from the workspace setting, None when there is none"""
+    if setting == 'tmpfs':
+        candidates = [os.environ.get('XDG_RUNTIME_DIR')] + list(TMPFS)
+        for path in candidates:
+            if path and os.path.isdir(path) and os.access(path, os.W_OK):
+                return path
+        return None
+    return setting if os.path.isdir(setting) else None
+
+
+def workspace_path(scratch, startdir):
+    """Stable per PKGBUILD directory so reused workspaces are found again"""
+    return os.path.join(scratch, 'empkg-%d-%s' % (os.getuid(), hashlib.sha256(startdir).hexdigest()[:16]))
+
+
+def tree_size(*roots):
+    """Bytes used by the files under roots"""
+    size = 0
+    for root in roots:
+        for dirpath, dirnames, filenames in os.walk(root):
+            for name in filenames:
+                st = os.lstat(os.path.join(dirpath, name))
+                if stat.S_ISREG(st.st_mode):
+                    size += st.st_size
+    return size
+
+
+def free_bytes(path):
+    st = os.statvfs(path)
+    return st.f_bavail * st.f_frsize
+
+
+def estimate(key, source_paths):
+    """Bytes the build should need: the last recorded usage, else its sources times SOURCE_FACTOR
+
+    None when unknown, source_paths is None when some sources aren't there to be measured
+    """
+    used = cache_get('workspace', key)
+    if used is not None:
+        return used
+    if not source_paths:
+        return None
+    size = 0
+    for path in source_paths:
+        if os.path.isdir(path):
+            size += tree_size(path)
+        elif os.path.isfile(path):
+            size += os.path.getsize(path)
+    return size * SOURCE_FACTOR
+
+
+def fits(scratch, needed):
+    return free_bytes(scratch) >= needed * MARGIN
+
+
+def record(key, *roots):
+    """Remember how much the build used for the next estimate"""
+    cache_set('workspace', key, tree_size(*roots))
@@ -0,0 +1,52 @@
+import os
+import stat
+
+import pytest
+import yaml
+
+# fpm stand-in: logs its arguments and tars the payload like fpm would with the root user/group flags
+FPM = r'''#!/bin/sh
+echo "$@" >> "$FPM_LOG"
+dest=.
+while [ $# -gt 0 ]; do
+    case "$1" in
+        -n) name=$2; shift;;
+        -v) version=$2; shift;;
+        -p) dest=$2; shift;;
+    esac
+    shift
+done
+out="$dest/${name}_${version}_all.deb"
+# Written outside of the payload so its root keeps the normalized mtime
+tmp=$(mktemp)
+tar --sort=name --owner=0 --group=0 --numeric-owner --exclude='*.deb' --exclude='*.delta' -cf "$tmp" .
+mv "$tmp" "$out"
+echo "Created package {:path=>\"$out\"}"
+'''
+
+
+@pytest.fixture
+def env(tmpdir, monkeypatch):
+    """Isolated cache and an fpm stand-in on PATH, FPM_LOG collects its command lines"""
+    bindir = tmpdir.mkdir('bin')
+    fpm = bindir.join('fpm')
+    fpm.write(FPM)
+    fpm.chmod(stat.S_IMODE(os.stat(str(fpm)).st_mode) | 0111)
+    monkeypatch.setenv('PATH', '%s:%s' % (bindir, os.environ['PATH']))
+    monkeypatch.setenv('EMPKG_CACHE_DIR', str(tmpdir.join('cache')))
+    monkeypatch.setenv('FPM_LOG', str(tmpdir.join('fpm.log')))
+    return tmpdir
+
+
+def fpm_calls(tmpdir):
+    path = tmpdir.join('fpm.log')
+    return path.read().splitlines() if path.check() else []
+
+
+def write_pkgbuild(directory, **values):
+    """PKGBUILD.yml of a deb built on apt in directory, returns its path"""
+    pkgbuild = dict(pkgver='1.0', pkgrel=1, pkgtype='deb', makepkgman='apt')
+    pkgbuild.update(values)
+    path = directory.join('PKGBUILD.yml')
+    path.write(yaml.safe_dump(pkgbuild, default_flow_style=False))
+    return str(path)
@@ -0,0 +1,69 @@
+import errno
+import os
+import time
+
+from conftest import write_pkgbuild
+from empkg.api import CANCELLED, OK, TIMEOUT, start_build
+
+
+def sleeping_build(env):
+    """A PKGBUILD whose build script leaves a sleep behind, and the file its pid goes to"""
+    pidfile = env.join('sleep.pid')
+    script = 'sleep 30 &\necho $! > %s\nwait\n' % pidfile
+    return write_pkgbuild(env.mkdir('demo'), pkgname='demo', build=script), pidfile
+
+
+def wait_for(check, timeout=10):
+    deadline = time.time() + timeout
+    while not check():
+        assert time.time() < deadline
+        time.sleep(0.05)
+
+
+def running(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as exc:
+        assert exc.errno == errno.ESRCH
+        return False
+    return True
+
+
+def test_cancel_kills_the_process_group(env):
+    path, pidfile = sleeping_build(env)
+    build = start_build(path)
+    wait_for(lambda: pidfile.check() and pidfile.read().strip())
+    pid = int(pidfile.read())
+    build.cancel()
+    result = build.wait(10)
+    assert result.status == CANCELLED
+    assert result.error == 'Cancelled'
+    # The script's child went with it, init reaps it
+    wait_for(lambda: not running(pid))
+
+
+def test_timeout(env):
+    path, pidfile = sleeping_build(env)
+    result = start_build(path, timeout=1).wait(10)
+    assert result.status == TIMEOUT
+    assert result.error == 'Timed out after 1s'
+    wait_for(lambda: not running(int(pidfile.read())))
+
+
+def test_event_order(env):
+    path = write_pkgbuild(env.mkdir('demo'), pkgname='demo', build='true\n')
+    heard = []
+    build = start_build(path, listener=heard.append)
+    events = list(build.events())
+    result = build.wait()
+    assert result.status == OK
+    assert events == heard
+    names = [event['event'] for event in events]
+    assert names[0] == 'stage'
+    assert names[-1] == 'finished'
+    assert names.count('finished') == 1
+    assert events[-1]['result'] is result
+    stages = [event['stage'] for event in events if event['event'] == 'stage']
+    assert stages.index('build') < stages.index('hooks')
+    logs = [event['line'] for event in events if event['event'] == 'log']
+    assert logs == result.log
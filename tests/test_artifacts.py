@@ -0,0 +1,25 @@
+import glob
+import os
+import zlib
+
+import pytest
+
+from empkg.artifacts import STORE_ERRORS, ArtifactStore
+
+
+def test_get_round_trip_and_store_errors(tmpdir):
+    store = ArtifactStore(str(tmpdir.join('store')))
+    package = tmpdir.join('demo_1.0_all.deb')
+    package.write(os.urandom(300000), mode='wb')
+    digest = store.add(str(package), pkgname='demo', pkgver='1.0', pkgrel=1, arch='all')
+
+    out = tmpdir.mkdir('out')
+    assert open(store.get(digest, str(out)), 'rb').read() == package.read('rb')
+
+    with pytest.raises(STORE_ERRORS):
+        store.get('0' * 64, str(out))
+    for path in glob.glob(os.path.join(store.root, 'chunks', '*', '*')):
+        with open(path, 'wb') as fd:
+            fd.write(zlib.compress('corrupt'))
+    with pytest.raises(STORE_ERRORS):
+        store.get(digest, str(out))
@@ -0,0 +1,56 @@
+import os
+import subprocess
+
+import pytest
+
+from empkg.buildroot import BuildRoot
+from empkg.util import Job
+
+
+def base_root(tmpdir):
+    base = tmpdir.mkdir('base')
+    base.mkdir('etc').join('hostname').write('base\n')
+    return str(base)
+
+
+def quiet():
+    return Job(log=lambda line: None)
+
+
+def test_overlay_snapshot(tmpdir):
+    base = base_root(tmpdir)
+    root = BuildRoot(base, method='overlay', job=quiet())
+    try:
+        root.create()
+    except RuntimeError:
+        pytest.skip('overlay mounts not allowed in user namespaces here')
+    try:
+        hostname = os.path.join(root.root, 'etc', 'hostname')
+        cmd = root.wrap_setup(['sh', '-c', 'cat %s && echo build > %s' % (hostname, hostname)])
+        assert subprocess.check_output(cmd, shell=True) == 'base\n'
+        # The write went to the upper dir, not the base
+        assert open(os.path.join(root.path, 'upper', 'etc', 'hostname')).read() == 'build\n'
+        assert open(os.path.join(base, 'etc', 'hostname')).read() == 'base\n'
+        path = root.path
+    finally:
+        root.destroy()
+    assert not os.path.exists(path)
+    assert os.listdir(str(tmpdir)) == ['base']
+
+
+def test_hardlink_snapshot(tmpdir):
+    base = base_root(tmpdir)
+    with BuildRoot(base, method='hardlink', job=quiet()) as root:
+        path = root.path
+        assert os.path.samefile(os.path.join(root.root, 'etc', 'hostname'), os.path.join(base, 'etc', 'hostname'))
+    assert not os.path.exists(path)
+    assert open(os.path.join(base, 'etc', 'hostname')).read() == 'base\n'
+
+
+def test_auto_never_hardlinks(tmpdir, monkeypatch):
+    base = base_root(tmpdir)
+    monkeypatch.setattr(BuildRoot, 'create_overlay', lambda self: False)
+    monkeypatch.setattr(BuildRoot, 'create_reflink', lambda self: False)
+    with pytest.raises(RuntimeError):
+        BuildRoot(base, job=quiet()).create()
+    assert os.listdir(str(tmpdir)) == ['base']
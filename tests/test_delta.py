@@ -0,0 +1,71 @@
+import os
+import random
+import tarfile
+from cStringIO import StringIO
+
+from empkg.delta import apply_delta, compress_package, make_delta
+from empkg.util import file_digest
+
+
+def tarball(files):
+    data = StringIO()
+    with tarfile.open(fileobj=data, mode='w') as tar:
+        for name, content in files:
+            member = tarfile.TarInfo(name)
+            member.size = len(content)
+            tar.addfile(member, StringIO(content))
+    return data.getvalue()
+
+
+def ar_member(name, data):
+    header = '%-16s%-12d%-6d%-6d%-8s%-10d`\n' % (name + '/', 0, 0, 0, '100644', len(data))
+    return header + data + ('\n' if len(data) % 2 else '')
+
+
+def uncompressed_deb(path, files):
+    """A deb like fpm writes with --deb-compression none"""
+    with open(path, 'wb') as fd:
+        fd.write('!<arch>\n')
+        fd.write(ar_member('debian-binary', '2.0\n'))
+        fd.write(ar_member('control.tar', tarball([('./control', 'Package: demo\n')])))
+        fd.write(ar_member('data.tar', tarball(files)))
+    return compress_package(path)
+
+
+def payload(seed, size=200000):
+    rng = random.Random(seed)
+    return ''.join(chr(rng.randrange(256)) for _ in xrange(size))
+
+
+def test_delta_over_shifted_payload(tmpdir):
+    library = payload(1)
+    old = uncompressed_deb(str(tmpdir.join('demo_1.0_all.deb')), [('./usr/lib/libdemo.so', library)])
+    # A few bytes inserted at the front shift the rest of the file off any block boundary
+    new = uncompressed_deb(str(tmpdir.join('demo_1.1_all.deb')), [('./usr/lib/libdemo.so', 'v1.1' + library)])
+
+    # Published compressed
+    with open(new, 'rb') as fd:
+        assert 'data.tar.gz/' in fd.read()
+    size = make_delta(old, new, new + '.delta')
+    assert size < os.path.getsize(new) / 10
+
+    rebuilt = str(tmpdir.join('rebuilt.deb'))
+    apply_delta(old, new + '.delta', rebuilt)
+    assert file_digest(rebuilt) == file_digest(new)
+
+
+def test_pacman_packages_are_gzip_compressed(tmpdir):
+    path = str(tmpdir.join('demo-1.0-1-any.pkg.tar'))
+    with open(path, 'wb') as fd:
+        fd.write(tarball([('.PKGINFO', 'pkgname = demo\n'), ('usr/bin/demo', payload(2, 50000))]))
+    old = compress_package(path)
+    assert old == path + '.gz' and not os.path.exists(path)
+
+    path = str(tmpdir.join('demo-1.1-1-any.pkg.tar'))
+    with open(path, 'wb') as fd:
+        fd.write(tarball([('.PKGINFO', 'pkgname = demo\n'), ('usr/bin/demo', payload(2, 50000) + 'more')]))
+    new = compress_package(path)
+    make_delta(old, new, new + '.delta')
+    rebuilt = str(tmpdir.join('rebuilt.pkg.tar.gz'))
+    apply_delta(old, new + '.delta', rebuilt)
+    assert file_digest(rebuilt) == file_digest(new)
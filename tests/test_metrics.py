@@ -0,0 +1,53 @@
+from empkg import metrics
+
+
+def record(path, pkgbase, status, started, timings, counters=None):
+    conf = {'pkgbase': pkgbase, 'pkgver': '1.0', 'pkgrel': 1}
+    metrics.record(conf, status, started, started + sum(seconds for _, _, seconds in timings), timings,
+                   counters or {}, path=path)
+
+
+def test_percentile():
+    assert metrics.percentile([], 0.5) is None
+    assert metrics.percentile([4.0], 0.99) == 4.0
+    assert metrics.percentile([1.0, 2.0, 3.0, 4.0], 0.5) == 2.5
+    assert metrics.percentile(range(101), 0.9) == 90
+
+
+def test_regressions():
+    baseline = [10.0, 11.0, 9.0, 10.0, 10.0]
+    history = {
+        ('demo', 'build'): baseline + [14.0, 15.0, 13.0],
+        # Within REGRESSION of the baseline
+        ('demo', 'package'): baseline + [11.0, 12.0, 11.0],
+        # Not enough builds to tell
+        ('other', 'build'): [1.0, 5.0, 5.0],
+    }
+    assert metrics.regressions(history) == [('demo', 'build', 10.0, 14.0)]
+
+
+def test_report_and_prometheus(tmpdir):
+    path = str(tmpdir.join('metrics.sqlite'))
+    record(path, 'demo', 'ok', 1000, [('demo', 'build', 2.0), ('demo', 'package', 1.0)],
+           {'source_cache_hit': 1, 'source_cache_miss': 1, 'download_bytes': 2e6, 'download_seconds': 2})
+    record(path, 'demo', 'ok', 2000, [('demo', 'build', 4.0), ('demo', 'package', 1.0)], {'source_cache_hit': 2})
+    # Failed builds count, their stages don't
+    record(path, 'demo', 'failed', 3000, [('demo', 'build', 100.0)])
+
+    db = metrics.connect(path)
+    try:
+        report = metrics.report(db)
+        text = metrics.prometheus(db)
+    finally:
+        db.close()
+
+    assert 'demo                     build               2     3.00s     3.80s     3.98s     4.00s' in report
+    assert 'demo: source_cache 3/4 (75%), downloaded 2.0 MB at 1.0 MB/s' in report
+    lines = text.splitlines()
+    assert 'empkg_stage_duration_seconds{pkgname="demo",quantile="0.5",stage="build"} 3.000000' in lines
+    assert 'empkg_stage_duration_seconds_count{pkgname="demo",stage="build"} 2' in lines
+    assert 'empkg_cache_lookups_total{cache="source_cache",pkgbase="demo",result="hit"} 3' in lines
+    assert 'empkg_cache_lookups_total{cache="source_cache",pkgbase="demo",result="miss"} 1' in lines
+    assert 'empkg_builds_total{pkgbase="demo",status="failed"} 1' in lines
+    assert 'empkg_builds_total{pkgbase="demo",status="ok"} 2' in lines
+    assert text.endswith('\n')
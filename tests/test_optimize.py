@@ -0,0 +1,23 @@
+import os
+
+from empkg.optimize import dedupe
+
+
+def write(root, path, data):
+    path = root.join(path)
+    path.dirpath().ensure(dir=True)
+    path.write(data)
+    return str(path)
+
+
+def test_dedupe_links_duplicates_but_not_conffiles(tmpdir):
+    root = tmpdir.mkdir('pkg')
+    first = write(root, 'usr/share/a', 'same')
+    second = write(root, 'usr/share/b', 'same')
+    conf = write(root, 'etc/demo/a.conf', 'same')
+    conf_dir = write(root, 'etc/other/b.conf', 'same')
+
+    assert dedupe(str(root), conffiles=('/etc/demo/a.conf', 'etc/other')) == 1
+    assert os.path.samefile(first, second)
+    for path in (conf, conf_dir):
+        assert os.stat(path).st_nlink == 1
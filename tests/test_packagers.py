@@ -0,0 +1,29 @@
+import os
+
+from conftest import write_pkgbuild
+from empkg.api import load
+from empkg.packagers import BasePackager
+from empkg.util import Job
+
+
+def stage_sources(project, source):
+    conf = load(write_pkgbuild(project, pkgname='demo', source=source), {'reuse_workspace': True})
+    packager = BasePackager(conf, job=Job(log=lambda line: None))
+    if not os.path.isdir(packager.srcdir):
+        os.makedirs(packager.srcdir)
+    packager.apply_context()
+    packager.get_sources()
+    return packager.srcdir
+
+
+def test_reused_srcdir_drops_removed_sources(env):
+    project = env.mkdir('demo')
+    for name in ('a.patch', 'b.patch'):
+        project.join(name).write(name)
+    srcdir = stage_sources(project, ['a.patch', 'b.patch'])
+    open(os.path.join(srcdir, 'built.o'), 'w').close()
+    assert sorted(os.listdir(srcdir)) == ['.empkg-sources', 'a.patch', 'b.patch', 'built.o']
+
+    stage_sources(project, ['a.patch'])
+    # What the build made stays
+    assert sorted(os.listdir(srcdir)) == ['.empkg-sources', 'a.patch', 'built.o']
@@ -0,0 +1,57 @@
+import pytest
+
+from empkg.pkgmanagers import AptGet, Pacman, parse_reverse_provides
+from empkg.util import Job
+
+
+def test_offline_install_fails_on_missing_packages(monkeypatch):
+    monkeypatch.setattr(AptGet, 'missing', classmethod(lambda cls, packages, root=None: ['gcc']))
+    monkeypatch.setattr('subprocess.call', lambda *args, **kwargs: pytest.fail('installed offline'))
+    with pytest.raises(RuntimeError) as exc:
+        AptGet.install(['gcc', 'make'], offline=True, job=Job(log=lambda line: None))
+    assert 'gcc' in str(exc.value)
+
+
+def test_offline_install_with_everything_installed(monkeypatch):
+    monkeypatch.setattr(AptGet, 'missing', classmethod(lambda cls, packages, root=None: []))
+    lines = []
+    AptGet.install(['make'], offline=True, job=Job(log=lines.append))
+    assert lines == ['All dependencies installed']
+
+
+SHOWPKG = '''Package: awk
+Versions: 
+
+Reverse Depends: 
+  base-files,awk
+Dependencies: 
+Provides: 
+Reverse Provides: 
+mawk 1.3.4.20200120-3.1 (= )
+gawk 1:5.1.0-1 (= )
+Package: mail-transport-agent
+Versions: 
+
+Reverse Depends: 
+  bsd-mailx,mail-transport-agent
+Dependencies: 
+Provides: 
+Reverse Provides: 
+'''
+
+
+def test_parse_reverse_provides():
+    assert parse_reverse_provides(SHOWPKG) == {'awk': set(['mawk', 'gawk']), 'mail-transport-agent': set()}
+
+
+def test_virtual_packages_are_not_missing(monkeypatch):
+    monkeypatch.setattr(AptGet, 'db_mtime', classmethod(lambda cls: None))
+    monkeypatch.setattr(AptGet, 'query', classmethod(
+        lambda cls, cmd, root=None: (0, SHOWPKG if cmd[0] == 'apt-cache' else 'mawk ii \nmake ii \n')))
+    assert AptGet.missing(['make', 'awk', 'mail-transport-agent']) == ['mail-transport-agent']
+
+
+def test_pacman_provides(monkeypatch):
+    # pacman -T prints what isn't satisfied
+    monkeypatch.setattr(Pacman, 'query', classmethod(lambda cls, cmd, root=None: (127, 'java-runtime\n')))
+    assert Pacman.provided(['sh', 'java-runtime']) == set(['sh'])
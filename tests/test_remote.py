@@ -0,0 +1,50 @@
+import pytest
+
+pytest.importorskip('fabric')
+
+from empkg import remote
+from empkg.util import Job
+
+
+class Output(str):
+    failed = False
+
+
+def test_probe_builder_parse_errors(monkeypatch):
+    monkeypatch.setattr(remote, 'run', lambda cmd: Output('0.50 0.40 0.30 1/100 1234\n4\nrunning\n'))
+    assert remote.probe_builder() == {'load': 0.5, 'cpus': 4, 'running': 1}
+    for out in ('', 'Welcome to the builder\n', '0.50 0.40 0.30 1/100 1234\n'):
+        monkeypatch.setattr(remote, 'run', lambda cmd, out=out: Output(out))
+        assert remote.probe_builder() is None
+
+
+def test_rank_builders(monkeypatch):
+    inventory = [
+        {'host': 'localhost', 'distro': None, 'capacity': 2},
+        {'host': '127.0.0.2', 'distro': None, 'capacity': 1},
+        {'host': '127.0.0.3', 'distro': None, 'capacity': 4},
+        {'host': '127.0.0.4', 'distro': None, 'capacity': 1},
+        {'host': '127.0.0.5', 'distro': 'centos', 'capacity': 8},
+    ]
+    probes = {
+        'localhost': {'load': 3.0, 'cpus': 4, 'running': 1},
+        # Full
+        '127.0.0.2': {'load': 0.0, 'cpus': 4, 'running': 1},
+        '127.0.0.3': {'load': 0.5, 'cpus': 4, 'running': 1},
+        # Unreachable or unparsable
+        '127.0.0.4': None,
+        '127.0.0.5': {'load': 0.0, 'cpus': 64, 'running': 0},
+    }
+    probed = []
+
+    def execute(task, hosts=()):
+        probed.extend(hosts)
+        return dict((host, probes[host]) for host in hosts)
+    monkeypatch.setattr(remote, 'execute', execute)
+    lines = []
+    conf = {'pkgtype': 'deb', 'makepkgman': 'apt'}
+
+    assert remote.rank_builders(inventory, conf, Job(log=lines.append)) == ['127.0.0.3', 'localhost', '127.0.0.2']
+    # The rpm builder isn't even probed
+    assert '127.0.0.5' not in probed
+    assert 'Builder 127.0.0.4 is unreachable' in lines
@@ -0,0 +1,56 @@
+import tarfile
+from cStringIO import StringIO
+
+from empkg.repo import Repository
+from empkg.util import Job
+
+
+def pacman_package(directory, name, version, arch='x86_64'):
+    """Minimal pacman package, a tarball with its .PKGINFO"""
+    path = directory.join('%s-%s-%s.pkg.tar.gz' % (name, version, arch))
+    info = 'pkgname = %s\npkgver = %s\narch = %s\nsize = 1\n' % (name, version, arch)
+    with tarfile.open(str(path), 'w:gz') as tar:
+        member = tarfile.TarInfo('.PKGINFO')
+        member.size = len(info)
+        tar.addfile(member, StringIO(info))
+    return str(path)
+
+
+def db_names(repo_dir):
+    with tarfile.open(str(repo_dir.join('repo.db.tar.gz'))) as tar:
+        return sorted(member.name for member in tar.getmembers() if member.isdir())
+
+
+def quiet():
+    return Job(log=lambda line: None)
+
+
+def test_pacman_replaces_older_versions(tmpdir):
+    built = tmpdir.mkdir('built')
+    repo_dir = tmpdir.join('repo')
+    repository = Repository(str(repo_dir), job=quiet())
+    repository.add([pacman_package(built, 'foo', '1.0-1'), pacman_package(built, 'bar', '2.0-1')])
+    repository.add([pacman_package(built, 'foo', '1.1-1')])
+
+    assert db_names(repo_dir) == ['bar-2.0-1', 'foo-1.1-1']
+    assert not repo_dir.join('foo-1.0-1-x86_64.pkg.tar.gz').check()
+
+    # Other arches are other packages
+    repository.add([pacman_package(built, 'foo', '1.1-1', arch='aarch64')])
+    assert db_names(repo_dir) == ['bar-2.0-1', 'foo-1.1-1', 'foo-1.1-1']
+
+
+def test_keep_bounds_other_repositories(tmpdir, monkeypatch):
+    repository = Repository(str(tmpdir.join('repo')), keep=2, job=quiet())
+    for version, added in (('1.0', 1), ('1.1', 2), ('1.2', 3)):
+        repository.packages['foo_%s_all.deb' % version] = {
+            'type': 'deb', 'name': 'foo', 'arch': 'all', 'filename': 'foo_%s_all.deb' % version,
+            'mtime': 0, 'added': added,
+        }
+    repository.supersede()
+    assert sorted(repository.packages) == ['foo_1.1_all.deb', 'foo_1.2_all.deb']
+
+    repository.keep = None
+    repository.packages['foo_1.3_all.deb'] = dict(repository.packages['foo_1.2_all.deb'], added=4)
+    repository.supersede()
+    assert len(repository.packages) == 3
@@ -0,0 +1,50 @@
+import tarfile
+
+from conftest import fpm_calls, write_pkgbuild
+from empkg.__main__ import verify_reproducible
+from empkg.api import load
+from empkg.fingerprint import hash_file
+from empkg.reproducible import source_date_epoch
+from empkg.util import Job
+
+PACKAGE = '''#!/bin/bash
+mkdir -p {{pkgdir}}/usr/share/demo
+date +%s%N > {{pkgdir}}/usr/share/demo/built
+echo data > {{pkgdir}}/usr/share/demo/data
+chmod 666 {{pkgdir}}/usr/share/demo/data
+'''
+
+
+def test_builds_twice_with_the_same_digests(env):
+    project = env.mkdir('demo')
+    conf = load(write_pkgbuild(project, pkgname='demo', package=PACKAGE.replace('date +%s%N', 'echo')), {})
+    conf.update(reproducible=True, source_date_epoch=1500000000)
+    lines = []
+    err, artifacts = verify_reproducible(conf, job=Job(log=lines.append))
+    assert err is None
+    assert len(artifacts) == 1
+    assert lines[-1] == 'Reproducible: 1 packages identical over two builds'
+
+    calls = fpm_calls(env)
+    assert len(calls) == 2
+    for call in calls:
+        assert '--source-date-epoch-default %d' % source_date_epoch(conf) in call
+        assert '--deb-user root' in call
+        assert '--deb-group root' in call
+
+    # normalize_tree ran on the payload
+    epoch = source_date_epoch(conf)
+    with tarfile.open(artifacts[0]) as tar:
+        members = tar.getmembers()
+    assert all(member.mtime == epoch for member in members)
+    data = [member for member in members if member.name.endswith('/data')][0]
+    assert not data.mode & 022
+
+
+def test_reports_packages_that_differ(env):
+    project = env.mkdir('demo')
+    conf = load(write_pkgbuild(project, pkgname='demo', package=PACKAGE), {})
+    conf['reproducible'] = True
+    err, artifacts = verify_reproducible(conf, job=Job(log=lambda line: None))
+    assert err.startswith('Not reproducible: demo_1.0_all.deb')
+    assert hash_file(artifacts[0]) != hash_file(artifacts[0] + '.first')
@@ -0,0 +1,64 @@
+import json
+import os
+import socket
+import subprocess
+import sys
+import time
+
+import pytest
+
+from empkg.server import EXIT_MARKER, submit
+
+DAEMON = '''
+import sys
+from empkg.server import serve
+
+def build(args):
+    print 'building %s' % ' '.join(args)
+
+serve(sys.argv[1], 2, {'build': build})
+'''
+
+
+@pytest.fixture
+def daemon(tmpdir):
+    path = str(tmpdir.join('empkg.sock'))
+    env = dict(os.environ, PYTHONPATH=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    proc = subprocess.Popen([sys.executable, '-c', DAEMON, path], env=env, stdout=subprocess.PIPE)
+    proc.stdout.readline()
+    yield path
+    proc.terminate()
+    proc.wait()
+
+
+def request(path, data):
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.connect(path)
+    sock.sendall(data)
+    out = ''
+    while True:
+        chunk = sock.recv(4096)
+        if not chunk:
+            break
+        out += chunk
+    sock.close()
+    return out
+
+
+def test_slow_client_does_not_stall_others(daemon, tmpdir, capsys):
+    slow = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    slow.connect(daemon)
+    try:
+        started = time.time()
+        assert submit(daemon, str(tmpdir.join('PKGBUILD.yml')), ['PKGBUILD.yml', '--reuse']) is None
+        assert time.time() - started < 5
+    finally:
+        slow.close()
+    assert capsys.readouterr()[0] == 'building PKGBUILD.yml --reuse\n'
+
+
+def test_request_names_its_command(daemon, tmpdir):
+    out = request(daemon, json.dumps({'command': 'repo', 'cwd': str(tmpdir), 'args': []}) + '\n')
+    assert out == "Unknown command u'repo'\n" + EXIT_MARKER % 2
+    # No command, no build
+    assert request(daemon, json.dumps({'cwd': str(tmpdir), 'args': ['PKGBUILD.yml']}) + '\n') == ''
@@ -0,0 +1,73 @@
+import os
+import tarfile
+from cStringIO import StringIO
+
+import pytest
+
+from empkg import sources
+
+URL = 'https://example.com/demo-1.0.tar'
+
+
+def test_downloads_are_copied_out_of_the_cache(env):
+    cached = os.path.join(sources.source_cache(URL), 'demo-1.0.tar')
+    with open(cached, 'w') as fd:
+        fd.write('cached')
+    srcdir = env.mkdir('src')
+
+    # Offline, so only the cached file can be used
+    assert sources.get_url(URL, str(srcdir), offline=True, hardlink=True) == 'demo-1.0.tar'
+    staged = srcdir.join('demo-1.0.tar')
+    assert not os.path.samefile(cached, str(staged))
+    staged.write('modified', mode='a')
+    assert open(cached).read() == 'cached'
+
+
+def test_extracting_over_a_hardlinked_source(tmpdir):
+    startdir = tmpdir.mkdir('start')
+    startdir.join('config').write('original')
+    member = tmpdir.join('config')
+    member.write('from the archive')
+    archive = str(startdir.join('demo.tar'))
+    with tarfile.open(archive, 'w') as tar:
+        tar.add(str(member), 'config')
+    srcdir = tmpdir.mkdir('src')
+
+    sources.stage(['config', 'demo.tar'], str(srcdir), hardlink=True, root=str(startdir))
+    assert os.path.samefile(str(startdir.join('config')), str(srcdir.join('config')))
+    sources.extract_tar(str(srcdir.join('demo.tar')), str(srcdir))
+
+    assert srcdir.join('config').read() == 'from the archive'
+    assert startdir.join('config').read() == 'original'
+
+
+def archive(path, members):
+    with tarfile.open(path, 'w') as tar:
+        for name, linkname in members:
+            member = tarfile.TarInfo(name)
+            if linkname is None:
+                tar.addfile(member, StringIO(''))
+            else:
+                member.type = tarfile.SYMTYPE
+                member.linkname = linkname
+                tar.addfile(member)
+    return path
+
+
+def test_absolute_symlinks_are_extracted(tmpdir):
+    path = archive(str(tmpdir.join('venv.tar')), [('venv/bin/python', '/usr/bin/python2.7'), ('venv/lib/x.py', None)])
+    destination = tmpdir.mkdir('src')
+    sources.extract_tar(path, str(destination))
+    assert os.readlink(str(destination.join('venv', 'bin', 'python'))) == '/usr/bin/python2.7'
+
+
+def test_writes_through_symlinks_are_refused(tmpdir):
+    outside = tmpdir.mkdir('outside')
+    for linkname in (str(outside), '../outside'):
+        path = archive(str(tmpdir.join('evil.tar')), [('link', linkname), ('link/evil', None)])
+        destination = tmpdir.join('src')
+        destination.ensure(dir=True)
+        with pytest.raises(ValueError):
+            sources.extract_tar(path, str(destination))
+        destination.remove()
+    assert outside.listdir() == []
@@ -0,0 +1,99 @@
+import threading
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+
+import pytest
+
+from empkg import transport
+from empkg.util import Job
+
+BODY = ''.join(chr(i % 251) for i in xrange(300000))
+
+
+class Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class Handler(BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def send(self, status, body, headers=(), length=None):
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(body) if length is None else length))
+        for header in headers:
+            self.send_header(*header)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_HEAD(self):
+        self.send(200, '', length=len(BODY))
+
+    def do_GET(self):
+        self.server.requests.append((self.path, self.headers.get('Range')))
+        offset = int(self.headers['Range'][len('bytes='):-1]) if 'Range' in self.headers else 0
+        name = self.path.split('/')[1]
+        first = len(self.server.requests) == 1
+        if name == 'redirect':
+            self.send(302, '', [('Location', '/plain/demo.tar')])
+        elif name == 'disposition':
+            self.send(200, BODY, [('Content-Disposition', 'attachment; filename="%s"' % self.path.split('/', 2)[2])])
+        elif first and name != 'plain':
+            # Connection dropped half way through
+            self.send(200, BODY[:len(BODY) // 2], length=len(BODY))
+        elif name == 'norange' or not offset:
+            self.send(200, BODY)
+        elif name == 'mismatch':
+            self.send(206, BODY, [('Content-Range', 'bytes 0-%d/%d' % (len(BODY) - 1, len(BODY)))])
+        else:
+            self.send(206, BODY[offset:], [('Content-Range', 'bytes %d-%d/%d' % (offset, len(BODY) - 1, len(BODY)))])
+
+
+@pytest.fixture
+def server():
+    httpd = Server(('127.0.0.1', 0), Handler)
+    httpd.requests = []
+    thread = threading.Thread(target=httpd.serve_forever)
+    thread.daemon = True
+    thread.start()
+    yield httpd
+    httpd.shutdown()
+    httpd.server_close()
+    transport.pool.close()
+
+
+def fetch(server, path, destination, lines=None):
+    url = 'http://127.0.0.1:%d%s' % (server.server_address[1], path)
+    job = Job(log=(lines if lines is not None else []).append)
+    filename = transport.fetch(url, str(destination), backoff=0, job=job)
+    return filename, destination.join(filename).read('rb')
+
+
+def test_resume_after_truncated_response(server, tmpdir):
+    assert fetch(server, '/resume/demo.tar', tmpdir) == ('demo.tar', BODY)
+    assert server.requests == [('/resume/demo.tar', None), ('/resume/demo.tar', 'bytes=%d-' % (len(BODY) // 2))]
+
+
+def test_server_ignoring_range_restarts(server, tmpdir):
+    assert fetch(server, '/norange/demo.tar', tmpdir) == ('demo.tar', BODY)
+    assert [range_ for _, range_ in server.requests] == [None, 'bytes=%d-' % (len(BODY) // 2)]
+
+
+def test_redirect(server, tmpdir):
+    assert fetch(server, '/redirect/demo.tar', tmpdir) == ('demo.tar', BODY)
+    assert [path for path, _ in server.requests] == ['/redirect/demo.tar', '/plain/demo.tar']
+
+
+def test_content_range_mismatch(server, tmpdir):
+    lines = []
+    assert fetch(server, '/mismatch/demo.tar', tmpdir, lines) == ('demo.tar', BODY)
+    assert any('Resumed at 0 instead of byte %d' % (len(BODY) // 2) in line for line in lines)
+    # Started over without a Range
+    assert server.requests[-1] == ('/mismatch/demo.tar', None)
+
+
+def test_content_disposition_filename(server, tmpdir):
+    assert fetch(server, '/disposition/../../evil.tar', tmpdir)[0] == 'evil.tar'
+    with pytest.raises(transport.TransferError):
+        fetch(server, '/disposition/..', tmpdir)
+    assert sorted(tmpdir.listdir()) == [tmpdir.join('evil.tar')]